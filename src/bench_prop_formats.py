@@ -0,0 +1,83 @@
+'''Compare parse and write speed of the document property file formats'''
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+
+from doccol.engine.utils.PropertyFile import PropertyFile
+from doccol.engine.utils.BinaryPropertyFile import BinaryPropertyFile
+
+FORMATS = (
+    ('v1 json', PropertyFile),
+    ('v2 binary', BinaryPropertyFile),
+)
+
+
+def make_properties(rnd, num_props):
+    '''Stored property values like a document with lists and dicts would have'''
+    def _python(value):
+        return {'value_type': 'python', 'value': value}
+
+    properties = dict()
+    for i in range(num_props):
+        kind = i % 4
+        if kind == 0:
+            value = _python(u'title text %d' % rnd.randint(0, 1000000))
+        elif kind == 1:
+            value = _python(rnd.random() * 1000)
+        elif kind == 2:
+            value = {'value_type': 'list', 'value': [
+                _python(u'item %d' % j) for j in range(rnd.randint(5, 20))]}
+        else:
+            value = {'value_type': 'dict', 'value': dict([
+                ('key%d' % j, _python(rnd.randint(0, 1000))) for j in range(rnd.randint(5, 20))])}
+        properties['prop%d' % i] = value
+    return properties
+
+
+def bench(prop_file_class, folder, docs):
+    paths = [os.path.join(folder, 'doc%d' % i) for i in range(len(docs))]
+
+    start = time.time()
+    for path, properties in zip(paths, docs):
+        props = prop_file_class(path)
+        props.def_property('name')
+        props.def_property('properties')
+        props.update({'name': os.path.basename(path), 'properties': properties})
+    write_secs = time.time() - start
+
+    start = time.time()
+    for path in paths:
+        props = prop_file_class(path)
+        props.def_property('properties')
+        props['properties']
+    read_secs = time.time() - start
+
+    size = sum([os.path.getsize(path) for path in paths])
+    return write_secs, read_secs, size
+
+
+if __name__ == '__main__':
+
+    num_docs = 2000
+    num_props = 40
+    if len(sys.argv) > 1:
+        num_docs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_props = int(sys.argv[2])
+
+    rnd = random.Random(1)
+    docs = [make_properties(rnd, num_props) for i in range(num_docs)]
+
+    print "%d documents with %d properties each" % (num_docs, num_props)
+    print "%-12s %12s %12s %12s" % ('format', 'write docs/s', 'read docs/s', 'bytes/doc')
+    for name, prop_file_class in FORMATS:
+        folder = tempfile.mkdtemp()
+        try:
+            write_secs, read_secs, size = bench(prop_file_class, folder, docs)
+        finally:
+            shutil.rmtree(folder)
+        print "%-12s %12.0f %12.0f %12.0f" % (
+            name, num_docs / write_secs, num_docs / read_secs, float(size) / num_docs)
@@ -14,9 +14,15 @@ def abort(msg = None):
 if __name__ == '__main__':
 
     # Get arguments
-    if len(sys.argv) != 2:
-        abort ("Usage: %s colection_path" % (os.path.basename(sys.argv[0])))
+    if len(sys.argv) not in (2, 3):
+        abort ("Usage: %s colection_path [version]" % (os.path.basename(sys.argv[0])))
     path = sys.argv[1].strip()
+    version = None
+    if len(sys.argv) == 3:
+        try:
+            version = int(sys.argv[2])
+        except ValueError:
+            abort("Version must be a number: " + sys.argv[2])
 
     # Create directory if doesn't exists
     if not os.path.exists(path):
@@ -28,7 +34,7 @@ if __name__ == '__main__':
 
     # Do creation
     try:
-        create_doccol(path)
+        create_doccol(path, version)
     except DocCollectionOperationError, e:
         abort("Failed:\n" + str(e))
 
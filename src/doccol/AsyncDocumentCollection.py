@@ -0,0 +1,448 @@
+import sys
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from DocumentCollection import DocumentCollection
+
+
+class DocColFuture(object):
+    '''
+    Result of an AsyncDocumentCollection call, filled in by a worker thread
+
+        future = acol.get('Banner Documents', 'Guide')
+        doc = future.get()                          # Blocks until done
+        future.add_done_callback(lambda f: ioloop.add_callback(handle, f))
+    '''
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = list()
+
+
+    def _set_result(self, result, exc_info=None):
+        with self.__lock:
+            self.__result = result
+            self.__exc_info = exc_info
+            self.__done.set()
+            callbacks = self.__callbacks
+            self.__callbacks = list()
+        for callback in callbacks:
+            callback(self)
+
+
+    def ready(self):
+        '''Has the call finished?'''
+        return self.__done.is_set()
+
+
+    def successful(self):
+        '''Did the call finish without raising?'''
+        return self.ready() and self.__exc_info is None
+
+
+    def wait(self, timeout=None):
+        '''Block until the call finishes (or timeout seconds pass)'''
+        self.__done.wait(timeout)
+
+
+    def get(self, timeout=None):
+        '''
+        Block until the call finishes and return its result
+
+        :param timeout: Seconds to wait (None for no limit)
+        :return: Value returned by the call (re-raises what the call raised)
+        '''
+        if not self.__done.wait(timeout):
+            raise TimeoutError()
+        if self.__exc_info is not None:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(future) when the call finishes
+
+        Called on the worker thread (or right away if already finished), so
+        hand off to your event loop from it (ex: IOLoop.add_callback()).
+        '''
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+
+class AsyncDocument(object):
+    '''
+    Document returned by AsyncDocumentCollection
+
+    Properties are loaded on the worker thread before the document is
+    handed back, so doc.p reads come from memory and don't block.  Changes
+    go through set() and delete(), which return a DocColFuture.
+    '''
+
+    def __init__(self, acol, doc):
+        self.__acol = acol
+        self.__doc = doc
+
+
+    @property
+    def document(self):
+        '''Underlying (blocking) Document'''
+        return self.__doc
+
+
+    @property
+    def domain(self):
+        return self.__doc.domain
+
+    @property
+    def name(self):
+        return self.__doc.name
+
+    @property
+    def properties(self):
+        return self.__doc.properties
+
+    @property
+    def p(self):
+        return self.properties
+
+
+    def refresh(self):
+        '''
+        Re-load the properties
+
+        :return: DocColFuture of this document
+        '''
+        def _refresh():
+            self.__doc.snapshot()
+            return self
+        return self.__acol._read(_refresh)
+
+
+    def set(self, **kwargs):
+        '''
+        Set property values (in order with other changes to this document)
+
+        :return: DocColFuture (of None)
+        '''
+        return self.__acol._write(self.__doc.properties.set, **kwargs)
+
+
+    def del_prop(self, name):
+        '''
+        Delete a property (in order with other changes to this document)
+
+        :return: DocColFuture (of None)
+        '''
+        return self.__acol._write(self.__doc.properties.del_prop, name)
+
+
+    def delete(self):
+        '''
+        Delete the document out of the collection
+
+        :return: DocColFuture (of None)
+        '''
+        return self.__acol._write(self.__doc.delete)
+
+
+    def open_attachment(self, prop_name, chunk_size=None):
+        '''
+        Stream an attachment property's contents
+
+            reader = doc.open_attachment('file')
+            chunk = reader.read().get()
+            while chunk:
+                response.write(chunk)
+                chunk = reader.read().get()
+            reader.close()
+
+        :param prop_name: Name of the attachment property
+        :param chunk_size: Default bytes per read()
+        :return: AsyncAttachmentReader
+        '''
+        attachment = self.p.get(prop_name)
+        if attachment is None or not hasattr(attachment, 'open'):
+            raise KeyError("Document %s has no attachment property '%s'" % (str(self), prop_name))
+        return AsyncAttachmentReader(self.__acol, attachment, chunk_size)
+
+
+    def __str__(self):
+        return str(self.__doc)
+
+
+class AsyncAttachmentReader(object):
+    '''
+    Reads an attachment a chunk at a time on the attachment pool
+
+    The file is opened by the first read(), so the caller never blocks.
+    '''
+
+    def __init__(self, acol, attachment, chunk_size=None):
+        self.__acol = acol
+        self.__attachment = attachment
+        self.__chunk_size = chunk_size or AsyncDocumentCollection.ATTACHMENT_CHUNK_SIZE
+        self.__fh = None
+        self.__lock = threading.Lock()     # One read at a time, in order
+
+
+    def read(self, size=None):
+        '''
+        Read the next chunk
+
+        :param size: Bytes to read (default the reader's chunk_size)
+        :return: DocColFuture of the data ('' at the end)
+        '''
+        def _read():
+            with self.__lock:
+                if self.__fh is None:
+                    self.__fh = self.__attachment.open('rb')
+                return self.__fh.read(size or self.__chunk_size)
+        return self.__acol._read_attachment(_read)
+
+
+    def close(self):
+        '''Close the file (once reads are done)'''
+        with self.__lock:
+            if self.__fh is not None:
+                self.__fh.close()
+                self.__fh = None
+
+
+class AsyncDocIterator(object):
+    '''
+    Lists documents a batch at a time on the read pool
+
+        docs = acol.list_docs('Banner Documents')
+        batch = docs.next_batch().get()
+        while batch:
+            ...
+            batch = docs.next_batch().get()
+    '''
+
+    def __init__(self, acol, make_iter, batch_size):
+        self.__acol = acol
+        self.__make_iter = make_iter
+        self.__batch_size = batch_size
+        self.__iter = None
+        self.__lock = threading.Lock()     # Generator is advanced by one worker at a time
+
+
+    def next_batch(self, size=None):
+        '''
+        Get the next documents
+
+        :param size: Max number of documents (default the iterator's batch_size)
+        :return: DocColFuture of a list of AsyncDocument (empty at the end)
+        '''
+        def _next():
+            with self.__lock:
+                if self.__iter is None:
+                    self.__iter = self.__make_iter()
+                docs = list()
+                for doc in self.__iter:
+                    docs.append(doc)
+                    if len(docs) >= (size or self.__batch_size):
+                        break
+                return docs
+        return self.__acol._read(_next)
+
+
+class AsyncDocumentCollection(object):
+    '''
+    Non-blocking front end to a DocumentCollection for event loop servers
+
+    Each call runs the collection work on a worker thread and returns a
+    DocColFuture right away.  Three bounded thread pools are used:
+
+      read pool         get(), find(), search(), list_docs() and loading
+                        properties.  Reads run concurrently.
+      writer            new(), del_doc() and AsyncDocument set(), del_prop()
+                        and delete().  Run one at a time in the order they
+                        were called, so changes to a document are never
+                        reordered (and never race each other in the engine).
+      attachment pool   Streamed attachment reads, so a few large downloads
+                        can't tie up the threads small metadata reads need.
+
+    find() and search() wait for a running write to finish, since writes
+    update the indexes they read.
+    '''
+
+    ATTACHMENT_CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, path, workers=8, attachment_workers=2):
+        '''
+        :param path: Path to document collection (or an open DocumentCollection)
+        :param workers: Max number of reads to run at once
+        :param attachment_workers: Max number of attachment reads to run at once
+        '''
+        if isinstance(path, DocumentCollection):
+            self.__col = path
+        else:
+            self.__col = DocumentCollection(path)
+
+        self.__read_pool = ThreadPool(workers)
+        self.__write_pool = ThreadPool(1)
+        self.__attachment_pool = ThreadPool(attachment_workers)
+        self.__index_lock = threading.Lock()    # Held by writes, find() and search()
+
+
+    @property
+    def collection(self):
+        '''Underlying (blocking) DocumentCollection'''
+        return self.__col
+
+
+    @property
+    def data_types(self):
+        return self.__col.data_types
+
+
+    def close(self):
+        '''Finish queued work and stop the worker threads'''
+        for pool in (self.__read_pool, self.__write_pool, self.__attachment_pool):
+            pool.close()
+        for pool in (self.__read_pool, self.__write_pool, self.__attachment_pool):
+            pool.join()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    # -- Running work --------------------------------------------------------
+
+    def _submit(self, pool, func, args, kwargs, lock=None):
+        '''
+        Run func on a pool
+
+        :return: DocColFuture
+        '''
+        future = DocColFuture()
+
+        def _run():
+            try:
+                if lock is not None:
+                    with lock:
+                        result = func(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+            except Exception:
+                future._set_result(None, sys.exc_info())
+                return
+            future._set_result(result)
+
+        pool.apply_async(_run)
+        return future
+
+
+    def _read(self, func, *args, **kwargs):
+        return self._submit(self.__read_pool, func, args, kwargs)
+
+
+    def _read_indexed(self, func, *args, **kwargs):
+        return self._submit(self.__read_pool, func, args, kwargs, self.__index_lock)
+
+
+    def _write(self, func, *args, **kwargs):
+        return self._submit(self.__write_pool, func, args, kwargs, self.__index_lock)
+
+
+    def _read_attachment(self, func, *args, **kwargs):
+        return self._submit(self.__attachment_pool, func, args, kwargs)
+
+
+    def _wrap(self, doc, load=True):
+        '''Make an AsyncDocument (loading its properties on this worker)'''
+        if load:
+            doc.snapshot()
+        return AsyncDocument(self, doc)
+
+
+    # -- Collection calls ----------------------------------------------------
+
+    def get(self, domain, name, load=True):
+        '''
+        Retrieve a document
+
+        :param domain: Name of the domain to get document from
+        :param name: Name of the document to retrieve (within domain)
+        :param load: Load the properties too (so doc.p reads don't block)
+        :return: DocColFuture of an AsyncDocument (raises KeyError if missing)
+        '''
+        return self._read(lambda: self._wrap(self.__col.get(domain, name), load))
+
+
+    def new(self, domain, name, **properties):
+        '''
+        Create a new document (in order with other changes)
+
+        :param domain: Domain for the document
+        :param name: Unique name for the document (in the domain)
+        :param properties: Property values to set on it
+        :return: DocColFuture of an AsyncDocument
+        '''
+        def _new():
+            doc = self.__col.new(domain, name)
+            if len(properties) > 0:
+                doc.p.set(**properties)
+            return self._wrap(doc)
+        return self._write(_new)
+
+
+    def del_doc(self, domain, name):
+        '''
+        Delete a document out of the collection (in order with other changes)
+
+        :return: DocColFuture (of None)
+        '''
+        return self._write(self.__col.del_doc, domain, name)
+
+
+    def find(self, domain=None, where=None, limit=None, order_by=None, load=True, **predicates):
+        '''
+        Find documents by property values (see DocumentCollection.find())
+
+        :param load: Load the documents' properties too
+        :return: DocColFuture of a list of AsyncDocument
+        '''
+        def _find():
+            return [self._wrap(doc, load) for doc in self.__col.find(
+                domain, where, limit, order_by=order_by, **predicates)]
+        return self._read_indexed(_find)
+
+
+    def search(self, text, domain=None, limit=None, load=True):
+        '''
+        Find documents by the words in them (see DocumentCollection.search())
+
+        :param load: Load the documents' properties too
+        :return: DocColFuture of a list of AsyncDocument, best match first
+        '''
+        def _search():
+            return [self._wrap(doc, load) for doc in self.__col.search(text, domain, limit)]
+        return self._read_indexed(_search)
+
+
+    def list_docs(self, domain, batch_size=100):
+        '''
+        List documents (with properties loaded) a batch at a time
+
+        :param domain: Name of domain, or None for all domains
+        :param batch_size: Number of documents per batch
+        :return: AsyncDocIterator
+        '''
+        def _make_iter():
+            for doc in self.__col.list_docs(domain, prefetch=True):
+                yield self._wrap(doc, load=False)
+        return AsyncDocIterator(self, _make_iter, batch_size)
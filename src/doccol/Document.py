@@ -7,24 +7,62 @@ from DocumentProperties import DocumentProperties
 class Document(object):
     '''A document in the collection'''
 
-    def __init__(self, engine, doc_id):
+    def __init__(self, engine, doc_id, values=None, stamp=None):
         '''
 
         :param engine: Document collection engine which stores doc info
         :param name: Unique ID for the document for the engine
+        :param values: Properties already loaded for the document (like snapshot())
+        :param stamp: Document stamp from when values were loaded
         '''
         self.__engine = engine
         self.__doc_id = doc_id
+        self.__properties = DocumentProperties(engine, doc_id, values, stamp)
 
 
+    @property
+    def domain(self):
+        '''Name of the domain the document is in'''
+        return self.__doc_id.domain
+
+    @property
+    def name(self):
+        '''Name of the document (unique in its domain)'''
+        return self.__doc_id.doc_name
+
     @property
     def properties(self):
-        return DocumentProperties(self.__engine, self.__doc_id)
+        return self.__properties
 
     @property
     def p(self):
         return self.properties
 
+    def snapshot(self):
+        '''
+        Load all properties once so reads (doc.p.title, ...) come from memory
+
+        :return: DocumentProperties (also available as doc.p)
+        '''
+        return self.__properties._load()
+
+
+    def refresh(self):
+        '''Re-load properties captured by snapshot()'''
+        self.__properties._refresh()
+
+
+    @property
+    def loaded(self):
+        '''Are properties being read from a snapshot()?'''
+        return self.__properties._loaded
+
+
+    def is_stale(self):
+        '''Has the document changed since snapshot() (or refresh()) was called?'''
+        return self.__properties._is_stale()
+
+
     def __str__(self):
         return "%s :: %s" % (self.__doc_id.domain, self.__doc_id.doc_name)
 
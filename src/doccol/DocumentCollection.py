@@ -1,5 +1,7 @@
 
 from .engine import pick_engine
+from .engine.verify import verify_attachments
+from .engine.garbage import collect_garbage
 
 from Document import Document
 
@@ -9,6 +11,24 @@ class PropertyDataTypes(object):
 
 
 
+class BulkNewResult(object):
+    '''Outcome of creating one document with DocumentCollection.bulk_new()'''
+
+    def __init__(self, name, doc, error):
+        self.name = name
+        self.doc = doc
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return "%s: created" % (self.name)
+        return "%s: FAILED: %s" % (self.name, str(self.error))
+
+
 class DocumentCollection(object):
     '''Interface to the DocumentCollection folder for CRUD'''
 
@@ -24,6 +44,29 @@ class DocumentCollection(object):
             self.data_types.__setattr__(type_name, type_class)
 
 
+    @property
+    def settings(self):
+        '''
+        Collection-wide settings for the engine (see the engine for what's available)
+
+            col.settings['dedup_attachments'] = True
+        '''
+        return self.__engine.settings
+
+
+    def batch(self):
+        '''
+        Group changes so each document's properties are written once
+
+            with col.batch():
+                for name, props in items:
+                    col.new(domain, name).p.set(**props)
+
+        :return: context manager
+        '''
+        return self.__engine.batch()
+
+
     def new(self, domain, name):
         '''
         Create a new document
@@ -37,17 +80,194 @@ class DocumentCollection(object):
         return doc
 
 
-    def list_docs(self, domain):
+    def bulk_new(self, domain, items, workers=4):
+        '''
+        Create many documents (with properties) at once
+
+        Failures don't stop the load.  Check each result's ok/error.
+
+        :param domain: Domain for the documents
+        :param items: Iterable of (name, properties dict)
+        :param workers: Number of workers to copy attachments in with
+        :return: list of BulkNewResult (in the same order as items)
+        '''
+        results = list()
+        for name, doc_id, error in self.__engine.create_new_docs(domain, items, workers):
+            doc = None
+            if doc_id is not None:
+                doc = Document(self.__engine, doc_id)
+            results.append(BulkNewResult(name, doc, error))
+        return results
+
+
+    def list_docs(self, domain, prefetch=False, workers=8):
         '''
         List documents in the collection
 
         :param domain: Name of domain, or None for all domains
+        :param prefetch: Load properties ahead of time (documents come back
+                         as if doc.snapshot() was called)
+        :param workers: Number of workers to prefetch with
         :return: Document objects
         '''
-        for doc_id in self.__engine.list_all_docs(domain):
+        if prefetch:
+            for doc_id, values, stamp in self.__engine.list_all_docs_with_properties(domain, workers):
+                yield Document(self.__engine, doc_id, values, stamp)
+        else:
+            for doc_id in self.__engine.list_all_docs(domain):
+                yield Document(self.__engine, doc_id)
+
+
+    def find(self, domain=None, where=None, limit=None, workers=None, order_by=None, **predicates):
+        '''
+        Find documents by property values
+
+            col.find('Banner Documents', module='Banner Finance')
+            col.find(where={'version': Range('8.5', None), 'title': Prefix('Banner')}, limit=50)
+            col.find(order_by='-date', limit=10)
+
+        :param domain: Name of domain, or None for all domains
+        :param where: Dictionary of [property_name] = Predicate (Eq, In, Prefix, Range)
+                      or a plain value to match exactly
+        :param limit: Stop after this many documents are found
+        :param workers: Number of workers the engine may use to scan with
+        :param order_by: Property name to sort by ('-name' for descending).  Documents
+                         without a number or string value for it are left out.
+        :param predicates: More [property_name] = Predicate (merged into where)
+        :return: Document objects
+        '''
+        all_where = dict(where or dict())
+        all_where.update(predicates)
+        for doc_id in self.__engine.find_docs(domain, all_where, limit, workers, order_by):
+            yield Document(self.__engine, doc_id)
+
+
+    def declare_index(self, prop_name, kind='equality'):
+        '''
+        Index a property so find() can look up values without scanning
+
+        :param prop_name: Name of the property to index
+        :param kind: Type of index: 'equality', or 'sorted' to also answer Range
+                     and Prefix queries and order_by
+        '''
+        self.__engine.declare_index(prop_name, kind)
+
+
+    def drop_index(self, prop_name):
+        '''
+        Stop indexing a property
+
+        :param prop_name: Name of the property
+        '''
+        self.__engine.drop_index(prop_name)
+
+
+    def rebuild_indexes(self, prop_names=None):
+        '''
+        Rebuild property indexes from the documents
+
+        :param prop_names: Properties to rebuild (None for all)
+        '''
+        self.__engine.rebuild_indexes(prop_names)
+
+
+    def refresh_indexes(self):
+        '''
+        Catch the indexes up with documents added, edited, or removed by hand
+        (or by a git pull)
+
+        Happens automatically the first time the indexes are used after the
+        collection is opened.  Only changed documents are read.
+
+        :return: Number of documents re-indexed
+        '''
+        return self.__engine.refresh_indexes()
+
+
+    def search(self, text, domain=None, limit=None):
+        '''
+        Find documents by the words in their string properties and attachments
+
+            col.declare_text_index()
+            col.search('budget "fiscal year"', limit=20)
+
+        :param text: Words the documents must all contain ("quoted" for phrases)
+        :param domain: Name of domain, or None for all domains
+        :param limit: Max number of results
+        :return: Document objects, best match first
+        '''
+        for doc_id, score in self.__engine.search_docs(text, domain, limit):
             yield Document(self.__engine, doc_id)
 
 
+    def declare_text_index(self, prop_names=None, attachments=True):
+        '''
+        Index the words in documents so search() can find them
+
+        :param prop_names: Properties to index (None for every property)
+        :param attachments: Also index attachment files
+        '''
+        self.__engine.declare_text_index(prop_names, attachments)
+
+
+    def drop_text_index(self):
+        '''Stop keeping the full-text index'''
+        self.__engine.drop_text_index()
+
+
+    def rebuild_text_index(self, background=False):
+        '''
+        Rebuild the full-text index from the documents
+
+        :param background: Rebuild on another thread (search() keeps working)
+        :return: threading.Thread doing the rebuild if background, else None
+        '''
+        return self.__engine.rebuild_text_index(background)
+
+
+    def register_text_extractor(self, ext, extractor):
+        '''
+        Set how to get the text out of attachments of a file type
+
+        Plain text types are handled already.
+
+        :param ext: File extension (ex: '.pdf')
+        :param extractor: Called with the path to the file, returns text (or None)
+        '''
+        self.__engine.register_text_extractor(ext, extractor)
+
+
+    def verify_attachments(self, domain=None, processes=None, max_mb_per_sec=None, include_ok=False):
+        '''
+        Check attachment files still match the hashes recorded when they were added
+
+            for check in col.verify_attachments(max_mb_per_sec=50):
+                print check
+
+        :param domain: Name of domain, or None for all domains
+        :param processes: Number of processes to hash files with (default number of CPUs)
+        :param max_mb_per_sec: Limit on how fast files are read (None for no limit)
+        :param include_ok: Also report attachments that passed
+        :return: AttachmentCheck objects for mismatched, missing, and unreadable files
+        '''
+        max_bytes_per_sec = None
+        if max_mb_per_sec is not None:
+            max_bytes_per_sec = int(max_mb_per_sec * 1024 * 1024)
+        return verify_attachments(self.__engine, domain, processes, max_bytes_per_sec, include_ok)
+
+
+    def collect_garbage(self):
+        '''
+        Remove stored chunks and blobs no document uses anymore
+
+        Chunked attachments share chunks, so replacing or deleting them leaves
+        chunks behind until this runs.  Reads every document.
+
+        :return: dict of number removed: {'chunks': n, 'blobs': n}
+        '''
+        return collect_garbage(self.__engine)
+
+
     def get(self, domain, name):
         '''
         Retrieve a document
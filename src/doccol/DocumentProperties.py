@@ -3,14 +3,25 @@ class DocumentProperties(object):
     '''Helper that can be accessed via document.p & document.properties'''
 
 
-    def __init__(self, engine, doc_id):
+    def __init__(self, engine, doc_id, values=None, stamp=None):
+        '''
+        :param engine: Document collection engine which stores doc info
+        :param doc_id: Unique ID for the document for the engine
+        :param values: Properties already loaded for the document (see _load())
+        :param stamp: Document stamp from when values were loaded
+        '''
         self.__engine = engine
         self.__doc_id = doc_id
+        self.__snapshot = values
+        self.__snapshot_stamp = stamp
 
 
     def get(self, name):
         '''Get parameter value'''
-        property_values = self.__engine.get_document_properties(self.__doc_id)
+        if self.__snapshot is not None:
+            property_values = self.__snapshot
+        else:
+            property_values = self.__engine.get_document_properties(self.__doc_id)
         if property_values.has_key(name):
             return property_values[name]
         return None
@@ -20,11 +31,50 @@ class DocumentProperties(object):
     def set(self, **kwargs):
         '''Set multiple parameter values'''
         self.__engine.update_properties(self.__doc_id, kwargs)
+        if self.__snapshot is not None:
+            self._load()
 
 
     def del_prop(self, name):
         '''Delete the property with the given name'''
         self.__engine.del_property(self.__doc_id, name)
+        if self.__snapshot is not None:
+            self._load()
+
+
+    # -- Snapshot ------------------------------------------------------------
+    # Underscored so they don't hide properties of the same name (doc.p.load)
+
+    def _load(self):
+        '''
+        Fetch the properties once and serve reads from memory
+
+        Until _refresh() is called, reads won't see changes made to the document
+        by anything other than this object.  Use _is_stale() to check.
+
+        :return: self
+        '''
+        self.__snapshot_stamp = self.__engine.get_document_stamp(self.__doc_id)
+        self.__snapshot = self.__engine.get_document_properties(self.__doc_id)
+        return self
+
+
+    def _refresh(self):
+        '''Re-fetch loaded properties (if _load() was called)'''
+        if self.__snapshot is not None:
+            self._load()
+
+
+    @property
+    def _loaded(self):
+        return self.__snapshot is not None
+
+
+    def _is_stale(self):
+        '''Have the document's properties changed since they were loaded?'''
+        if self.__snapshot is None:
+            return False
+        return self.__engine.get_document_stamp(self.__doc_id) != self.__snapshot_stamp
 
 
 
@@ -40,7 +90,3 @@ class DocumentProperties(object):
             self.set({key: value})
         else:
             super(DocumentProperties, self).__setattr__(key, value)
-
-
-
-
@@ -1,3 +1,5 @@
 '''Library/tool for managing collections of documents with metadata'''
 
-from DocumentCollection import DocumentCollection
\ No newline at end of file
+from DocumentCollection import DocumentCollection
+from AsyncDocumentCollection import AsyncDocumentCollection, DocColFuture
+from .engine.query import Eq, In, Prefix, Range
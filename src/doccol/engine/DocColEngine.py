@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
+from contextlib import contextmanager
 
 class DocColEngine(object):
     '''Logic for working with Document Collection folder (base components)
@@ -14,6 +15,22 @@ class DocColEngine(object):
         '''Data types that can be used when setting property values'''
 
 
+    @property
+    def settings(self):
+        '''Collection-wide settings (PropertyFile-like), or None if engine has none'''
+        return None
+
+
+    @contextmanager
+    def batch(self):
+        '''
+        Group changes made in a with block so they can be saved together
+
+        Engines that can't defer saves just make changes as they happen.
+        '''
+        yield
+
+
     @abstractmethod
     def create_new_doc(self, domain, name):
         '''
@@ -25,6 +42,34 @@ class DocColEngine(object):
         '''
 
 
+    def create_new_docs(self, domain, items, workers=4):
+        '''
+        Initialize many new documents (with properties) in one domain
+
+        Engines should override this with something faster than one
+        create_new_doc() and update_properties() per document.
+
+        :param domain: Domain (like a folder) of documents
+        :param items: Iterable of (name, properties dict)
+        :param workers: Number of workers the engine may use
+        :return: Generator of (name, Internal Document ID or None, Exception or None)
+        '''
+        with self.batch():
+            for name, properties in items:
+                try:
+                    doc_id = self.create_new_doc(domain, name)
+                except Exception, e:
+                    yield name, None, e
+                    continue
+                try:
+                    self.update_properties(doc_id, properties)
+                except Exception, e:
+                    self.del_document(doc_id)
+                    yield name, None, e
+                    continue
+                yield name, doc_id, None
+
+
     @abstractmethod
     def list_all_domains(self):
         '''
@@ -44,6 +89,126 @@ class DocColEngine(object):
         '''
 
 
+    def list_all_docs_with_properties(self, domain=None, workers=8, after=None):
+        '''
+        List all documents with their properties loaded
+
+        Engines should override this to load properties ahead of time, and to
+        start after a document without listing the ones before it
+
+        :param domain: Name of the domain (None for all domains)
+        :param workers: Number of workers the engine may use
+        :param after: Start after this document (an id from listing the same domain)
+        :return: Generator of (document id, properties, stamp)
+        '''
+        doc_ids = self.list_all_docs(domain)
+        if after is not None:
+            for doc_id in doc_ids:
+                if (doc_id.domain, doc_id.name) == (after.domain, after.name):
+                    break
+        for doc_id in doc_ids:
+            stamp = self.get_document_stamp(doc_id)
+            yield doc_id, self.get_document_properties(doc_id), stamp
+
+
+    @abstractmethod
+    def find_docs(self, domain, where, limit=None, workers=None, order_by=None):
+        '''
+        Find documents whose property values pass every predicate
+
+        :param domain: Name of the domain (None for all domains)
+        :param where: Dictionary of [property_name] = Predicate (or value to equal)
+        :param limit: Stop after this many documents are found
+        :param workers: Number of workers the engine may use
+        :param order_by: Property name to sort by ('-name' for descending)
+        :return: Generator listing document ids
+        '''
+
+
+    @abstractmethod
+    def declare_index(self, prop_name, kind='equality'):
+        '''
+        Keep a secondary index on a property so find_docs() doesn't need to scan
+
+        :param prop_name: Name of the property to index
+        :param kind: Type of index
+        '''
+
+
+    @abstractmethod
+    def drop_index(self, prop_name):
+        '''
+        Stop indexing a property
+
+        :param prop_name: Name of the property
+        '''
+
+
+    @abstractmethod
+    def rebuild_indexes(self, prop_names=None):
+        '''
+        Rebuild secondary indexes from scratch
+
+        :param prop_names: Properties to rebuild (None for all)
+        '''
+
+
+    @abstractmethod
+    def refresh_indexes(self):
+        '''
+        Update the indexes for documents changed outside the engine
+
+        :return: Number of documents re-indexed
+        '''
+
+
+    @abstractmethod
+    def declare_text_index(self, prop_names=None, attachments=True):
+        '''
+        Keep a full-text index so search_docs() can find documents by words
+
+        :param prop_names: Properties to index (None for every property)
+        :param attachments: Also index attachment files
+        '''
+
+
+    @abstractmethod
+    def drop_text_index(self):
+        '''Stop keeping the full-text index'''
+
+
+    @abstractmethod
+    def rebuild_text_index(self, background=False):
+        '''
+        Rebuild the full-text index from scratch
+
+        :param background: Rebuild on another thread
+        :return: threading.Thread doing the rebuild if background, else None
+        '''
+
+
+    @abstractmethod
+    def register_text_extractor(self, ext, extractor):
+        '''
+        Set how to get the text out of attachments of a file type
+
+        :param ext: File extension (ex: '.pdf')
+        :param extractor: Called with the path to the file, returns text (or None)
+        '''
+
+
+    @abstractmethod
+    def search_docs(self, text, domain=None, limit=None):
+        '''
+        Find documents containing every word and "quoted phrase" in text
+
+        :param text: Search query
+        :param domain: Name of the domain (None for all domains)
+        :param limit: Max number of results
+        :return: Generator of (document id, score), best first
+        '''
+
+
     @abstractmethod
     def get_document_id(self, domain, name):
         '''
@@ -65,6 +230,18 @@ class DocColEngine(object):
         '''
 
 
+    @abstractmethod
+    def get_document_stamp(self, doc_id):
+        '''
+        Get a cheap token that changes when the document's properties change
+
+        Used to tell if properties loaded earlier are stale.
+
+        :param doc_id: Internal Document ID
+        :return: Comparable value (None if the document doesn't exist)
+        '''
+
+
     @abstractmethod
     def update_properties(self, doc_id, properties):
         '''
@@ -3,6 +3,8 @@ from abc import ABCMeta, abstractproperty
 class DocumentId(object):
     "Identifies a document in the collection (specific to engine being used)"
 
+    __metaclass__ = ABCMeta
+
     @abstractproperty
     def name(self):
         '''
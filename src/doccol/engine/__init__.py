@@ -1,6 +1,7 @@
 import os
 
 from .exceptions import DocCollectionOperationError
+from .utils.atomic_write import atomic_write
 
 def is_doc_col_folder(path):
     '''Is the given directory a valid collection?'''
@@ -9,10 +10,39 @@ def is_doc_col_folder(path):
 LATEST_DOC_COL_VER=1
 
 
-def create_doccol(path):
-    '''Create a new collection'''
+SUPPORTED_VERSIONS = (1, 2, 3)
+
+
+def create_doccol(path, version=None):
+    '''
+    Create a new collection
+
+    :param path: Folder to create the collection in
+    :param version: Collection format version (default LATEST_DOC_COL_VER).
+                    2 keeps document properties in a binary format.
+                    3 keeps everything but attachments in one SQLite database.
+    '''
     global LATEST_DOC_COL_VER
 
+    if version is None:
+        version = LATEST_DOC_COL_VER
+    prepare_doccol_folder(path, version)
+    write_doccol_version(path, version)
+
+
+def prepare_doccol_folder(path, version):
+    '''
+    Set up a new collection's folder, except for the VERSION file
+
+    Until VERSION is written (see write_doccol_version()) pick_engine() won't
+    open the collection, so a partly built collection can't be used.
+
+    :param path: Folder to create the collection in
+    :param version: Collection format version
+    '''
+    if version not in SUPPORTED_VERSIONS:
+        raise DocCollectionOperationError("Unsupported Document Collection Version: " + str(version))
+
     if not os.path.isdir(path):
         raise DocCollectionOperationError("Not a directory: " + path)
 
@@ -23,14 +53,58 @@ def create_doccol(path):
         print >>fh, "This is a marker file to designate this folder as a Document Collection"
         print >>fh, "meant to be managed by the doccol tool"
 
-    os.mkdir(os.path.join(path, 'documents'))
+    if version < 3:
+        os.mkdir(os.path.join(path, 'documents'))
 
-    with open(os.path.join(path, 'VERSION'), 'wt') as fh:
-        print >>fh, str(LATEST_DOC_COL_VER)
+    # Indexes are rebuilt from the documents, and blobs are only a shared
+    # copy of attachments that are linked into the documents, so keep them
+    # out of git
+    with open(os.path.join(path, '.gitignore'), 'wt') as fh:
+        print >>fh, "index/"
+        print >>fh, "blobs/"
 
 
-def pick_engine(col_path):
-    '''Pick an egine to use for the given path'''
+def write_doccol_version(path, version):
+    '''
+    Write (atomically) the VERSION file that makes a folder usable as a collection
+
+    :param path: Collection folder
+    :param version: Collection format version
+    '''
+    with atomic_write(os.path.join(path, 'VERSION'), 'w', fsync=True) as fh:
+        print >>fh, str(version)
+
+
+def get_engine_class(version):
+    '''
+    Get the engine class that handles a collection format version
+
+    :param version: Collection format version
+    :return: DocColEngine subclass
+    '''
+    if version == 1:
+        from .v1.DocColEngineV1 import DocColEngineV1
+        return DocColEngineV1
+
+    elif version == 2:
+        from .v2.DocColEngineV2 import DocColEngineV2
+        return DocColEngineV2
+
+    elif version == 3:
+        from .v3.DocColEngineV3 import DocColEngineV3
+        return DocColEngineV3
+
+    else:
+        raise DocCollectionOperationError("Unsupported Document Collection Version: " + str(version))
+
+
+def read_doccol_version(col_path):
+    '''
+    Read the format version of a collection
+
+    :param col_path: Collection folder
+    :return: int
+    '''
 
     # Make sure this is one of our colections
     if not os.path.exists(os.path.join(col_path, 'DOCCOL.txt')):
@@ -42,14 +116,11 @@ def pick_engine(col_path):
         raise DocCollectionOperationError("Missing version file: " + path)
     with open(path, 'rt') as fh:
         try:
-            version = int(fh.read())
+            return int(fh.read())
         except ValueError:
             raise DocCollectionOperationError("Version file appears to be corrupt: " + path)
 
-    # Pick engine
-    if version == 1:
-        from .v1.DocColEngineV1 import DocColEngineV1
-        return DocColEngineV1(col_path)
 
-    else:
-        raise DocCollectionOperationError("Unsupported Document Collection Version: " + str(version))
+def pick_engine(col_path):
+    '''Pick an egine to use for the given path'''
+    return get_engine_class(read_doccol_version(col_path))(col_path)
@@ -0,0 +1,34 @@
+'''Remove attachment data no document uses anymore'''
+import time
+
+from .v1.FileAttachmentV1 import FileAttachmentV1
+from .v1.prop_pickle import iter_stored_values
+
+
+def collect_garbage(engine):
+    '''
+    Remove chunks no attachment lists, and blobs no document links to
+
+    Every document's stored properties (including values nested in list and
+    dict values) are scanned for the chunks their attachments use, so this
+    reads the whole collection.  Chunks added since GC_GRACE_SECONDS before
+    the scan started are kept, but blobs aren't protected the same way:
+    don't run while documents are being added to a collection that dedups
+    attachments.
+
+    :param engine: DocColEngine of the collection
+    :return: dict of number removed: {'chunks': n, 'blobs': n}
+    '''
+    # Chunks added after this (while scanning) are newer than the grace cutoff
+    started = time.time()
+    referenced = set()
+    for doc_id, properties, stamp in engine.list_all_docs_with_properties(None):
+        for stored_value in properties.stored_values.values():
+            for value in iter_stored_values(stored_value, FileAttachmentV1.type_code):
+                for hash, length in value.get('chunks') or ():
+                    referenced.add(hash)
+
+    return {
+        'chunks': engine.chunk_store.collect_garbage(referenced, started),
+        'blobs': engine.blob_store.collect_garbage(),
+    }
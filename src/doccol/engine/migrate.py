@@ -0,0 +1,270 @@
+'''Copy a collection into a new collection of another format version'''
+import os
+import json
+from itertools import islice
+
+from . import pick_engine, get_engine_class, prepare_doccol_folder, write_doccol_version
+from .exceptions import DocCollectionOperationError
+from .utils.LookupFile import LookupFile
+
+from .v1.ListDataV1 import ListDataV1
+from .v1.DictDataV1 import DictDataV1
+from .v1.FileAttachmentV1 import FileAttachmentV1
+from .v1.ColStoreV1 import ColStoreV1
+
+
+CHECKPOINT_FILE_NAME = 'MIGRATE.lookup'
+MIGRATE_CHUNK_SIZE = 256
+MAX_FAILURES_REPORTED = 10
+
+
+def migrate_collection(src_path, dest_path, version, workers=4, progress=None):
+    '''
+    Copy a collection into a new collection of another format version
+
+    Documents are streamed a domain at a time from the source engine into
+    the destination engine's create_new_docs() (which copies attachments on
+    a pool of workers), MIGRATE_CHUNK_SIZE documents at a time.  After each
+    chunk the number of documents done in the domain, and the last one, are
+    recorded in MIGRATE.lookup in the destination, so calling this again
+    after a crash or failure carries on after the last finished chunk
+    (without reading the documents before it).  The source must not
+    be changed while it's being migrated.
+
+    Each attachment's hash is checked, while it's copied, against the hash
+    recorded when it was added to the source.  Documents that fail are
+    deleted from the destination and recorded in the checkpoint; they're
+    retried on the next call.
+
+    The destination's VERSION file is written (atomically) last, and only if
+    every document was copied, so until then the destination can't be
+    opened as a collection.  Indexes declared in the source are declared
+    (and built) just before.
+
+    :param src_path: Path to the collection to copy
+    :param dest_path: Path to create the new collection in (new or empty
+                      folder, or a destination left by an unfinished call)
+    :param version: Format version of the new collection
+    :param workers: Number of threads to read and copy documents with
+    :param progress: Called as progress(domain, documents done in domain) after each chunk
+    :return: Number of documents copied by this call
+    '''
+    src = pick_engine(src_path)
+    src_store = ColStoreV1(src_path, src.settings)
+    dest = _open_destination(src_path, dest_path, version)
+
+    copied = 0
+    checkpoint = LookupFile(os.path.join(dest_path, CHECKPOINT_FILE_NAME))
+    try:
+        if 'source' not in checkpoint:
+            checkpoint['source'] = os.path.abspath(src_path)
+            checkpoint['version'] = version
+            if src.settings is not None and dest.settings is not None:
+                dest.settings['dedup_attachments'] = src.settings['dedup_attachments']
+                dest.settings['compress_attachments'] = src.settings['compress_attachments']
+                dest.settings['chunk_attachments'] = src.settings['chunk_attachments']
+                dest.settings['index_durability'] = src.settings['index_durability']
+        elif checkpoint['source'] != os.path.abspath(src_path) or checkpoint['version'] != version:
+            raise DocCollectionOperationError(
+                "%s holds an unfinished migration of %s to version %s" % (
+                    dest_path, checkpoint['source'], checkpoint['version']))
+
+        # Retry documents that failed last time
+        for key in [key for key in checkpoint.keys() if key.startswith('failed:')]:
+            domain, name = json.loads(key[len('failed:'):])
+            del checkpoint[key]
+            src_doc_id = src.get_document_id(domain, name)
+            if src_doc_id is not None:
+                copied += _copy_docs(dest, src_store, domain, [
+                    (src_doc_id, src.get_document_properties(src_doc_id), None)
+                    ], checkpoint, workers, check_existing=True)
+
+        # Copy domains, picking up where the last call stopped
+        for domain in src.list_all_domains():
+            key = 'domain:' + domain
+            done = checkpoint.get(key, 0)
+            if done is True:
+                continue
+
+            # Docs in the chunk after the checkpoint may be partly copied
+            check_existing = key in checkpoint
+            checkpoint[key] = done
+
+            # Start listing after the last finished document, so finished ones
+            # aren't read again
+            after = None
+            if checkpoint.get('after:' + domain) is not None:
+                after = src.get_document_id(domain, checkpoint['after:' + domain])
+            docs = src.list_all_docs_with_properties(domain, workers, after=after)
+            if after is None:
+                for skipped in islice(docs, done):
+                    pass
+            while True:
+                chunk = list(islice(docs, MIGRATE_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    break
+                copied += _copy_docs(dest, src_store, domain, chunk, checkpoint, workers, check_existing)
+                check_existing = False
+                done += len(chunk)
+                checkpoint['after:' + domain] = chunk[-1][0].name
+                checkpoint[key] = done
+                if progress is not None:
+                    progress(domain, done)
+            checkpoint[key] = True
+
+        failed = sorted([(json.loads(key[len('failed:'):]), value)
+                         for key, value in checkpoint.items() if key.startswith('failed:')])
+        if len(failed) > 0:
+            raise DocCollectionOperationError(
+                "%d documents failed to migrate (call again to retry them):\n%s" % (
+                    len(failed), "\n".join(["%s :: %s: %s" % (domain, name, error)
+                                            for (domain, name), error in failed[:MAX_FAILURES_REPORTED]])))
+
+        _copy_indexes(src, dest)
+        write_doccol_version(dest_path, version)
+
+    finally:
+        checkpoint.close()
+
+    os.unlink(os.path.join(dest_path, CHECKPOINT_FILE_NAME))
+    return copied
+
+
+def _open_destination(src_path, dest_path, version):
+    '''
+    Create the destination collection (without VERSION), or reopen a partial one
+
+    :return: Engine for the destination
+    '''
+    if os.path.abspath(src_path) == os.path.abspath(dest_path):
+        raise DocCollectionOperationError("Can't migrate a collection onto itself: " + src_path)
+
+    if not os.path.exists(dest_path):
+        os.mkdir(dest_path)
+    if os.path.exists(os.path.join(dest_path, 'VERSION')):
+        raise DocCollectionOperationError("Migration destination is already a collection: " + dest_path)
+
+    if os.path.exists(os.path.join(dest_path, 'DOCCOL.txt')):
+        if not os.path.exists(os.path.join(dest_path, CHECKPOINT_FILE_NAME)):
+            raise DocCollectionOperationError("Not an unfinished migration: " + dest_path)
+    elif len(os.listdir(dest_path)) > 0:
+        raise DocCollectionOperationError("Migration destination isn't empty: " + dest_path)
+    else:
+        prepare_doccol_folder(dest_path, version)
+
+    return get_engine_class(version)(dest_path)
+
+
+def _copy_docs(dest, src_store, domain, docs, checkpoint, workers, check_existing=False):
+    '''
+    Create documents in the destination with the source documents' properties
+
+    :param dest: Destination engine
+    :param src_store: ColStoreV1 of the source
+    :param domain: Name of the domain
+    :param docs: list of (document id, LazyPropertiesV1, stamp) from the source
+    :param checkpoint: LookupFile to record failures in
+    :param check_existing: Replace documents already in the destination
+    :return: Number of documents copied
+    '''
+    def _record_failure(name, error):
+        checkpoint['failed:' + json.dumps([domain, name])] = str(error)
+
+    items = list()
+    attachments = dict()        # [name] = list of (FileAttachmentV1, stored value in source)
+    for doc_id, properties, stamp in docs:
+        name = doc_id.doc_name
+        if check_existing:
+            existing = dest.get_document_id(domain, name)
+            if existing is not None:
+                dest.del_document(existing)
+
+        attachments[name] = list()
+        try:
+            values = dict()
+            for prop_name, stored_value in properties.stored_values.items():
+                values[prop_name] = _make_migrate_value(stored_value, attachments[name], src_store)
+        except DocCollectionOperationError, e:
+            _record_failure(name, e)
+            continue
+        items.append((name, values))
+
+    copied = 0
+    for name, doc_id, error in dest.create_new_docs(domain, items, workers):
+        if error is None:
+            error = _verify_attachments(attachments[name])
+            if error is not None:
+                dest.del_document(doc_id)
+        if error is None:
+            copied += 1
+        else:
+            _record_failure(name, error)
+    return copied
+
+
+def _make_migrate_value(stored_value, attachments, col_store):
+    '''
+    Turn a value stored in the source into a value to set in the destination
+
+    :param stored_value: Value created by encode_prop_value_for_disk()
+    :param attachments: list to add (FileAttachmentV1, stored value) to for
+                        each attachment found
+    :param col_store: ColStoreV1 of the source (to read chunked attachments)
+    :return: Property value
+    '''
+    value_type = stored_value['value_type']
+    value = stored_value['value']
+
+    if value_type == 'python':
+        return value
+
+    if value_type == 'list':
+        return ListDataV1([_make_migrate_value(item, attachments, col_store) for item in value])
+
+    if value_type == 'dict':
+        values = DictDataV1()
+        for key, item in value.items():
+            values[key] = _make_migrate_value(item, attachments, col_store)
+        return values
+
+    if value_type == FileAttachmentV1.type_code:
+        # Read through the source attachment, so compressed and chunked files
+        # copy their original bytes
+        source = FileAttachmentV1().decode_retrieved_value(value, None, None, None, col_store)
+        attachment = FileAttachmentV1(
+            attach = source,
+            filename = value['filename'],
+            sha256 = value.get('sha256') is not None,
+            compress = value.get('compression') or False,
+            chunked = value.get('chunks') is not None)
+        attachments.append((attachment, value))
+        return attachment
+
+    raise DocCollectionOperationError("Can't migrate values of type '%s'" % (value_type))
+
+
+def _verify_attachments(attachments):
+    '''
+    Check copied attachments have the hashes recorded in the source
+
+    :param attachments: list of (FileAttachmentV1, stored value in source)
+    :return: Exception describing the first mismatch, or None
+    '''
+    for attachment, value in attachments:
+        for name, copied_hash in (('hash', attachment.hash), ('sha256', attachment.sha256)):
+            if value.get(name) is not None and value[name] != copied_hash:
+                return DocCollectionOperationError(
+                    "Attachment %s doesn't match its recorded %s (changed or corrupt)" % (
+                        value.get('path') or value['filename'], name))
+    return None
+
+
+def _copy_indexes(src, dest):
+    '''Declare (and build) the source's property and text indexes in the destination'''
+    if src.settings is None:
+        return
+    for prop_name, kind in sorted((src.settings['indexes'] or dict()).items()):
+        dest.declare_index(prop_name, kind)
+    text_index = src.settings['text_index']
+    if text_index is not None:
+        dest.declare_text_index(text_index['props'], text_index['attachments'])
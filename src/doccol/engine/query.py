@@ -0,0 +1,134 @@
+'''Predicates for finding documents by property value'''
+
+NUMBER_TYPES = (int, long, float)
+
+
+def _comparable(a, b):
+    '''Can these values be ordered against each other meaningfully?'''
+    if isinstance(a, bool) or isinstance(b, bool):
+        return False
+    if isinstance(a, NUMBER_TYPES) and isinstance(b, NUMBER_TYPES):
+        return True
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return True
+    return False
+
+
+def calc_sort_key(value):
+    '''
+    Key to order property values by
+
+    Numbers sort before strings (ISO dates sort correctly as strings).
+
+    :param value: Stored property value
+    :return: tuple, or None if the value can't be ordered
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, NUMBER_TYPES):
+        return (0, value)
+    if isinstance(value, basestring):
+        return (1, value)
+    return None
+
+
+class Predicate(object):
+    '''Test applied to the stored (python typed) value of a property'''
+
+    def matches(self, value):
+        '''
+        :param value: Stored property value
+        :return: True if the value passes
+        '''
+        raise NotImplementedError()
+
+
+class Eq(Predicate):
+    '''Property equals value'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def matches(self, value):
+        return value == self.value
+
+    def __repr__(self):
+        return "Eq(%r)" % (self.value, )
+
+
+class In(Predicate):
+    '''Property equals one of the values'''
+
+    def __init__(self, values):
+        self.values = list(values)
+
+    def matches(self, value):
+        return value in self.values
+
+    def __repr__(self):
+        return "In(%r)" % (self.values, )
+
+
+class Prefix(Predicate):
+    '''Property is a string starting with prefix'''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def matches(self, value):
+        return isinstance(value, basestring) and value.startswith(self.prefix)
+
+    def __repr__(self):
+        return "Prefix(%r)" % (self.prefix, )
+
+
+class Range(Predicate):
+    '''
+    Property is between low and high
+
+    Only numbers are compared to numbers and strings to strings (ISO dates
+    compare correctly as strings).
+    '''
+
+    def __init__(self, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        '''
+        :param low: Lowest value allowed (None for no limit)
+        :param high: Highest value allowed (None for no limit)
+        :param low_inclusive: Is low itself allowed?
+        :param high_inclusive: Is high itself allowed?
+        '''
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.high_inclusive = high_inclusive
+
+    def matches(self, value):
+        if self.low is not None:
+            if not _comparable(value, self.low):
+                return False
+            if value < self.low or (value == self.low and not self.low_inclusive):
+                return False
+        if self.high is not None:
+            if not _comparable(value, self.high):
+                return False
+            if value > self.high or (value == self.high and not self.high_inclusive):
+                return False
+        return True
+
+    def __repr__(self):
+        return "Range(%r, %r)" % (self.low, self.high)
+
+
+def compile_where(where):
+    '''
+    Normalize a where clause
+
+    :param where: Dictionary of [property_name] = Predicate, or a plain value for Eq
+    :return: list of (property_name, Predicate)
+    '''
+    compiled = list()
+    for prop_name, test in (where or dict()).items():
+        if not isinstance(test, Predicate):
+            test = Eq(test)
+        compiled.append((prop_name, test))
+    return compiled
@@ -1,43 +1,115 @@
+import threading
+from collections import OrderedDict
 
 class Cache(object):
-    '''Basic in-memory caching implementation'''
+    '''
+    Basic in-memory LRU caching implementation
 
-    def __init__(self, max_size, close_cb=None):
+    Safe to use from several threads.
+    '''
+
+    def __init__(self, max_size, close_cb=None, weigher=None):
+        '''
+        :param max_size: Max number of entries (or max total weight if weigher given)
+        :param close_cb: Called as close_cb(key, value) when an entry is evicted
+        :param weigher: Called as weigher(value) to get the approx size of an entry
+        '''
         self.__max_size = max_size
         self.__close_cb = close_cb
-        self.__entries = dict()
-        self.__entry_order = list()
+        self.__weigher = weigher
+        self.__entries = OrderedDict()  # [key] = (value, weight), oldest first
+        self.__total_weight = 0
+        self.__lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def _weigh(self, value):
+        if self.__weigher is None:
+            return 1
+        return self.__weigher(value)
 
 
     def add(self, key, value):
+        with self.__lock:
 
-        # Clean out cache
-        while len(self.__entry_order) > self.__max_size - 1:
-            self.remove_oldest()
+            # Remove key if exists
+            if self.has(key):
+                self.remove(key)
 
-        # Remove key if exists
-        if self.has(key):
-            self.remove(key)
+            # Add entry
+            weight = self._weigh(value)
+            self.__entries[key] = (value, weight)
+            self.__total_weight += weight
 
-        # Add entry
-        self.__entry_order.append(key)
-        self.__entries[key] = value
+            # Clean out cache (always keeping the entry just added)
+            while self.__total_weight > self.__max_size and len(self.__entries) > 1:
+                self.remove_oldest()
 
 
     def has(self, key):
-        return self.__entries.has_key(key)
+        return key in self.__entries
 
 
     def get(self, key):
-        return self.__entries[key]
+        '''
+        Get a value from the cache, marking it as most recently used
+
+        Values may change size while cached, so they are re-weighed here.
+        '''
+        with self.__lock:
+            try:
+                value, weight = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+
+            new_weight = self._weigh(value)
+            self.__entries[key] = (value, new_weight)
+            self.__total_weight += new_weight - weight
+            return value
 
 
     def remove(self, key):
-        if self.has(key):
-            del self.__entries[key]
-            self.__entry_order.remove(key)
+        with self.__lock:
+            if self.has(key):
+                value, weight = self.__entries.pop(key)
+                self.__total_weight -= weight
 
 
     def remove_oldest(self):
-        if len(self.__entry_order) > 0:
-            del self.__entries[self.__entry_order.pop(0)]
+        with self.__lock:
+            if len(self.__entries) > 0:
+                key, (value, weight) = self.__entries.popitem(last=False)
+                self.__total_weight -= weight
+                self.evictions += 1
+                if self.__close_cb is not None:
+                    self.__close_cb(key, value)
+
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+    @property
+    def total_weight(self):
+        return self.__total_weight
+
+
+    def stats(self):
+        '''
+        Counters for tuning the cache size
+
+        :return: dict
+        '''
+        return {
+            'entries': len(self.__entries),
+            'weight': self.__total_weight,
+            'max_size': self.__max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,242 @@
+import io
+import os
+import bz2
+import zlib
+import struct
+
+
+class CompressedFileError(Exception): pass
+
+
+# Compressed file layout:
+#
+#   header      MAGIC, method code, chunk size          (HEADER_FORMAT)
+#   chunks      Each chunk_size bytes of the original, compressed separately
+#   seek table  Compressed length of each chunk         (TABLE_ENTRY_FORMAT each)
+#   trailer     Original size, seek table offset,
+#               number of chunks, MAGIC                 (TRAILER_FORMAT)
+#
+# Since chunks are compressed separately, a reader can seek to any position
+# by decompressing only the chunk it falls in.
+
+MAGIC = 'DCZ1'
+HEADER_FORMAT = '>4scI'
+TABLE_ENTRY_FORMAT = '>I'
+TRAILER_FORMAT = '>QQI4s'
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# [method] = (code in header, compress, decompress)
+# (lzma isn't in the Python 2 standard library)
+METHODS = {
+    'zlib': ('z', lambda data: zlib.compress(data, 6), zlib.decompress),
+    'bz2':  ('b', lambda data: bz2.compress(data, 9), bz2.decompress),
+}
+
+
+def check_method(method):
+    '''Raise CompressedFileError if method isn't a supported compression method'''
+    if method not in METHODS:
+        raise CompressedFileError("Unsupported compression method: %s (use one of %s)" % (
+            method, ', '.join(sorted(METHODS.keys()))))
+
+
+class CompressedFileWriter(object):
+    '''
+    Compresses data written to it into an open file, a chunk at a time
+
+    Call finish() after the last write to add the seek table.
+    '''
+
+    def __init__(self, fh, method, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        :param fh: File to write to (opened 'wb', at the start)
+        :param method: Compression method (key of METHODS)
+        :param chunk_size: Bytes of the original to compress together
+        '''
+        check_method(method)
+        self.__fh = fh
+        self.__code, self.__compress, decompress = METHODS[method]
+        self.__chunk_size = chunk_size
+        self.__pending = list()         # Data not compressed yet
+        self.__pending_size = 0
+        self.__chunk_lengths = list()   # Compressed length of each chunk
+        self.size = 0                   # Bytes written to the writer
+        self.stored_size = 0            # Bytes written to the file
+
+        self._write_raw(struct.pack(HEADER_FORMAT, MAGIC, self.__code, chunk_size))
+
+
+    def _write_raw(self, data):
+        self.__fh.write(data)
+        self.stored_size += len(data)
+
+
+    def write(self, data):
+        self.__pending.append(data)
+        self.__pending_size += len(data)
+        self.size += len(data)
+        if self.__pending_size >= self.__chunk_size:
+            data = ''.join(self.__pending)
+            pos = 0
+            while len(data) - pos >= self.__chunk_size:
+                self._write_chunk(data[pos:pos+self.__chunk_size])
+                pos += self.__chunk_size
+            self.__pending = [data[pos:]]
+            self.__pending_size = len(data) - pos
+
+
+    def _write_chunk(self, data):
+        compressed = self.__compress(data)
+        self.__chunk_lengths.append(len(compressed))
+        self._write_raw(compressed)
+
+
+    def finish(self):
+        '''Compress what's left and write the seek table (fh is left open)'''
+        if self.__pending_size > 0:
+            self._write_chunk(''.join(self.__pending))
+            self.__pending = list()
+            self.__pending_size = 0
+
+        table_offset = self.stored_size
+        self._write_raw(''.join([struct.pack(TABLE_ENTRY_FORMAT, length)
+                                 for length in self.__chunk_lengths]))
+        self._write_raw(struct.pack(TRAILER_FORMAT, self.size, table_offset,
+                                    len(self.__chunk_lengths), MAGIC))
+
+
+class CompressedFileReader(io.RawIOBase):
+    '''
+    Read-only, seekable file object over a file written by CompressedFileWriter
+
+    Data is decompressed a chunk at a time as it's read.  Seeking only
+    decompresses the chunk the new position falls in.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: Path to the compressed file
+        '''
+        super(CompressedFileReader, self).__init__()
+        self.name = path
+        self.__fh = open(path, 'rb')
+        try:
+            self._read_layout()
+        except:
+            self.__fh.close()
+            raise
+
+        self.__pos = 0
+        self.__chunk_i = None           # Index of the chunk in __chunk_data
+        self.__chunk_data = None
+
+
+    def _read_layout(self):
+        header = self.__fh.read(struct.calcsize(HEADER_FORMAT))
+        trailer_size = struct.calcsize(TRAILER_FORMAT)
+        file_size = os.fstat(self.__fh.fileno()).st_size
+        if len(header) < struct.calcsize(HEADER_FORMAT) or file_size < len(header) + trailer_size:
+            raise CompressedFileError("Not a compressed file (or truncated): " + self.name)
+
+        magic, code, self.__chunk_size = struct.unpack(HEADER_FORMAT, header)
+        self.__fh.seek(file_size - trailer_size)
+        self.__size, table_offset, chunk_count, trailer_magic = struct.unpack(
+            TRAILER_FORMAT, self.__fh.read(trailer_size))
+        if magic != MAGIC or trailer_magic != MAGIC:
+            raise CompressedFileError("Not a compressed file (or truncated): " + self.name)
+
+        self.__decompress = None
+        for method, (method_code, compress, decompress) in METHODS.items():
+            if method_code == code:
+                self.method = method
+                self.__decompress = decompress
+        if self.__decompress is None:
+            raise CompressedFileError("Unknown compression in %s: %r" % (self.name, code))
+
+        # Start of each chunk in the file
+        entry_size = struct.calcsize(TABLE_ENTRY_FORMAT)
+        self.__fh.seek(table_offset)
+        table = self.__fh.read(chunk_count * entry_size)
+        if len(table) != chunk_count * entry_size:
+            raise CompressedFileError("Corrupt seek table in " + self.name)
+        self.__chunk_offsets = list()
+        offset = struct.calcsize(HEADER_FORMAT)
+        for i in range(chunk_count):
+            self.__chunk_offsets.append(offset)
+            offset += struct.unpack(TABLE_ENTRY_FORMAT, table[i*entry_size:(i+1)*entry_size])[0]
+        self.__chunk_offsets.append(offset)
+
+
+    @property
+    def size(self):
+        '''Size of the original (uncompressed) data'''
+        return self.__size
+
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+
+    def _get_chunk(self, i):
+        if self.__chunk_i != i:
+            self.__fh.seek(self.__chunk_offsets[i])
+            compressed = self.__fh.read(self.__chunk_offsets[i+1] - self.__chunk_offsets[i])
+            try:
+                self.__chunk_data = self.__decompress(compressed)
+            except (zlib.error, IOError, EOFError, ValueError), e:
+                raise CompressedFileError("Corrupt chunk %d in %s: %s" % (i, self.name, str(e)))
+            self.__chunk_i = i
+        return self.__chunk_data
+
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = self.__size - self.__pos
+        parts = list()
+        while size > 0 and self.__pos < self.__size:
+            i, chunk_pos = divmod(self.__pos, self.__chunk_size)
+            data = self._get_chunk(i)[chunk_pos:chunk_pos+size]
+            if not data:
+                raise CompressedFileError("Chunk %d in %s is shorter than expected" % (i, self.name))
+            parts.append(data)
+            self.__pos += len(data)
+            size -= len(data)
+        return ''.join(parts)
+
+
+    def readall(self):
+        return self.read()
+
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__pos
+        elif whence == 2:
+            offset += self.__size
+        if offset < 0:
+            raise IOError("Invalid seek position: %d" % (offset))
+        self.__pos = offset
+        return self.__pos
+
+
+    def tell(self):
+        return self.__pos
+
+
+    def close(self):
+        if not self.closed:
+            self.__fh.close()
+            self.__chunk_data = None
+        super(CompressedFileReader, self).close()
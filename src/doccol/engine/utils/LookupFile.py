@@ -1,17 +1,54 @@
 import os
 import json
+import time
+import threading
 
 from collections import MutableMapping
 
+from .atomic_write import atomic_write
+
 class LookupFileError(Exception): pass
 
+class LookupFileTruncatedError(LookupFileError):
+    '''The last segment in the file is incomplete (crash while appending)'''
+    def __init__(self, path, offset):
+        self.path = path
+        self.offset = offset    # Length of the file that can be kept
+        super(LookupFileTruncatedError, self).__init__(
+            "Truncated segment at end of %s @%d" % (path, offset+1))
+
 class LookupFile(MutableMapping):
     '''A lookup table that gets saved to disk'''
 
-    def __init__(self, path):
+    # Durability options
+    DURABILITY_OS = 'os'            # Flush every write to the OS (it writes to disk when it wants)
+    DURABILITY_FSYNC = 'fsync'      # fsync every write
+    DURABILITY_GROUP = 'group'      # fsync at most every group_commit_ms (writes in between share it)
+
+    COMPACT_MIN_ENTRIES = 64
+
+    def __init__(self, path, durability=DURABILITY_OS, group_commit_ms=50, compact_ratio=2.0):
+        '''
+        :param path: Path to the file to save the lookup in
+        :param durability: One of the DURABILITY_ options
+        :param group_commit_ms: Max time a write waits to be fsync'd for DURABILITY_GROUP
+        :param compact_ratio: Flatten the file automatically once the number of
+            set/del entries appended is more than this times the number of keys
+            (None to only flatten when save() is called)
+        '''
+        if durability not in (self.DURABILITY_OS, self.DURABILITY_FSYNC, self.DURABILITY_GROUP):
+            raise LookupFileError("Unknown durability option: " + str(durability))
+
         self.__path = path
         self.__fh = None
         self.__values = dict()
+        self.__durability = durability
+        self.__group_commit_secs = group_commit_ms / 1000.0
+        self.__compact_ratio = compact_ratio
+        self.__log_entries = 0          # set/del segments since the file was last flattened
+        self.__lock = threading.RLock()
+        self.__last_sync = 0
+        self.__sync_timer = None
 
         # Load lookups
         if os.path.exists(self.__path):
@@ -23,23 +60,118 @@ class LookupFile(MutableMapping):
         else:
             self.__fh = open(self.__path, 'w')
 
+        self._compact_if_needed()
+
 
     def _load(self, path):
         self.__values = dict()
-        for segment in self._read_segments(path):
-            if segment['entry'] == 'list':
-                self.__values.update(segment['values'])
-            elif segment['entry'] == 'set':
-                self.__values[segment['key']] = segment['value']
-            elif segment['entry'] == 'del':
-                del self.__values[segment['key']]
+        self.__log_entries = 0
+        try:
+            for segment in self._read_segments(path):
+                if segment['entry'] != 'list':
+                    self.__log_entries += 1
+
+                if segment['entry'] == 'list':
+                    self.__values.update(segment['values'])
+                elif segment['entry'] == 'set':
+                    self.__values[segment['key']] = segment['value']
+                elif segment['entry'] == 'del':
+                    self.__values.pop(segment['key'], None)
+
+        # Recover from a partial append by dropping the incomplete segment
+        except LookupFileTruncatedError, e:
+            print "WARNING: %s (discarding)" % (str(e))
+            with open(path, 'r+b') as fh:
+                fh.truncate(e.offset)
 
 
     def save(self):
-        '''Will re-save the output file (flattening it as well)'''
-        self.__fh.close()
-        self.__fh = open(self.__path, 'w')
-        self.__fh.write(self._build_segment({'entry': 'list', 'values': self.__values}))
+        '''
+        Will re-save the output file (flattening it as well)
+
+        The flattened file is written to a temp name and renamed over the log,
+        so a crash leaves either the old log or the new file.
+        '''
+        with self.__lock:
+            self._cancel_sync_timer()
+            self.__fh.close()
+            with atomic_write(self.__path, fsync=self.__durability != self.DURABILITY_OS) as fh:
+                fh.write(self._build_segment({'entry': 'list', 'values': self.__values}))
+            self.__fh = open(self.__path, 'a')
+            self.__log_entries = 0
+
+
+    def _compact_if_needed(self):
+        '''Flatten the file if it has gathered too many superseded entries'''
+        if self.__compact_ratio is None:
+            return
+        if self.__log_entries < self.COMPACT_MIN_ENTRIES:
+            return
+        if self.__log_entries > self.__compact_ratio * len(self.__values):
+            self.save()
+
+
+    def replace_all(self, values):
+        '''
+        Replace every key in the lookup with the given values (and flatten file)
+
+        :param values: Dictionary of new lookup values
+        '''
+        self.__values = dict(values)
+        self.save()
+
+
+    def close(self):
+        '''Release the file handle used to append updates'''
+        with self.__lock:
+            if self.__fh is not None:
+                self._cancel_sync_timer()
+                self.__fh.flush()
+                if self.__durability != self.DURABILITY_OS:
+                    os.fsync(self.__fh.fileno())
+                self.__fh.close()
+                self.__fh = None
+
+
+    # -- Durability ----------------------------------------------------------
+
+    def _append(self, segment_content):
+        '''
+        Append a segment to the file (syncing as durability calls for)
+
+        :param segment_content: Content of the segment
+        '''
+        with self.__lock:
+            self.__fh.write(self._build_segment(segment_content))
+            self.__fh.flush()
+            self.__log_entries += 1
+
+            if self.__durability == self.DURABILITY_FSYNC:
+                os.fsync(self.__fh.fileno())
+
+            elif self.__durability == self.DURABILITY_GROUP:
+                wait = self.__last_sync + self.__group_commit_secs - time.time()
+                if wait <= 0:
+                    self._sync()
+                elif self.__sync_timer is None:
+                    self.__sync_timer = threading.Timer(wait, self._sync)
+                    self.__sync_timer.daemon = True
+                    self.__sync_timer.start()
+
+
+    def _sync(self):
+        '''fsync everything appended so far (called by the group commit timer)'''
+        with self.__lock:
+            self.__sync_timer = None
+            if self.__fh is not None:
+                os.fsync(self.__fh.fileno())
+            self.__last_sync = time.time()
+
+
+    def _cancel_sync_timer(self):
+        if self.__sync_timer is not None:
+            self.__sync_timer.cancel()
+            self.__sync_timer = None
 
 
     # -- Dictionary Interfaces -----------------------------------------------
@@ -49,19 +181,31 @@ class LookupFile(MutableMapping):
 
 
     def __setitem__(self, key, value):
-        self.__fh.write(self._build_segment(self.ADD_ENTRY, {'entry': 'set', 'key': key, 'value': value}))
+        self._append({'entry': 'set', 'key': key, 'value': value})
         self.__values[key] = value
+        self._compact_if_needed()
 
 
     def __delitem__(self, key):
-        self.__fh.write(self._build_segment(self.DEL_ENTRY, {'entry': 'del', 'key': key}))
+        if key not in self.__values:
+            raise KeyError(key)
+        self._append({'entry': 'del', 'key': key})
         del self.__values[key]
+        self._compact_if_needed()
 
 
     def __contains__(self, key):
         return key in self.__values
 
 
+    def __iter__(self):
+        return iter(self.__values)
+
+
+    def __len__(self):
+        return len(self.__values)
+
+
     def keys(self):
         return self.__values.keys()
 
@@ -92,45 +236,50 @@ class LookupFile(MutableMapping):
         '''
         Get segment_content back out from string created by content()
 
+        Segments are read from the file one at a time, so only one segment
+        needs to be in memory at once.
+
         :param path: File to read segments out of
         :return: generator for structured data
+        :raises LookupFileTruncatedError: (after good segments) if the last
+            segment is incomplete.  The file up to e.offset can be kept.
         '''
         try:
-            with open(path, 'r') as fh:
-                content = fh.read()
+            fh = open(path, 'rb')
         except Exception, e:
             raise LookupFileError("Failed to read lookup file: %s" % (path))
 
-        if len(content) < 4:
-            raise LookupFileError("File too short %s" % (path))
-
-        segment_start = 0
-        while segment_start < len(content):
-
-            # First char should be \n
-            if content[segment_start] != '\n':
-                raise LookupFileError(
-                    "Structure error on %s: segment @%d needs to start with newline" % (path, segment_start+1))
-
-            # Get digits that represent length of segment
-            next_newline = content.find("\n", segment_start+1)
-            if next_newline == -1:
-                raise LookupFileError(
-                    "Structure error on %s: Couldn't find newline after segment length @%d" % (path, segment_start+1))
-            seg_len_str = content[segment_start+1, next_newline]
-            try:
-                seg_len = int(seg_len_str)
-            except ValueError:
-                raise LookupFileError(
-                    "Structure error on %s: Segment length not an in @%d: %s" % (path, segment_start+1, seg_len_str))
-
-            # Get segment contents
-            segment_json = content[next_newline+1, next_newline+1+seg_len]
-            try:
-                yield json.loads(segment_json)
-            except Exception, e:
-                 raise LookupFileError(
-                    "Structure error on %s: JSON decode error on @%d" % (path, next_newline+1))
-
-            # Get ready for next segment
-            segment_start = next_newline+1+seg_len
\ No newline at end of file
+        with fh:
+            while True:
+                segment_start = fh.tell()
+
+                # First char should be \n
+                first_char = fh.read(1)
+                if first_char == '':
+                    return
+                if first_char != '\n':
+                    raise LookupFileError(
+                        "Structure error on %s: segment @%d needs to start with newline" % (path, segment_start+1))
+
+                # Get digits that represent length of segment
+                seg_len_str = fh.readline()
+                if not seg_len_str.endswith('\n'):
+                    raise LookupFileTruncatedError(path, segment_start)
+                try:
+                    seg_len = int(seg_len_str)
+                except ValueError:
+                    raise LookupFileError(
+                        "Structure error on %s: Segment length not an in @%d: %s" % (path, segment_start+2, seg_len_str))
+
+                # Get segment contents
+                json_start = fh.tell()
+                segment_json = fh.read(seg_len)
+                if len(segment_json) < seg_len:
+                    raise LookupFileTruncatedError(path, segment_start)
+                try:
+                    segment = json.loads(segment_json)
+                except Exception, e:
+                    raise LookupFileError(
+                        "Structure error on %s: JSON decode error on @%d" % (path, json_start+1))
+
+                yield segment
@@ -1,26 +1,127 @@
 import os
 import json
+from collections import OrderedDict
+
+from .atomic_write import atomic_write
+
+
+class PropertyFileBatch(object):
+    '''
+    Collects PropertyFiles changed while a batch is open so each is saved once
+
+    Files join the batch by having their batch attribute set.  Changes made to
+    them are kept in memory (marked dirty) until commit() is called.
+    '''
+
+    def __init__(self):
+        self.__dirty = OrderedDict()    # [id(prop_file)] = PropertyFile
+        self.active = True
+
+
+    def mark_dirty(self, prop_file):
+        self.__dirty[id(prop_file)] = prop_file
+
+
+    def flush(self):
+        '''Save every dirty file'''
+        while len(self.__dirty) > 0:
+            key, prop_file = self.__dirty.popitem(last=False)
+            prop_file.flush()
+
+
+    def commit(self):
+        '''Save every dirty file and end the batch'''
+        self.active = False
+        self.flush()
 
 
 class PropertyFile(object):
     '''General purpose preoprty storage file'''
 
-    def __init__(self, path):
+    FILE_MODE = ''      # 'b' for binary subclasses
+
+    def __init__(self, path, batch=None):
+        '''
+        :param path: Path to the file to store properties in
+        :param batch: PropertyFileBatch to defer saves to (if active)
+        '''
         self.__path = path
         self.__property_defs = dict()
         self.__property_values = dict()
+        self.__size = 0
+        self.__dirty = False
+        self.batch = batch
+        self.memo = dict()          # Values derived from the properties (reset on change)
+
+        if os.path.exists(self.__path):
+            self.reload()
+
 
+    def reload(self):
+        '''Re-read the file (it was changed by something else), dropping unsaved changes'''
+        values = dict()
+        size = 0
         if os.path.exists(self.__path):
-            with open(self.__path, 'r') as fh:
-                self.__property_values = json.load(fh)
+            with open(self.__path, 'r' + self.FILE_MODE) as fh:
+                values = self._read_values(fh)
+                size = fh.tell()
+        self.__property_values = values
+        self.__size = size
+        self.__dirty = False
+        self.memo = dict()
+
+
+    @property
+    def approx_size(self):
+        '''Approximate size of the properties (bytes on disk when last loaded/saved)'''
+        return self.__size
+
+
+    @property
+    def dirty(self):
+        '''Has a change been made that hasn't been saved yet?'''
+        return self.__dirty
+
+
+    def _read_values(self, fh):
+        '''Parse the file contents'''
+        return json.load(fh)
+
+
+    def _write_values(self, values, fh):
+        '''Serialize values to the file'''
+        json.dump(values, fh, indent=4)
 
 
     def save(self):
         try:
-            with open(self.__path, 'w') as fh:
-                json.dump(self.__property_values, fh, indent=4)
+            with atomic_write(self.__path, 'w' + self.FILE_MODE) as fh:
+                self._write_values(self.__property_values, fh)
+                self.__size = fh.tell()
         except Exception, e:
             raise Exception("Failed to save properties to %s:\n%s" % (self.__path, str(e)))
+        self.__dirty = False
+
+
+    def flush(self):
+        '''Save if there are deferred changes'''
+        if self.__dirty:
+            self.save()
+
+
+    def discard_changes(self):
+        '''Forget deferred changes (file is being deleted)'''
+        self.__dirty = False
+
+
+    def _changed(self):
+        '''Save now, or defer to the batch if one is open'''
+        self.memo = dict()
+        if self.batch is not None and self.batch.active:
+            self.__dirty = True
+            self.batch.mark_dirty(self)
+        else:
+            self.save()
 
 
     def def_property(self, name, default=None, value=None):
@@ -44,7 +145,7 @@ class PropertyFile(object):
         if not self.__property_defs.has_key(name):
             raise AttributeError("Not a defined property: " + name)
         self.__property_values[name] = value
-        self.save()
+        self._changed()
 
 
     def update(self, values):
@@ -52,4 +153,4 @@ class PropertyFile(object):
             if not self.__property_defs.has_key(name):
                 raise AttributeError("Not a defined property: " + name)
             self.__property_values[name] = value
-        self.save()
+        self._changed()
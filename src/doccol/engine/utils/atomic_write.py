@@ -0,0 +1,58 @@
+import os
+import thread
+from contextlib import contextmanager
+
+
+def replace_file(src, dst):
+    '''
+    Move a file over another (atomic where the OS supports it)
+
+    :param src: Path to the new file
+    :param dst: Path to replace
+    '''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows won't rename over an existing file
+        if os.name != 'nt' or not os.path.exists(dst):
+            raise
+        os.unlink(dst)
+        os.rename(src, dst)
+
+
+def calc_temp_path(path):
+    '''
+    Temporary file name to write next to path before renaming into place
+
+    :param path: Path that will be written
+    :return: str path (distinct per process and thread)
+    '''
+    return '%s.%d.%d.tmp' % (path, os.getpid(), thread.get_ident())
+
+
+@contextmanager
+def atomic_write(path, mode='w', fsync=False):
+    '''
+    Write a file to a temporary name and rename it into place when done
+
+    Readers see either the old or the new contents, never a partial file.
+
+    :param path: Path to write
+    :param mode: File mode to open with ('w' or 'wb')
+    :param fsync: If True, flush to disk before renaming
+    :return: File handle (via with)
+    '''
+    tmp_path = calc_temp_path(path)
+    fh = open(tmp_path, mode)
+    try:
+        yield fh
+        fh.flush()
+        if fsync:
+            os.fsync(fh.fileno())
+        fh.close()
+        replace_file(tmp_path, path)
+    except:
+        fh.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
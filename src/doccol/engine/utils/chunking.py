@@ -0,0 +1,76 @@
+'''Split files into content-defined chunks, so edits only change nearby chunks'''
+import struct
+import hashlib
+
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+BOUNDARY_BITS = 16                  # Cut on average every 2**16 bytes past MIN_CHUNK_SIZE
+READ_SIZE = 1024 * 1024
+
+# Gear hash: each byte shifts the hash left and adds a random value for the
+# byte, so the top bits depend only on the last 32 bytes (a rolling window
+# for free).  Derived from md5 so boundaries never change between versions.
+GEAR = tuple([struct.unpack('>I', hashlib.md5('doccol gear %d' % (i)).digest()[:4])[0]
+              for i in range(256)])
+HASH_MASK = 0xFFFFFFFF
+WINDOW_SIZE = 32
+
+
+def find_chunk_boundary(data, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE,
+                        boundary_bits=BOUNDARY_BITS):
+    '''
+    Find where the first chunk in data ends
+
+    The boundary is the first position past min_size where the top
+    boundary_bits of the rolling hash are all zero, so it depends only on
+    the bytes just before it: inserting or removing bytes earlier in a file
+    moves the boundaries after it along with the content.
+
+    :param data: str of bytes
+    :return: Length of the first chunk (len(data) if no boundary is found)
+    '''
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+
+    mask = (HASH_MASK << (32 - boundary_bits)) & HASH_MASK
+    gear = GEAR
+    h = 0
+
+    # Prime the hash with the window before min_size
+    start = max(0, min_size - WINDOW_SIZE)
+    for byte in bytearray(data[start:min_size]):
+        h = ((h << 1) + gear[byte]) & HASH_MASK
+
+    pos = min_size
+    for byte in bytearray(data[min_size:end]):
+        h = ((h << 1) + gear[byte]) & HASH_MASK
+        pos += 1
+        if not h & mask:
+            return pos
+    return end
+
+
+def iter_chunks(fh, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, boundary_bits=BOUNDARY_BITS):
+    '''
+    Read a file as content-defined chunks
+
+    :param fh: File-like object to read
+    :return: Generator of str (each chunk, in order)
+    '''
+    buf = ''
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = fh.read(READ_SIZE)
+            if data:
+                buf += data
+            else:
+                eof = True
+        if not buf:
+            return
+
+        cut = find_chunk_boundary(buf, min_size, max_size, boundary_bits)
+        yield buf[:cut]
+        buf = buf[cut:]
@@ -0,0 +1,123 @@
+'''Copy file data without passing it through Python buffers where the OS allows'''
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # Windows
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile       # pysendfile
+    except ImportError:
+        sendfile = None
+
+
+FICLONE = 0x40049409                # Linux ioctl: share the extents of another file (reflink)
+SENDFILE_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Errors meaning "not supported here", so fall back to the next method
+UNSUPPORTED_ERRNOS = set([getattr(errno, name) for name in (
+    'EINVAL', 'ENOSYS', 'ENOTTY', 'EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF')
+    if hasattr(errno, name)])
+
+
+def _reflink(in_fh, out_fh):
+    '''
+    Make out_fh share in_fh's data blocks (Btrfs, XFS, ...)
+
+    :return: True if done
+    '''
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(out_fh.fileno(), FICLONE, in_fh.fileno())
+    except (IOError, OSError), e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def send_file_data(in_fh, out_fh, offset=0, length=None):
+    '''
+    Write part of a file to another file or a socket
+
+    Uses sendfile() (data goes from the page cache straight to the output
+    in the kernel) when available, else a read/write loop.
+
+    :param in_fh: File to read (opened 'rb')
+    :param out_fh: File or socket to write to (anything with fileno())
+    :param offset: Position in in_fh to start at
+    :param length: Number of bytes to send (None for the rest of the file)
+    :return: Number of bytes sent
+    '''
+    if length is None:
+        length = max(0, os.fstat(in_fh.fileno()).st_size - offset)
+
+    sent = 0
+    if sendfile is not None:
+        if hasattr(out_fh, 'flush'):
+            out_fh.flush()
+        try:
+            while sent < length:
+                count = sendfile(out_fh.fileno(), in_fh.fileno(), offset + sent,
+                                 min(length - sent, SENDFILE_CHUNK_SIZE))
+                if count == 0:
+                    break       # File is shorter than expected
+                sent += count
+            return sent
+        except (IOError, OSError), e:
+            if sent > 0 or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+
+    return copy_file_data(in_fh, out_fh, offset, length)
+
+
+def copy_file_data(in_fh, out_fh, offset=0, length=None):
+    '''
+    Write part of a file to another file or a socket with a read/write loop
+
+    :param in_fh: File-like object to read (must support seek())
+    :param out_fh: File or socket to write to
+    :param offset: Position in in_fh to start at
+    :param length: Number of bytes to copy (None for the rest of the file)
+    :return: Number of bytes copied
+    '''
+    in_fh.seek(offset)
+    copied = 0
+    while length is None or copied < length:
+        size = COPY_BUFFER_SIZE
+        if length is not None:
+            size = min(length - copied, size)
+        data = in_fh.read(size)
+        if not data:
+            break
+        if hasattr(out_fh, 'write'):
+            out_fh.write(data)
+        else:
+            out_fh.sendall(data)
+        copied += len(data)
+    return copied
+
+
+def fast_copy_file(src_path, dst_path):
+    '''
+    Copy a file (contents and permissions), as cheaply as the OS allows
+
+    Tries, in order: a reflink (no data copied at all), sendfile() (copied
+    in the kernel), and a plain read/write loop.
+
+    :param src_path: File to copy
+    :param dst_path: Path to write the copy to (replaced if it exists)
+    '''
+    with open(src_path, 'rb') as in_fh:
+        with open(dst_path, 'wb') as out_fh:
+            if not _reflink(in_fh, out_fh):
+                send_file_data(in_fh, out_fh)
+    shutil.copymode(src_path, dst_path)
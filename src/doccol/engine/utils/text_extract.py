@@ -0,0 +1,51 @@
+'''Getting searchable words out of property values and attachment files'''
+
+import os
+import re
+
+MAX_EXTRACT_BYTES = 16 * 1024 * 1024    # Only index the start of huge files
+MAX_TOKEN_LEN = 64                      # Longer "words" are probably encoded data
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def to_unicode(text):
+    '''Decode bytes as UTF-8 (replacing anything that isn't)'''
+    if isinstance(text, unicode):
+        return text
+    return text.decode('utf-8', 'replace')
+
+
+def tokenize(text):
+    '''
+    Split text into lower case words
+
+    :param text: str or unicode
+    :return: list of unicode tokens in the order they appear
+    '''
+    return [token for token in TOKEN_PATTERN.findall(to_unicode(text).lower())
+            if len(token) <= MAX_TOKEN_LEN]
+
+
+def extract_plain_text(path):
+    '''
+    Read a text file for indexing
+
+    :param path: Path to the file
+    :return: unicode
+    '''
+    with open(path, 'rb') as fh:
+        return to_unicode(fh.read(MAX_EXTRACT_BYTES))
+
+
+def calc_extractor_key(filename):
+    '''Key to look up the extractor for a file in an extractors dictionary'''
+    return os.path.splitext(filename)[1].lower()
+
+
+# [extension] = callable(path) returning the text of the file (or None)
+DEFAULT_TEXT_EXTRACTORS = dict([(ext, extract_plain_text) for ext in (
+    '.txt', '.text', '.md', '.rst', '.csv', '.tsv', '.log', '.ini', '.cfg',
+    '.json', '.xml', '.html', '.htm', '.sql', '.py', '.js', '.css', '.sh',
+    '.bat', '.yml', '.yaml',
+)])
@@ -0,0 +1,52 @@
+'''Compact encoding of lists of non-negative integers (7 bits per byte)'''
+
+
+def encode_varints(numbers):
+    '''
+    Encode integers with the high bit of each byte marking "more bytes follow"
+
+    Small numbers take one byte, so sorted lists should be delta encoded first.
+
+    :param numbers: Iterable of integers >= 0
+    :return: str of bytes
+    '''
+    out = bytearray()
+    for number in numbers:
+        if number < 0:
+            raise ValueError("Can't encode negative number: %d" % (number))
+        while number >= 0x80:
+            out.append((number & 0x7F) | 0x80)
+            number >>= 7
+        out.append(number)
+    return str(out)
+
+
+def decode_varints(data, offset=0, length=None):
+    '''
+    Decode integers written by encode_varints()
+
+    :param data: str of bytes
+    :param offset: Where to start in data
+    :param length: Number of bytes to decode (None for the rest of data)
+    :return: list of integers
+    '''
+    if length is None:
+        end = len(data)
+    else:
+        end = offset + length
+    data = bytearray(data[offset:end])
+
+    numbers = list()
+    number = 0
+    shift = 0
+    for byte in data:
+        number |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(number)
+            number = 0
+            shift = 0
+    if shift:
+        raise ValueError("Truncated varint data")
+    return numbers
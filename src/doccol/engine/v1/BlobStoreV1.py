@@ -0,0 +1,155 @@
+import os
+import errno
+
+from ..utils.atomic_write import calc_temp_path
+
+
+class BlobStoreV1(object):
+    '''
+    Content addressed store for attachment files shared between documents
+
+    Each distinct file is stored once under blobs/ (named by its hash) and
+    hard linked into every document folder that uses it.  The link count on
+    the blob is the reference count: when only the blob store's link is left,
+    no document uses the file anymore and it can be removed.
+
+    Because documents hold real links, deleting a document folder by hand
+    is still safe.  collect_garbage() cleans up blobs it left unreferenced.
+
+    Blobs are keyed by the hash of the attachment's content plus, for
+    compressed attachments, the compression method (see calc_blob_key()),
+    so a raw and a compressed copy of the same content are never mixed up.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: Path to the folder to keep blobs in
+        '''
+        self.__path = path
+
+
+    @property
+    def path(self):
+        return self.__path
+
+
+    @property
+    def supported(self):
+        '''Can this platform hard link files?'''
+        return hasattr(os, 'link')
+
+
+    @staticmethod
+    def calc_blob_key(hash, compression=None):
+        '''
+        Key to store an attachment's file under
+
+        :param hash: MD5 of the attachment's (uncompressed) content
+        :param compression: Method the stored file is compressed with (or None)
+        :return: str
+        '''
+        if compression is None:
+            return hash
+        return hash + '.' + compression
+
+
+    def calc_blob_path(self, hash):
+        return os.path.join(self.__path, hash[:2], hash)
+
+
+    def calc_incoming_path(self, filename):
+        '''
+        Path to copy a file to before its hash is known
+
+        :param filename: Original filename (for debugging leftovers)
+        :return: str path
+        '''
+        incoming = os.path.join(self.__path, 'incoming')
+        if not os.path.exists(incoming):
+            try:
+                os.makedirs(incoming)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return calc_temp_path(os.path.join(incoming, filename))
+
+
+    def add(self, incoming_path, hash):
+        '''
+        Move a file copied to calc_incoming_path() into the store
+
+        If the store already has the content, the incoming file is discarded.
+
+        :param incoming_path: Path to the new file
+        :param hash: Key of the file (see calc_blob_key())
+        :return: Path to the blob, or None if a different file has the same hash
+                 (incoming file is left for the caller in that case)
+        '''
+        blob_path = self.calc_blob_path(hash)
+        blob_dir = os.path.dirname(blob_path)
+        if not os.path.exists(blob_dir):
+            try:
+                os.makedirs(blob_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        try:
+            # Linking fails if the blob exists, so concurrent adds can't clobber
+            os.link(incoming_path, blob_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            if os.path.getsize(blob_path) != os.path.getsize(incoming_path):
+                return None
+
+        os.unlink(incoming_path)
+        return blob_path
+
+
+    def link(self, hash, path):
+        '''
+        Add a reference to a blob by linking it to path
+
+        :param hash: Content hash of the blob
+        :param path: Path to create in the document folder
+        '''
+        os.link(self.calc_blob_path(hash), path)
+
+
+    def release(self, hash):
+        '''
+        Remove a blob if no document links to it anymore
+
+        :param hash: Content hash of the blob
+        '''
+        blob_path = self.calc_blob_path(hash)
+        try:
+            if os.stat(blob_path).st_nlink <= 1:
+                os.unlink(blob_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    def collect_garbage(self):
+        '''
+        Remove every blob no document links to anymore
+
+        (Don't run while documents are being added: a blob just added but not
+         linked yet looks unreferenced)
+
+        :return: Number of blobs removed
+        '''
+        removed = 0
+        if not os.path.exists(self.__path):
+            return removed
+        for shard in os.listdir(self.__path):
+            shard_path = os.path.join(self.__path, shard)
+            if shard == 'incoming' or not os.path.isdir(shard_path):
+                continue
+            for hash in os.listdir(shard_path):
+                if os.stat(os.path.join(shard_path, hash)).st_nlink <= 1:
+                    os.unlink(os.path.join(shard_path, hash))
+                    removed += 1
+        return removed
@@ -0,0 +1,259 @@
+import io
+import os
+import time
+import errno
+import bisect
+import hashlib
+
+from ..utils.atomic_write import atomic_write
+
+
+class ChunkStoreV1(object):
+    '''
+    Content addressed store for pieces of attachment files
+
+    Chunked attachments (see utils/chunking.py) are split where their
+    content says to, and each distinct chunk is stored once under chunks/
+    (named by its SHA-256).  Revisions of a file that differ only a little
+    share most of their chunks.  The attachment's stored value lists its
+    chunks (the manifest) and open() reassembles them as they're read.
+
+    Chunks aren't reference counted: collect_garbage() removes the ones no
+    manifest lists.
+    '''
+
+    GC_GRACE_SECONDS = 3600     # Don't collect chunks added or reused more recently
+    REMOVING_SUFFIX = '.removing'
+
+    def __init__(self, path):
+        '''
+        :param path: Path to the folder to keep chunks in
+        '''
+        self.__path = path
+
+
+    @property
+    def path(self):
+        return self.__path
+
+
+    def calc_chunk_path(self, hash):
+        return os.path.join(self.__path, hash[:2], hash)
+
+
+    def add(self, data):
+        '''
+        Store a chunk (if it isn't stored already)
+
+        :param data: str contents of the chunk
+        :return: (hash of the chunk, True if it was new)
+        '''
+        hash = hashlib.sha256(data).hexdigest()
+        chunk_path = self.calc_chunk_path(hash)
+
+        if os.path.exists(chunk_path):
+            # Mark as in use, so a concurrent collect_garbage() leaves it
+            try:
+                os.utime(chunk_path, None)
+                return hash, False
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        chunk_dir = os.path.dirname(chunk_path)
+        if not os.path.exists(chunk_dir):
+            try:
+                os.makedirs(chunk_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Concurrent adds of the same chunk write the same bytes, so either rename wins
+        with atomic_write(chunk_path, 'wb') as fh:
+            fh.write(data)
+        return hash, True
+
+
+    def open(self, manifest, name=None):
+        '''
+        Read the file a manifest describes
+
+        :param manifest: list of [hash, length] of each chunk, in order
+        :param name: Name for the file object (for messages)
+        :return: ChunkedFileReader
+        '''
+        return ChunkedFileReader(self, manifest, name)
+
+
+    def iter_chunk_hashes(self):
+        '''List the hash of every stored chunk'''
+        for hash in self._iter_chunk_files():
+            if '.' not in hash:
+                yield hash
+
+
+    def _iter_chunk_files(self):
+        if not os.path.exists(self.__path):
+            return
+        for shard in sorted(os.listdir(self.__path)):
+            shard_path = os.path.join(self.__path, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in sorted(os.listdir(shard_path)):
+                yield name
+
+
+    def collect_garbage(self, referenced, started=None):
+        '''
+        Remove every chunk no manifest lists
+
+        Chunks added (or reused) since GC_GRACE_SECONDS before started are
+        kept, so documents being added while the references were collected
+        don't lose chunks their manifests aren't saved with yet.
+
+        A chunk is renamed aside before it's removed, then checked again:
+        if add() reused it in the meantime it's put back.
+
+        :param referenced: set of the chunk hashes in use
+        :param started: time.time() from before referenced was collected
+                        (default now)
+        :return: Number of chunks removed
+        '''
+        if started is None:
+            started = time.time()
+        keep_after = started - self.GC_GRACE_SECONDS
+
+        self._recover_removing()
+
+        removed = 0
+        for hash in list(self.iter_chunk_hashes()):
+            if hash in referenced:
+                continue
+            chunk_path = self.calc_chunk_path(hash)
+            removing_path = chunk_path + self.REMOVING_SUFFIX
+            try:
+                if os.stat(chunk_path).st_mtime >= keep_after:
+                    continue
+
+                # add() can't reuse the chunk once it's renamed (it writes a new
+                # one), but may have touched it just before
+                os.rename(chunk_path, removing_path)
+                if os.stat(removing_path).st_mtime >= keep_after:
+                    os.rename(removing_path, chunk_path)
+                    continue
+                os.unlink(removing_path)
+                removed += 1
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return removed
+
+
+    def _recover_removing(self):
+        '''Put back chunks a collect_garbage() that crashed left renamed aside'''
+        for name in list(self._iter_chunk_files()):
+            if not name.endswith(self.REMOVING_SUFFIX):
+                continue
+            chunk_path = self.calc_chunk_path(name[:-len(self.REMOVING_SUFFIX)])
+            try:
+                if os.path.exists(chunk_path):
+                    os.unlink(chunk_path + self.REMOVING_SUFFIX)
+                else:
+                    os.rename(chunk_path + self.REMOVING_SUFFIX, chunk_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class ChunkedFileReader(io.RawIOBase):
+    '''
+    Read-only, seekable file object over the chunks listed in a manifest
+
+    Chunk files are opened one at a time as reading reaches them.
+    '''
+
+    def __init__(self, chunk_store, manifest, name=None):
+        super(ChunkedFileReader, self).__init__()
+        self.name = name
+        self.__paths = list()
+        self.__offsets = [0]        # Start of each chunk, then the end of the file
+        for hash, length in manifest:
+            self.__paths.append(chunk_store.calc_chunk_path(hash))
+            self.__offsets.append(self.__offsets[-1] + length)
+
+        self.__pos = 0
+        self.__chunk_i = None       # Index of the chunk open in __chunk_fh
+        self.__chunk_fh = None
+
+
+    @property
+    def size(self):
+        return self.__offsets[-1]
+
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+
+    def _open_chunk(self, i):
+        if self.__chunk_i != i:
+            if self.__chunk_fh is not None:
+                self.__chunk_fh.close()
+                self.__chunk_fh = None
+            self.__chunk_fh = open(self.__paths[i], 'rb')
+            self.__chunk_i = i
+        return self.__chunk_fh
+
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = self.size - self.__pos
+        parts = list()
+        while size > 0 and self.__pos < self.size:
+            i = bisect.bisect_right(self.__offsets, self.__pos) - 1
+            fh = self._open_chunk(i)
+            fh.seek(self.__pos - self.__offsets[i])
+            data = fh.read(min(size, self.__offsets[i+1] - self.__pos))
+            if not data:
+                raise IOError("Chunk is shorter than recorded: " + self.__paths[i])
+            parts.append(data)
+            self.__pos += len(data)
+            size -= len(data)
+        return ''.join(parts)
+
+
+    def readall(self):
+        return self.read()
+
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Invalid seek position: %d" % (offset))
+        self.__pos = offset
+        return self.__pos
+
+
+    def tell(self):
+        return self.__pos
+
+
+    def close(self):
+        if not self.closed and self.__chunk_fh is not None:
+            self.__chunk_fh.close()
+            self.__chunk_fh = None
+        super(ChunkedFileReader, self).close()
@@ -0,0 +1,41 @@
+import os
+
+from .BlobStoreV1 import BlobStoreV1
+from .ChunkStoreV1 import ChunkStoreV1
+
+
+class ColStoreV1(object):
+    '''
+    Collection-wide storage and settings made available to property values
+
+    Passed down through encode_prop_value_for_disk() and
+    decode_prop_value_from_disk() so values (like attachments) can use storage
+    outside of the document folder.
+    '''
+
+    def __init__(self, col_path, settings):
+        '''
+        :param col_path: Path to the root of the collection
+        :param settings: PropertyFile with the collection settings
+        '''
+        self.__settings = settings
+        self.blob_store = BlobStoreV1(os.path.join(col_path, 'blobs'))
+        self.chunk_store = ChunkStoreV1(os.path.join(col_path, 'chunks'))
+
+
+    @property
+    def dedup_attachments(self):
+        '''Should attachments be stored once in the blob store by default?'''
+        return bool(self.__settings['dedup_attachments'])
+
+
+    @property
+    def compress_attachments(self):
+        '''Compression method for attachments by default (None to store as is)'''
+        return self.__settings['compress_attachments'] or None
+
+
+    @property
+    def chunk_attachments(self):
+        '''Should attachments be stored as shared chunks in the chunk store by default?'''
+        return bool(self.__settings['chunk_attachments'])
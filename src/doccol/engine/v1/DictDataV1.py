@@ -65,12 +65,13 @@ class DictDataV1(ModelDataTypeV1):
 
     # -- Storing ----------------------------------------------------------------------
 
-    def prep_for_store(self, store_path, store_prefix):
+    def prep_for_store(self, store_path, store_prefix, col_store=None):
         '''
         Prepare working value for storage
 
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: value ready to be encoded into the file storing the document properties
         '''
         store_values = dict()
@@ -80,12 +81,13 @@ class DictDataV1(ModelDataTypeV1):
             store_values[name] = encode_prop_value_for_disk(
                 prop_value = value,
                 store_path = store_path,
-                store_prefix = store_prefix)
+                store_prefix = store_prefix,
+                col_store = col_store)
 
         return store_values
 
 
-    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types):
+    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types, col_store=None):
         '''
         Decode value prepared by prep_for_store() back to working value
 
@@ -93,6 +95,7 @@ class DictDataV1(ModelDataTypeV1):
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
         :param col_data_types: Dictionary of property data type handlers in collection
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: anything
         '''
         decoded_values = dict()
@@ -103,7 +106,8 @@ class DictDataV1(ModelDataTypeV1):
                 stored_value = item,
                 store_path=store_path,
                 store_prefix=store_prefix,
-                col_data_types=col_data_types)
+                col_data_types=col_data_types,
+                col_store=col_store)
 
         return DictDataV1(decoded_values)
 
@@ -1,26 +1,47 @@
 import os
-import glob
 import shutil
+import heapq
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from string import ascii_letters, digits
 from bunch import Bunch
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from ..DocColEngine import DocColEngine
 from ..DoccumentId import DocumentId
 
 from ..utils.LookupFile import LookupFile
-from ..utils.PropertyFile import PropertyFile
+from ..utils.PropertyFile import PropertyFile, PropertyFileBatch
 from ..utils.Cache import Cache
 
 from ..exceptions import PropertyValueDecodeError
+from ..query import compile_where, calc_sort_key
 
 from ModelDataTypeV1 import safe_del_prop_value
 from ListDataV1 import ListDataV1
 from DictDataV1 import DictDataV1
 from FileAttachmentV1 import FileAttachmentV1
+from ColStoreV1 import ColStoreV1
+from LazyPropertiesV1 import LazyPropertiesV1
+from PropertyIndexV1 import PropertyIndexesV1
+from TextIndexV1 import TextIndexV1
+from IndexStampsV1 import IndexStampsV1
 
 from prop_pickle import encode_prop_value_for_disk, decode_prop_value_from_disk
+from prop_pickle import iter_stored_values, stored_values_match
 
 SANITIZE_FOLD_SAFE_CHARS=set(ascii_letters + digits + '_')
+PROP_FILE_CACHE_BYTES=8 * 1024 * 1024
+BULK_CHUNK_SIZE=256
+LIST_READ_AHEAD=64
 
 def sanitize_folder_name(name):
     def _get_safe_folder_name_chars(name):
@@ -61,6 +82,9 @@ class V1DocumentId(DocumentId):
     def domain_folder(self):
         return self.__domain_folder
     @property
+    def name(self):
+        return self.__doc_name
+    @property
     def doc_name(self):
         return self.__doc_name
     @property
@@ -83,12 +107,45 @@ class DocColEngineV1(DocColEngine):
         (may add index later and compare against file times)
     '''
 
+    DOC_PROP_FILE_NAME = 'doc.properties'
+    DOC_PROP_FILE_CLASS = PropertyFile      # Format of the doc.properties files
+
     def __init__(self, path):
         self.__path = path
-        self.__domains = dict()
+        self.__domains = dict()                 # [domain_name] = path to domain folder
+        self.__domains_mtime = None             # mtime of documents/ when __domains loaded
 
-        self.__prop_file_cache = Cache(100)     # [prop_file_path] = PropertyFile
+        self.__prop_file_cache = Cache(         # [prop_file_path] = PropertyFile
+            PROP_FILE_CACHE_BYTES,
+            weigher = lambda props: props.approx_size,
+            close_cb = lambda path, props: props.flush())
         self.__doc_path_cache = Cache(10000)    # [(domain_name, doc_name)] = path to doc folder
+        self.__doc_folder_indexes = dict()      # [domain_path] = LookupFile
+        self.__batch = None                     # PropertyFileBatch while batch() is open
+
+        self.__settings = PropertyFile(os.path.join(self.__path, 'collection.properties'))
+        self.__settings.def_property('dedup_attachments', default=False)
+        self.__settings.def_property('compress_attachments', default=None)
+        self.__settings.def_property('chunk_attachments', default=False)
+        self.__settings.def_property('indexes', default=None)
+        self.__settings.def_property('text_index', default=None)
+        self.__settings.def_property('index_durability', default=LookupFile.DURABILITY_OS)
+        self.__col_store = ColStoreV1(self.__path, self.__settings)
+
+        self.__prop_indexes = PropertyIndexesV1(
+            index_path = self.index_path,
+            settings = self.__settings,
+            calc_file_prefix = self._calc_prop_file_prefix,
+            iter_docs = self._iter_stored_docs)
+        self.__text_index = TextIndexV1(
+            index_path = self.index_path,
+            settings = self.__settings,
+            iter_docs = self._iter_stored_docs,
+            col_store = self.__col_store)
+        self.__index_stamps = IndexStampsV1(
+            os.path.join(self.index_path, 'stamps.lookup'), self.__settings['index_durability'])
+        self.__indexes_refreshed = False        # Checked for changes made outside the engine?
+        self.__stamps_pending = set()           # doc_refs written in the open batch
 
 
     DATA_TYPES = {
@@ -98,6 +155,67 @@ class DocColEngineV1(DocColEngine):
     }
 
 
+    @property
+    def settings(self):
+        '''
+        Collection-wide settings (saved in collection.properties)
+
+          dedup_attachments:  Store attachments once in blobs/ and hard link
+                              them into documents (default False)
+          compress_attachments: Store attachments compressed with 'zlib' or
+                              'bz2' (default None: stored as is)
+          chunk_attachments:  Split attachments into content-defined chunks
+                              stored once in chunks/ (default False)
+          indexes:            Properties with secondary indexes (see declare_index())
+          text_index:         Full-text index settings (see declare_text_index())
+          index_durability:   How index files are written: 'os' (default),
+                              'group' or 'fsync' (see LookupFile).  Read when
+                              the collection is opened.
+        '''
+        return self.__settings
+
+
+    @property
+    def blob_store(self):
+        '''BlobStoreV1 for deduplicated attachments'''
+        return self.__col_store.blob_store
+
+
+    @property
+    def chunk_store(self):
+        '''ChunkStoreV1 for chunked attachments'''
+        return self.__col_store.chunk_store
+
+
+    # -- Batching ------------------------------------------------------------
+
+    @contextmanager
+    def batch(self):
+        '''
+        Defer property file saves until the end of the with block
+
+        Each property file changed in the block is written once (atomically)
+        when the block exits.  Nested calls join the outer batch.
+        '''
+        if self.__batch is not None:
+            yield
+            return
+
+        self.__batch = PropertyFileBatch()
+        try:
+            yield
+        finally:
+            batch = self.__batch
+            self.__batch = None
+            batch.commit()
+
+            # Files are saved now, so their stamps are final
+            written = self.__stamps_pending
+            self.__stamps_pending = set()
+            for doc_ref in written:
+                self._record_doc_stamp(doc_ref)
+
+
     # -- Domains -------------------------------------------------------------
 
     def _get_domain_properties_file(self, domain_path):
@@ -108,11 +226,39 @@ class DocColEngineV1(DocColEngine):
         :return: PropertyFile
         '''
         path = os.path.join(domain_path, 'domain.properties')
-        props = PropertyFile(path)
+        props = PropertyFile(path, batch=self.__batch)
         props.def_property('name')
         return props
 
 
+    def _get_domain_registry(self):
+        '''
+        Get the lookup of domain name to domain folder path
+
+        Domains are scanned once per engine, and then only re-scanned if the
+        documents/ folder mtime changes (a domain folder added or removed).
+
+        :return: dict of [domain_name] = path to domain folder
+        '''
+        mtime = os.stat(self.documents_path).st_mtime
+        if mtime != self.__domains_mtime:
+            domains = dict()
+            for fold_name in os.listdir(self.documents_path):
+                path = os.path.join(self.documents_path, fold_name)
+                if not os.path.isdir(path):
+                    continue
+                try:
+                    path_domain_props = self._get_domain_properties_file(path)
+                except Exception, e:
+                    print "WARNING: For %s: %s" % (path, str(e))
+                    continue
+                if path_domain_props['name'] is not None:
+                    domains[path_domain_props['name']] = path
+            self.__domains = domains
+            self.__domains_mtime = mtime
+        return self.__domains
+
+
     def _get_domain_dir_path(self, domain, must_exist=False):
         '''
         Determine which directory to save documents in for a domain name (create if needed)
@@ -121,21 +267,17 @@ class DocColEngineV1(DocColEngine):
         :param must_exist: If False, then folder will be created
         :return: Full path to folder for domain
         '''
-        base_fold_name = sanitize_folder_name(domain)
+        domains = self._get_domain_registry()
 
         # See if folder already exists
-        for path in glob.glob(os.path.join(self.documents_path, base_fold_name) + '*'):
-            try:
-                path_domain_props = self._get_domain_properties_file(path)
-            except Exception, e:
-                print "WARNING: For %s: %s" % (path, str(e))
-                continue
-
-            if path_domain_props['name'] == domain:
-                return path
+        try:
+            return domains[domain]
+        except KeyError:
+            pass
 
         # -- If not found, need to create --
         if not must_exist:
+            base_fold_name = sanitize_folder_name(domain)
 
             # Make folder unique
             i=0
@@ -151,6 +293,10 @@ class DocColEngineV1(DocColEngine):
             props = self._get_domain_properties_file(path)
             props['name'] = domain
 
+            # Update registry in place
+            domains[domain] = path
+            self.__domains_mtime = os.stat(self.documents_path).st_mtime
+
             return path
 
 
@@ -163,7 +309,7 @@ class DocColEngineV1(DocColEngine):
 
 
     def _calc_doc_prop_file_path(self, doc_fold_path):
-        return os.path.join(doc_fold_path, 'doc.properties')
+        return os.path.join(doc_fold_path, self.DOC_PROP_FILE_NAME)
 
 
     def _get_doc_prop_file(self, doc_fold_path, must_exist=False):
@@ -180,16 +326,18 @@ class DocColEngineV1(DocColEngine):
         path = self._calc_doc_prop_file_path(doc_fold_path)
 
         # Use cache to avoid re-opening if possible
-        if self.__prop_file_cache.has(path):
-            return self.__prop_file_cache.get(path)
+        try:
+            props = self.__prop_file_cache.get(path)
+            props.batch = self.__batch
+            return props
+        except KeyError:
+            pass
 
         # Open it up
         if os.path.exists(path) or not must_exist:
 
             # Open property file
-            props = PropertyFile(path)
-            props.def_property('name')
-            props.def_property('properties')
+            props = self._open_doc_prop_file(path)
 
             # Cache
             self.__prop_file_cache.add(path, props)
@@ -201,6 +349,127 @@ class DocColEngineV1(DocColEngine):
         return None
 
 
+    def _open_doc_prop_file(self, path):
+        '''
+        Load a doc.properties file (without caching, so safe to call from threads)
+
+        :param path: Path to doc.properties
+        :return: PropertyFile
+        '''
+        props = self.DOC_PROP_FILE_CLASS(path, batch=self.__batch)
+        props.def_property('name')
+        props.def_property('properties')
+        return props
+
+
+    # -- Document folder index -----------------------------------------------
+
+    '''
+    To find a document by name without globbing the domain folder and reading
+    every candidate doc.properties, a lookup of document name to document
+    folder is kept for each domain under index/folders/.
+
+    The domain folder mtime is recorded in the lookup.  Adding or removing a
+    document folder (by the engine or by hand) changes the mtime, so a
+    mismatch means the lookup is stale and gets rebuilt from the folders.
+    '''
+
+    @property
+    def index_path(self):
+        return os.path.join(self.__path, 'index')
+
+
+    def _get_doc_folder_index(self, domain_path):
+        '''
+        Get the lookup of document name to folder for a domain
+
+        :param domain_path: Path to the folder for the domain
+        :return: LookupFile (fresh)
+        '''
+        index = self.__doc_folder_indexes.get(domain_path)
+        if index is None:
+            index_dir = os.path.join(self.index_path, 'folders')
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            index = LookupFile(os.path.join(
+                index_dir, os.path.basename(domain_path) + '.lookup'),
+                durability = self.__settings['index_durability'])
+            self.__doc_folder_indexes[domain_path] = index
+
+        if index.get('mtime') != os.stat(domain_path).st_mtime:
+            self._rebuild_doc_folder_index(domain_path, index)
+
+        return index
+
+
+    def _rebuild_doc_folder_index(self, domain_path, index):
+        '''
+        Scan all the document folders in a domain to rebuild the folder lookup
+
+        :param domain_path: Path to the folder for the domain
+        :param index: LookupFile to rebuild
+        '''
+        mtime = os.stat(domain_path).st_mtime
+        values = dict()
+        for doc_fold_name in os.listdir(domain_path):
+            doc_fold_path = os.path.join(domain_path, doc_fold_name)
+            if os.path.isdir(doc_fold_path):
+                try:
+                    doc_props = self._get_doc_prop_file(doc_fold_path, must_exist=True)
+                except Exception, e:
+                    print "WARNING: For %s: %s" % (doc_fold_path, str(e))
+                    continue
+                if doc_props is not None:
+                    values['doc:' + doc_props['name']] = doc_fold_name
+        values['mtime'] = mtime
+        index.replace_all(values)
+
+
+    def _find_doc_folder(self, domain_path, name):
+        '''
+        Find the folder a document is stored in
+
+        :param domain_path: Path to the folder for the domain
+        :param name: Name of the document
+        :return: Full path to the document folder, or None
+        '''
+        index = self._get_doc_folder_index(domain_path)
+        doc_fold_name = index.get('doc:' + name)
+        if doc_fold_name is None:
+            return None
+
+        # Confirm the hit (doc.properties may have been edited by hand)
+        path = os.path.join(domain_path, doc_fold_name)
+        doc_props = self._get_doc_prop_file(path, must_exist=True)
+        if doc_props is not None and doc_props['name'] == name:
+            return path
+
+        self._rebuild_doc_folder_index(domain_path, index)
+        doc_fold_name = index.get('doc:' + name)
+        if doc_fold_name is not None:
+            return os.path.join(domain_path, doc_fold_name)
+        return None
+
+
+    def _update_doc_folder_index(self, domain_path, name, doc_fold_name):
+        '''
+        Record a change made by the engine to the document folders of a domain
+
+        :param domain_path: Path to the folder for the domain
+        :param name: Name of the document
+        :param doc_fold_name: Folder document is now in, or None if removed
+        '''
+        index = self.__doc_folder_indexes.get(domain_path)
+        if index is None:
+            return
+        if doc_fold_name is None:
+            if 'doc:' + name in index:
+                del index['doc:' + name]
+        else:
+            index['doc:' + name] = doc_fold_name
+        index['mtime'] = os.stat(domain_path).st_mtime
+
+
     def create_new_doc(self, domain, name):
         '''
         Initialize a new document in the collection
@@ -212,16 +481,9 @@ class DocColEngineV1(DocColEngine):
         domain_path = self._get_domain_dir_path(domain)
         base_doc_name = sanitize_folder_name(name)
 
-        # See if folder already exists
-        for path in glob.glob(os.path.join(domain_path, base_doc_name) + '*'):
-            try:
-                path_doc_props = self._get_doc_prop_file(path)
-            except Exception, e:
-                print "WARNING: For %s: %s" % (path, str(e))
-                continue
-
-            if path_doc_props['name'] == name:
-                raise KeyError("Document already exists in domain (%s): %s" % (domain, name))
+        # See if document already exists
+        if self._find_doc_folder(domain_path, name) is not None:
+            raise KeyError("Document already exists in domain (%s): %s" % (domain, name))
 
 
         # -- If not found, need to create --
@@ -238,11 +500,15 @@ class DocColEngineV1(DocColEngine):
 
         # Create properties file
         props = self._get_doc_prop_file(path)
-        props['name'] = name
-        props['properties'] = dict()
+        props.update({
+            'name': name,
+            'properties': dict(),
+        })
+        self._record_doc_stamp(os.path.basename(domain_path) + '/' + fold_name)
 
         # Cache
         self.__doc_path_cache.add((domain, name), path)
+        self._update_doc_folder_index(domain_path, name, fold_name)
 
         return V1DocumentId(
             domain = domain,
@@ -251,46 +517,715 @@ class DocColEngineV1(DocColEngine):
             doc_folder = os.path.basename(path))
 
 
+    def create_new_docs(self, domain, items, workers=4):
+        '''
+        Initialize many new documents (with properties) in one domain
+
+        The domain is resolved and its folder listed once.  Documents are
+        processed in chunks: folders are created, property values (and
+        attachment copies) are prepared on a pool of threads, then each
+        doc.properties is written once.
+
+        :param domain: Domain (like a folder) of documents
+        :param items: Iterable of (name, properties dict)
+        :param workers: Number of threads to prepare property values on
+        :return: Generator of (name, Internal Document ID or None, Exception or None)
+        '''
+        domain_path = self._get_domain_dir_path(domain)
+        index = self._get_doc_folder_index(domain_path)
+        existing_folders = set(os.listdir(domain_path))
+
+        pool = ThreadPool(workers)
+        try:
+            chunk = list()
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= BULK_CHUNK_SIZE:
+                    for result in self._create_new_docs_chunk(
+                            domain, domain_path, index, existing_folders, chunk, pool):
+                        yield result
+                    chunk = list()
+            if len(chunk) > 0:
+                for result in self._create_new_docs_chunk(
+                        domain, domain_path, index, existing_folders, chunk, pool):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+            index['mtime'] = os.stat(domain_path).st_mtime
+
+
+    def _create_new_docs_chunk(self, domain, domain_path, index, existing_folders, chunk, pool):
+        '''Create one chunk of documents for create_new_docs()'''
+        results = list()
+        created = list()
+
+        with self.batch():
+
+            # Create document folders
+            for name, properties in chunk:
+                try:
+                    if 'doc:' + name in index:
+                        raise KeyError("Document already exists in domain (%s): %s" % (domain, name))
+
+                    base_doc_name = sanitize_folder_name(name)
+                    i=0
+                    fold_name = base_doc_name
+                    while fold_name in existing_folders:
+                        i += 1
+                        fold_name = '%s.%d' % (base_doc_name, i)
+                    path = os.path.join(domain_path, fold_name)
+                    os.mkdir(path)
+                    existing_folders.add(fold_name)
+
+                    props = self._get_doc_prop_file(path)
+                    props.update({
+                        'name': name,
+                        'properties': dict(),
+                    })
+                    index['doc:' + name] = fold_name
+                    self.__doc_path_cache.add((domain, name), path)
+
+                    doc_id = V1DocumentId(
+                        domain = domain,
+                        domain_folder = os.path.basename(domain_path),
+                        name = name,
+                        doc_folder = fold_name)
+                    results.append([name, doc_id, None])
+                    created.append((len(results)-1, path, properties))
+
+                except Exception, e:
+                    results.append([name, None, e])
+
+            # Prepare property values (copies attachments in) in parallel
+            def _encode(args):
+                i, path, properties = args
+                try:
+                    return i, self._encode_properties(path, properties), None
+                except Exception, e:
+                    return i, None, e
+
+            for i, encoded, error in pool.imap(_encode, created):
+                if error is None:
+                    props = self._get_doc_prop_file(
+                        os.path.join(domain_path, results[i][1].doc_folder))
+                    props['properties'] = encoded
+                    self._update_indexes(self._calc_doc_ref(results[i][1]), dict(), encoded)
+                    self._record_doc_stamp(self._calc_doc_ref(results[i][1]))
+                else:
+                    self.del_document(results[i][1])
+                    results[i][1] = None
+                    results[i][2] = error
+
+        return [tuple(result) for result in results]
+
+
+    def _encode_properties(self, doc_dir, properties):
+        '''
+        Convert property values for storage (without touching doc.properties)
+
+        :param doc_dir: Path to the document folder
+        :param properties: Dictionary of properties to encode (None values skipped)
+        :return: Dictionary of encoded properties
+        '''
+        encoded = dict()
+        for prop_name, prop_value in properties.items():
+            if prop_value is not None:
+                encoded[prop_name] = encode_prop_value_for_disk(
+                    prop_value = prop_value,
+                    store_path = doc_dir,
+                    store_prefix = self._calc_prop_file_prefix(prop_name),
+                    col_store = self.__col_store)
+        return encoded
+
+
     def list_all_domains(self):
         '''
         List all domains in the collection
 
         :return: Generator listing domain names
         '''
-        for fold_name in os.listdir(self.documents_path):
-            domain_props = self._get_domain_properties_file(os.path.join(
-                self.documents_path, fold_name))
-            yield domain_props['name']
+        for domain in sorted(self._get_domain_registry().keys()):
+            yield domain
 
 
-    def list_all_docs(self, domain=None):
+    def list_all_docs(self, domain=None, workers=None):
         '''
         List all documents in a domain in the collection
 
         :param domain: Name of the domain (None for all domains)
-        :return: Generator listing document ids
+        :param workers: Number of threads to load doc.properties with (None for serial)
+        :return: Generator listing document ids (ordered by folder name)
+        '''
+        for doc_id, doc_props, stamp in self._iter_docs(domain, workers):
+            yield doc_id
+
+
+    def list_all_docs_with_properties(self, domain=None, workers=8, after=None):
+        '''
+        List all documents with their properties loaded
+
+        doc.properties files are read on a pool of threads ahead of the
+        document being yielded.
+
+        :param domain: Name of the domain (None for all domains)
+        :param workers: Number of threads to load doc.properties with (None for serial)
+        :param after: Start after this document (an id from listing the same domain)
+        :return: Generator of (document id, properties, stamp) (ordered by folder name)
+        '''
+        for doc_id, doc_props, stamp in self._iter_docs(domain, workers, after):
+            doc_fold_path = os.path.join(self.documents_path, doc_id.domain_folder, doc_id.doc_folder)
+            yield doc_id, self._make_lazy_properties(doc_id, doc_fold_path, doc_props), stamp
+
+
+    def _iter_doc_folders(self, domain_fold_path):
+        '''
+        List the document folders in a domain
+
+        Uses scandir (when available) to avoid a stat call per entry
+
+        :param domain_fold_path: Path to the folder for the domain
+        :return: Sorted list of folder names
+        '''
+        if scandir is not None:
+            names = [entry.name for entry in scandir(domain_fold_path) if entry.is_dir()]
+        else:
+            names = [name for name in os.listdir(domain_fold_path)
+                     if os.path.isdir(os.path.join(domain_fold_path, name))]
+        names.sort()
+        return names
+
+
+    def _iter_docs(self, domain, workers, after=None):
+        '''
+        List documents along with their doc.properties
+
+        :param domain: Name of the domain (None for all domains)
+        :param workers: Number of threads to load doc.properties with (None for serial)
+        :param after: Skip documents up to and including this one in its domain
+                      (folders are skipped by name, without reading them)
+        :return: Generator of (document id, PropertyFile, stamp)
         '''
         if domain is None:
             for domain in self.list_all_domains():
-                for doc in self.list_all_docs(domain):
+                for doc in self._iter_docs(domain, workers, after):
+                    yield doc
+            return
+
+        domain_fold_path = self._get_domain_dir_path(domain, must_exist=True)
+        if domain_fold_path is None:
+            return
+
+        pool = None
+        if workers is not None:
+            pool = ThreadPool(workers)
+
+        def _load(path):
+            # Stamp before reading, so a change made meanwhile is seen as a change later
+            try:
+                stamp = self._calc_prop_file_stamp(path)
+                return self._open_doc_prop_file(path), stamp
+            except (IOError, OSError):
+                return None, None
+
+        def _finish(doc_fold_path, path, pending_load):
+            doc_props = None
+            if pending_load is not None:
+                doc_props, stamp = pending_load.get()
+                if doc_props is not None and not self.__prop_file_cache.has(path):
+                    self.__prop_file_cache.add(path, doc_props)
+                    doc_props.batch = self.__batch
+                else:
+                    doc_props = None
+            if doc_props is None:
+                stamp = self._calc_prop_file_stamp(path)
+                doc_props = self._get_doc_prop_file(doc_fold_path, must_exist=True)
+            if doc_props is None:
+                return None
+
+            doc_name = doc_props['name']
+            self.__doc_path_cache.add((domain, doc_name), doc_fold_path)
+            doc_id = V1DocumentId(
+                domain = domain,
+                domain_folder = os.path.basename(domain_fold_path),
+                name = doc_name,
+                doc_folder = os.path.basename(doc_fold_path))
+            return doc_id, doc_props, stamp
+
+        try:
+            pending = deque()
+            for doc_fold_name in self._iter_doc_folders(domain_fold_path):
+                if after is not None and after.domain == domain and doc_fold_name <= after.doc_folder:
+                    continue
+                doc_fold_path = os.path.join(domain_fold_path, doc_fold_name)
+                path = self._calc_doc_prop_file_path(doc_fold_path)
+
+                # Read ahead files not already cached
+                pending_load = None
+                if pool is not None and not self.__prop_file_cache.has(path):
+                    pending_load = pool.apply_async(_load, (path, ))
+                pending.append((doc_fold_path, path, pending_load))
+
+                if len(pending) >= LIST_READ_AHEAD:
+                    doc = _finish(*pending.popleft())
+                    if doc is not None:
+                        yield doc
+
+            while len(pending) > 0:
+                doc = _finish(*pending.popleft())
+                if doc is not None:
                     yield doc
 
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+    def find_docs(self, domain, where, limit=None, workers=None, order_by=None):
+        '''
+        Find documents whose property values pass every predicate
+
+        Predicates are tested against the raw values in doc.properties, so
+        nothing is decoded.  Only properties stored as plain python values
+        can match.
+
+        :param domain: Name of the domain (None for all domains)
+        :param where: Dictionary of [property_name] = Predicate (or value to equal)
+        :param limit: Stop after this many documents are found
+        :param workers: Number of threads to load doc.properties with (None for serial)
+        :param order_by: Property name to sort by ('-name' for descending).
+                         Documents without a number or string value for it are left out.
+        :return: Generator listing document ids
+        '''
+        where = compile_where(where)
+        found = 0
+        if limit is not None and limit <= 0:
+            return
+        self._ensure_indexes_fresh()
+
+        # Use secondary indexes to only look at documents that could match
+        doc_refs = self.__prop_indexes.find_refs(where)
+
+        if order_by is not None:
+            docs = self._find_docs_ordered(domain, where, limit, workers, order_by, doc_refs)
+        elif doc_refs is not None:
+            docs = self._iter_docs_by_ref(domain, sorted(doc_refs))
+        else:
+            docs = self._iter_docs(domain, workers)
+
+        for doc_id, doc_props, stamp in docs:
+            if stored_values_match(doc_props['properties'], where):
+                yield doc_id
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+
+    def _find_docs_ordered(self, domain, where, limit, workers, order_by, doc_refs):
+        '''
+        List candidate documents for find_docs() sorted by a property
+
+        With a sorted index on the property, documents are loaded in index
+        order so a top-k query stops after k matches.  Otherwise every
+        candidate is loaded and sorted (keeping only the top limit).
+
+        :param order_by: Property name to sort by ('-name' for descending)
+        :param doc_refs: Candidates from the indexes (None for all documents)
+        :return: Generator of (document id, PropertyFile, stamp)
+        '''
+        reverse = order_by.startswith('-')
+        prop_name = order_by.lstrip('-')
+
+        index = self.__prop_indexes.get(prop_name)
+        if hasattr(index, 'iter_sorted'):
+            ordered_refs = index.iter_sorted(reverse)
+            if doc_refs is not None:
+                ordered_refs = (doc_ref for doc_ref in ordered_refs if doc_ref in doc_refs)
+            for doc_id, doc_props, stamp in self._iter_docs_by_ref(domain, ordered_refs):
+                # Bools share index keys with 0 and 1, but aren't ordered
+                stored_value = doc_props['properties'].get(prop_name)
+                if stored_value is not None and stored_value['value_type'] == 'python' \
+                        and calc_sort_key(stored_value['value']) is not None:
+                    yield doc_id, doc_props, stamp
+            return
+
+        if doc_refs is not None:
+            docs = self._iter_docs_by_ref(domain, sorted(doc_refs))
+        else:
+            docs = self._iter_docs(domain, workers)
+
+        keyed = list()
+        for doc_id, doc_props, stamp in docs:
+            stored_value = doc_props['properties'].get(prop_name)
+            if stored_value is None or stored_value['value_type'] != 'python':
+                continue
+            sort_key = calc_sort_key(stored_value['value'])
+            if sort_key is None or not stored_values_match(doc_props['properties'], where):
+                continue
+            keyed.append(((sort_key, self._calc_doc_ref(doc_id)), doc_id, doc_props))
+
+        if limit is not None:
+            pick = heapq.nlargest if reverse else heapq.nsmallest
+            keyed = pick(limit, keyed, key=lambda entry: entry[0])
         else:
-            domain_fold_path = self._get_domain_dir_path(domain, must_exist=True)
-            if domain_fold_path is None:
+            keyed.sort(key=lambda entry: entry[0], reverse=reverse)
+
+        for key, doc_id, doc_props in keyed:
+            yield doc_id, doc_props, None
+
+
+    def _iter_docs_by_ref(self, domain, doc_refs):
+        '''
+        Load documents found in an index
+
+        :param domain: Name of the domain to limit to (None for all domains)
+        :param doc_refs: Iterable of (domain_folder)/(doc_folder) in the order to load
+        :return: Generator of (document id, PropertyFile, None)
+        '''
+        domain_names = dict()   # [domain_folder] = domain name
+        for domain_name, domain_path in self._get_domain_registry().items():
+            domain_names[os.path.basename(domain_path)] = domain_name
+
+        for doc_ref in doc_refs:
+            domain_folder, doc_folder = doc_ref.split('/', 1)
+            try:
+                domain_name = domain_names[domain_folder]
+            except KeyError:
+                continue
+            if domain is not None and domain_name != domain:
+                continue
+            doc_props = self._get_doc_prop_file(
+                os.path.join(self.documents_path, domain_folder, doc_folder), must_exist=True)
+            if doc_props is None:
+                continue
+            yield V1DocumentId(
+                domain = domain_name,
+                domain_folder = domain_folder,
+                name = doc_props['name'],
+                doc_folder = doc_folder), doc_props, None
+
+
+    # -- Property indexes ----------------------------------------------------
+
+    def _calc_doc_ref(self, doc_id):
+        '''Key for a document in the property indexes'''
+        return doc_id.domain_folder + '/' + doc_id.doc_folder
+
+
+    def _update_indexes(self, doc_ref, old_stored_values, new_stored_values):
+        '''Tell the property and text indexes about a document changing'''
+        self._ensure_indexes_fresh()
+        self.__prop_indexes.update_doc(doc_ref, new_stored_values)
+        self.__text_index.update_doc(doc_ref, old_stored_values, new_stored_values)
+
+
+    def _remove_from_indexes(self, doc_ref):
+        '''Tell the property and text indexes about a document being deleted'''
+        self._ensure_indexes_fresh()
+        self.__prop_indexes.remove_doc(doc_ref)
+        self.__text_index.remove_doc(doc_ref)
+
+
+    def _iter_stored_docs(self, cache=True):
+        '''
+        List every document's stored (encoded) property values (to build indexes)
+
+        If no index relies on the recorded stamps yet (this is the first index),
+        the stamps of the documents scanned are recorded once the scan
+        finishes, so the next refresh_indexes() doesn't read them all again.
+
+        :param cache: If False, read the files without the engine's caches or
+                      stamps (safe to run on another thread)
+        :return: Generator of (doc_ref, stored_values)
+        '''
+        if not cache:
+            for doc_ref, doc_props, stamp in self._read_doc_prop_files(workers=8):
+                yield doc_ref, doc_props['properties']
+            return
+
+        record = not self.__index_stamps.complete
+        changes = list()
+        domain_mtimes = dict()
+        if record:
+            # Before listing: a document folder added meanwhile changes the mtime
+            domain_mtimes = self._calc_domain_mtimes()
+
+        for doc_id, doc_props, stamp in self._iter_docs(None, workers=8):
+            doc_ref = self._calc_doc_ref(doc_id)
+            if record and stamp is not None:
+                changes.append((doc_ref, stamp))
+            yield doc_ref, doc_props['properties']
+
+        if record:
+            self.__index_stamps.finish(changes, domain_mtimes)
+
+
+    def _read_doc_prop_files(self, workers):
+        '''
+        Read every doc.properties straight from disk
+
+        Domain and document folders are listed directly, and nothing is
+        cached, so this doesn't touch the engine's state.
+
+        :param workers: Number of threads to load doc.properties with
+        :return: Generator of (doc_ref, PropertyFile, stamp)
+        '''
+        def _load(doc_ref):
+            path = self._calc_ref_prop_file_path(doc_ref)
+            try:
+                stamp = self._calc_prop_file_stamp(path)
+                if stamp is None:
+                    return doc_ref, None, None
+                return doc_ref, self._open_doc_prop_file(path), stamp
+            except (IOError, OSError):
+                return doc_ref, None, None
+
+        if not os.path.exists(self.documents_path):
+            return
+        pool = ThreadPool(workers)
+        try:
+            pending = deque()
+            for domain_folder in self._iter_doc_folders(self.documents_path):
+                domain_path = os.path.join(self.documents_path, domain_folder)
+                if not os.path.exists(os.path.join(domain_path, 'domain.properties')):
+                    continue
+                for doc_folder in self._iter_doc_folders(domain_path):
+                    pending.append(pool.apply_async(_load, (domain_folder + '/' + doc_folder, )))
+                    if len(pending) >= LIST_READ_AHEAD:
+                        doc_ref, doc_props, stamp = pending.popleft().get()
+                        if doc_props is not None:
+                            yield doc_ref, doc_props, stamp
+
+            while len(pending) > 0:
+                doc_ref, doc_props, stamp = pending.popleft().get()
+                if doc_props is not None:
+                    yield doc_ref, doc_props, stamp
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def _calc_domain_mtimes(self):
+        '''
+        :return: Dictionary of [domain_folder] = mtime (as find_changes() returns)
+        '''
+        mtimes = dict()
+        if os.path.exists(self.documents_path):
+            for domain_folder in self._iter_doc_folders(self.documents_path):
+                try:
+                    mtimes[domain_folder] = os.stat(
+                        os.path.join(self.documents_path, domain_folder)).st_mtime
+                except OSError:
+                    pass
+        return mtimes
+
+
+    def declare_index(self, prop_name, kind='equality'):
+        '''
+        Keep a secondary index on a property so find() doesn't need to scan
+
+        The index is built now (a full scan), then kept up to date as
+        documents change.
+
+        :param prop_name: Name of the property to index
+        :param kind: Type of index
+        '''
+        # Bring the other indexes up to date first: the scan may record stamps
+        self._ensure_indexes_fresh()
+        self.__prop_indexes.declare(prop_name, kind)
+
+
+    def drop_index(self, prop_name):
+        '''
+        Stop indexing a property
+
+        :param prop_name: Name of the property
+        '''
+        self.__prop_indexes.drop(prop_name)
+        self._reset_stamps_if_unindexed()
+
+
+    def rebuild_indexes(self, prop_names=None):
+        '''
+        Rebuild secondary indexes from scratch
+
+        :param prop_names: Properties to rebuild (None for all)
+        '''
+        self._ensure_indexes_fresh()
+        self.__prop_indexes.rebuild(prop_names)
+
+
+    @property
+    def declared_indexes(self):
+        '''Dictionary of [prop_name] = index kind'''
+        return self.__prop_indexes.declared
+
+
+    # -- Index refresh -------------------------------------------------------
+
+    '''
+    Documents edited outside the engine (by hand, or by a git pull) are
+    caught by comparing doc.properties stamps to the ones recorded in
+    index/stamps.lookup (see IndexStampsV1).  This is done the first time the
+    indexes are used after the collection is opened, and on refresh_indexes().
+    The engine records the stamp of each file it writes, so its own changes
+    aren't read back.
+    '''
+
+    def _has_indexes(self):
+        return len(self.__prop_indexes.declared) > 0 or self.__text_index.config is not None
+
+
+    def _ensure_indexes_fresh(self):
+        if not self.__indexes_refreshed:
+            self.refresh_indexes()
+
+
+    def _reset_stamps_if_unindexed(self):
+        '''Forget the stamps once the last index is dropped (they aren't kept up to date)'''
+        if not self._has_indexes():
+            self.__index_stamps.reset()
+
+
+    def _calc_ref_prop_file_path(self, doc_ref):
+        domain_folder, doc_folder = doc_ref.split('/', 1)
+        return self._calc_doc_prop_file_path(
+            os.path.join(self.documents_path, domain_folder, doc_folder))
+
+
+    def _record_doc_stamp(self, doc_ref):
+        '''Note that the indexes are up to date with a document's doc.properties'''
+        if not self.__indexes_refreshed or not self._has_indexes():
+            return
+        if self.__batch is not None:
+            self.__stamps_pending.add(doc_ref)
+            return
+        self.__index_stamps.record(
+            doc_ref, self._calc_prop_file_stamp(self._calc_ref_prop_file_path(doc_ref)))
+
+
+    def refresh_indexes(self):
+        '''
+        Update the indexes for documents changed outside the engine
+
+        Only documents whose doc.properties stamp changed are read (the first
+        refresh of a collection reads every document).
+
+        :return: Number of documents re-indexed
+        '''
+        self.__indexes_refreshed = True
+        if not self._has_indexes():
+            return 0
+
+        changes, domain_mtimes = self.__index_stamps.find_changes(
+            documents_path = self.documents_path,
+            list_folders = self._iter_doc_folders,
+            calc_stamp = lambda domain_folder, doc_folder: self._calc_prop_file_stamp(
+                self._calc_ref_prop_file_path(domain_folder + '/' + doc_folder)))
+
+        for doc_ref, stamp in changes:
+            path = self._calc_ref_prop_file_path(doc_ref)
+
+            stored_values = dict()
+            try:
+                doc_props = self.__prop_file_cache.get(path)
+            except KeyError:
+                doc_props = None
+
+            if stamp is None:
+                # Gone: forget the cached copy (unless it has changes of ours waiting to save)
+                if doc_props is not None and not doc_props.dirty:
+                    self.__prop_file_cache.remove(path)
+            else:
+                try:
+                    # Reload the cached copy in place (unless it has changes of
+                    # ours waiting to save), or read without caching
+                    if doc_props is None:
+                        doc_props = self._open_doc_prop_file(path)
+                    elif not doc_props.dirty:
+                        doc_props.reload()
+                    stored_values = doc_props['properties'] or dict()
+                except Exception, e:
+                    print "WARNING: For %s: %s" % (path, str(e))
+
+            self.__prop_indexes.update_doc(doc_ref, stored_values)
+            self.__text_index.replace_doc(doc_ref, stored_values)
+
+        self.__index_stamps.finish(changes, domain_mtimes)
+        return len(changes)
+
+
+    # -- Full-text index -----------------------------------------------------
+
+    def declare_text_index(self, prop_names=None, attachments=True):
+        '''
+        Keep a full-text index so search_docs() can find documents by words
+
+        The index is built now (a full scan), then kept up to date as
+        documents change.
+
+        :param prop_names: Properties to index (None for every property)
+        :param attachments: Also index attachment files (filename, and text
+                            if there's an extractor for the file type)
+        '''
+        self._ensure_indexes_fresh()
+        self.__text_index.declare(prop_names, attachments)
+
+
+    def drop_text_index(self):
+        '''Stop keeping the full-text index'''
+        self.__text_index.drop()
+        self._reset_stamps_if_unindexed()
+
+
+    def rebuild_text_index(self, background=False):
+        '''
+        Rebuild the full-text index from scratch
+
+        :param background: Rebuild on another thread (searches use the old index meanwhile)
+        :return: threading.Thread doing the rebuild if background, else None
+        '''
+        self._ensure_indexes_fresh()
+        if background and self.__batch is not None:
+            # The rebuild thread reads doc.properties from disk, so save what's waiting
+            self.__batch.flush()
+        return self.__text_index.rebuild(background)
+
+
+    def register_text_extractor(self, ext, extractor):
+        '''
+        Set how to get the text out of attachments of a file type
+
+        Only affects attachments indexed from now on (rebuild to re-index).
+
+        :param ext: File extension (ex: '.pdf')
+        :param extractor: Called with the path to the file, returns text (or None)
+        '''
+        self.__text_index.extractors[ext.lower()] = extractor
+
+
+    def search_docs(self, text, domain=None, limit=None):
+        '''
+        Find documents containing every word and "quoted phrase" in text
+
+        :param text: Search query
+        :param domain: Name of the domain (None for all domains)
+        :param limit: Max number of results
+        :return: Generator of (document id, score), best first
+        '''
+        ref_prefix = None
+        if domain is not None:
+            domain_path = self._get_domain_dir_path(domain, must_exist=True)
+            if domain_path is None:
                 return
-            for doc_fold_name in os.listdir(domain_fold_path):
-                doc_fold_path = os.path.join(domain_fold_path, doc_fold_name)
-                if os.path.isdir(doc_fold_path):
-                    doc_props = self._get_doc_prop_file(doc_fold_path, must_exist=True)
-                    if doc_props is not None:
-                        doc_name = doc_props['name']
-                        self.__doc_path_cache.add((domain, doc_name), doc_fold_path)
-                        yield V1DocumentId(
-                            domain = domain,
-                            domain_folder = os.path.basename(domain_fold_path),
-                            name = doc_name,
-                            doc_folder = os.path.basename(doc_fold_path))
+            ref_prefix = os.path.basename(domain_path) + '/'
+
+        self._ensure_indexes_fresh()
+        results = self.__text_index.search(text, ref_prefix, limit)
+        scores = dict(results)
+        for doc_id, doc_props, stamp in self._iter_docs_by_ref(domain, [ref for ref, score in results]):
+            yield doc_id, scores[self._calc_doc_ref(doc_id)]
 
 
     def get_document_id(self, domain, name):
@@ -305,20 +1240,16 @@ class DocColEngineV1(DocColEngine):
         if domain_path is None:
             return None
 
-        doc_fold_basename = sanitize_folder_name(name)
-
-        for path in glob.glob(os.path.join(domain_path, doc_fold_basename) + '*'):
-            doc_props = self._get_doc_prop_file(path, must_exist=True)
-            if doc_props is None:
-                print "WARNING: Can't find document properties: " + path
-            if doc_props['name'] == name:
-                return V1DocumentId(
-                    domain = domain,
-                    domain_folder = os.path.basename(domain_path),
-                    name = name,
-                    doc_folder = os.path.basename(path))
+        path = self._find_doc_folder(domain_path, name)
+        if path is None:
+            return None
 
-        return None
+        self.__doc_path_cache.add((domain, name), path)
+        return V1DocumentId(
+            domain = domain,
+            domain_folder = os.path.basename(domain_path),
+            name = name,
+            doc_folder = os.path.basename(path))
 
 
 
@@ -330,36 +1261,66 @@ class DocColEngineV1(DocColEngine):
         '''
         Get all of the properties for a document
 
+        Values are decoded as they're accessed (see LazyPropertiesV1)
+
         :param doc_id: Internal Document ID
-        :return: dict of properties (safe to modify)
+        :return: dict-like of properties (safe to modify)
         '''
         # Retrieve values stored in file
         doc_fold_path = os.path.join(self.documents_path, doc_id.domain_folder, doc_id.doc_folder)
         doc_prop_file = self._get_doc_prop_file(doc_fold_path, must_exist=True)
-        stored_prop_values = doc_prop_file['properties']
 
         # Cache Note: Value of property is stored in-mem in PropertyFile returned
         #             by _get_doc_prop_file() which caches the files.
         #             This call should return values from in-mem if file has been
-        #             loaded
+        #             loaded.  Decoded values are memoized on the PropertyFile too.
+
+        return self._make_lazy_properties(doc_id, doc_fold_path, doc_prop_file)
 
-        # Decode according to property value type
-        prop_values = dict()
-        for prop_name, prop_value in stored_prop_values.items():
+
+    def _make_lazy_properties(self, doc_id, doc_fold_path, doc_prop_file):
+        '''
+        Wrap a document's stored properties so they're decoded as accessed
+
+        :param doc_id: Internal Document ID
+        :param doc_fold_path: Path to the document folder
+        :param doc_prop_file: PropertyFile for the document
+        :return: LazyPropertiesV1
+        '''
+        def _decode(prop_name, prop_value):
             try:
-                prop_values[prop_name] = decode_prop_value_from_disk(
+                return decode_prop_value_from_disk(
                     stored_value = prop_value,
                     store_path = doc_fold_path,
                     store_prefix = self._calc_prop_file_prefix(prop_name),
-                    col_data_types = self.DATA_TYPES)
+                    col_data_types = self.DATA_TYPES,
+                    col_store = self.__col_store)
             except PropertyValueDecodeError, e:
                 raise PropertyValueDecodeError(
                     "Unable to decode property '%s' for document %s: %s" % (
                         prop_name, str(doc_id), str(e)))
 
-        return prop_values
+        return LazyPropertiesV1(doc_prop_file['properties'], _decode, doc_prop_file.memo)
+
+
+    def get_document_stamp(self, doc_id):
+        '''
+        Get a cheap token that changes when the document's properties change
+
+        :param doc_id: Internal Document ID
+        :return: (mtime, size) of doc.properties, or None if missing
+        '''
+        return self._calc_prop_file_stamp(self._calc_doc_prop_file_path(os.path.join(
+            self.documents_path, doc_id.domain_folder, doc_id.doc_folder)))
 
 
+    def _calc_prop_file_stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
 
     def update_properties(self, doc_id, properties):
         '''
@@ -368,6 +1329,9 @@ class DocColEngineV1(DocColEngine):
         :param doc_id: Internal Document ID
         :param properties: Dictionary of properties to set
         '''
+        # Refresh first: it reloads cached doc.properties changed outside the engine
+        self._ensure_indexes_fresh()
+
         doc_dir = os.path.join(self.documents_path, doc_id.domain_folder, doc_id.doc_folder)
         doc_props = self._get_doc_prop_file(doc_dir)
 
@@ -395,10 +1359,13 @@ class DocColEngineV1(DocColEngine):
                 saved_props[prop_name] = encode_prop_value_for_disk(
                     prop_value = prop_value,
                     store_path = doc_dir,
-                    store_prefix = self._calc_prop_file_prefix(prop_name))
+                    store_prefix = self._calc_prop_file_prefix(prop_name),
+                    col_store = self.__col_store)
 
         # Save properties
+        self._update_indexes(self._calc_doc_ref(doc_id), doc_props['properties'], saved_props)
         doc_props['properties'] = saved_props
+        self._record_doc_stamp(self._calc_doc_ref(doc_id))
 
         # Delete old values
         for value in props_to_delete:
@@ -433,14 +1400,34 @@ class DocColEngineV1(DocColEngine):
 
         :param doc_id: Internal Document ID
         '''
-        path = os.path.join(self.documents_path, doc_id.domain_folder, doc_id.doc_folder)
+        domain_path = os.path.join(self.documents_path, doc_id.domain_folder)
+        path = os.path.join(domain_path, doc_id.doc_folder)
         prop_file_path = self._calc_doc_prop_file_path(path)
+
+        # Find shared attachments to release once the folder is gone
+        blob_keys = list()
+        doc_props = self._get_doc_prop_file(path, must_exist=True)
+        if doc_props is not None:
+            self._remove_from_indexes(self._calc_doc_ref(doc_id))
+            for stored_value in doc_props['properties'].values():
+                for value in iter_stored_values(stored_value, FileAttachmentV1.type_code):
+                    if value.get('blob'):
+                        blob_keys.append(self.__col_store.blob_store.calc_blob_key(
+                            value['hash'], value.get('compression')))
+
         if os.path.exists(path):
             shutil.rmtree(path)
+        for blob_key in blob_keys:
+            self.__col_store.blob_store.release(blob_key)
 
-        # Clean cache
-        self.__doc_path_cache.remove(prop_file_path)
+        # Clean cache (and drop any saves deferred by a batch)
+        if self.__prop_file_cache.has(prop_file_path):
+            self.__prop_file_cache.get(prop_file_path).discard_changes()
+        self.__prop_file_cache.remove(prop_file_path)
         self.__doc_path_cache.remove((doc_id.domain, doc_id.doc_name))
+        self._update_doc_folder_index(domain_path, doc_id.doc_name, None)
+        self._record_doc_stamp(self._calc_doc_ref(doc_id))
+
 
 
 
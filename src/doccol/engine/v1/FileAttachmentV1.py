@@ -1,22 +1,56 @@
 import os
+import mmap
 import hashlib
 import shutil
 
 from .ModelDataTypeV1 import ModelDataTypeV1
+from ..utils.atomic_write import atomic_write, replace_file
+from ..utils.fast_copy import fast_copy_file, send_file_data, copy_file_data
+from ..utils.CompressedFile import CompressedFileReader, CompressedFileWriter, check_method
+from ..utils.chunking import iter_chunks
 
 class FileAttachmentV1(ModelDataTypeV1):
     '''A property within a document is a file'''
 
     type_code = 'attachment'
 
-    def __init__(self, attach=None):
+    COPY_BUFFER_SIZE = 1024 * 1024
+    COMPRESSED_SUFFIX = '.dcz'
+
+    def __init__(self, attach=None, buffer_size=None, sha256=False, dedup=None, filename=None,
+                 compress=None, chunked=None):
         '''
-        :param attach:  Path to the file outside the collection to be added
+        :param attach:  Path to the file outside the collection to be added, or an
+                        object with open() to read it from (like another FileAttachmentV1)
+        :param buffer_size: Bytes to read at a time when copying in (default COPY_BUFFER_SIZE)
+        :param sha256: Also calculate a SHA-256 hash when copying in
+        :param dedup: Store once in the collection blob store (None for collection setting)
+        :param filename: Original filename to record (default: name of the attach file)
+        :param compress: Store compressed with 'zlib' or 'bz2' (None for collection
+                         setting, False to store as is)
+        :param chunked: Store as content-defined chunks in the collection chunk store,
+                        shared with other attachments (None for collection setting).
+                        Not compressed or deduped as a whole file when chunked.
         '''
+        if compress:
+            check_method(compress)
+
         self.__col_path = None      # Path to file in the colelction
         self.__ext_path = attach    # Path to the file outside the collection to be added
         self.__hash = None
-        self.__orig_filename = None
+        self.__sha256 = None
+        self.__orig_filename = filename
+        self.__buffer_size = buffer_size or self.COPY_BUFFER_SIZE
+        self.__calc_sha256 = sha256
+        self.__dedup = dedup
+        self.__blob = False         # Is the file linked from the blob store?
+        self.__col_store = None
+        self.__compress = compress
+        self.__compression = None   # Method the stored file is compressed with
+        self.__size = None          # Size of the original file
+        self.__stored_size = None   # Size of the file in the collection
+        self.__chunked = chunked
+        self.__chunks = None        # Manifest: [hash, length] of each chunk (if chunked)
 
 
     @property
@@ -25,6 +59,46 @@ class FileAttachmentV1(ModelDataTypeV1):
         return self.__orig_filename
 
 
+    @property
+    def hash(self):
+        '''MD5 hex digest of the file contents'''
+        return self.__hash
+
+
+    @property
+    def sha256(self):
+        '''SHA-256 hex digest of the file contents (if calculated when stored)'''
+        return self.__sha256
+
+
+    @property
+    def size(self):
+        '''Size of the file contents'''
+        if self.__size is None and self.__col_path is not None and self.__compression is None:
+            return os.path.getsize(self.__col_path)
+        return self.__size
+
+
+    @property
+    def stored_size(self):
+        '''Size of the file in the collection (smaller than size if compressed)'''
+        if self.__stored_size is None and self.__col_path is not None:
+            return os.path.getsize(self.__col_path)
+        return self.__stored_size
+
+
+    @property
+    def compression(self):
+        '''Method the file is stored compressed with (None if not compressed)'''
+        return self.__compression
+
+
+    @property
+    def chunked(self):
+        '''Is the file stored as chunks in the collection chunk store?'''
+        return self.__chunks is not None
+
+
     def copy_to(self, path):
         '''
         Copy file out of collection
@@ -37,72 +111,322 @@ class FileAttachmentV1(ModelDataTypeV1):
         if os.path.isdir(path):
             path = os.path.join(path, self.filename)
 
-        # Copy
-        shutil.copy(self.__col_path, path)
+        # Copy (reflink or in-kernel copy where supported)
+        if self.__chunks is not None:
+            with self.open('rb') as in_fh:
+                with open(path, 'wb') as out_fh:
+                    copy_file_data(in_fh, out_fh)
+        elif self.__compression is None:
+            fast_copy_file(self.__col_path, path)
+        else:
+            with self.open('rb') as in_fh:
+                with open(path, 'wb') as out_fh:
+                    copy_file_data(in_fh, out_fh)
+            shutil.copymode(self.__col_path, path)
 
         return path
 
 
+    def send_to(self, out_fh, offset=0, length=None):
+        '''
+        Write the file's contents to an open file or socket
+
+        Uses sendfile() where available, so serving an attachment doesn't
+        copy it through Python.
+
+        :param out_fh: File or socket to write to (anything with fileno())
+        :param offset: Position in the file to start at
+        :param length: Number of bytes to send (None for the rest of the file)
+        :return: Number of bytes sent
+        '''
+        if self.__compression is not None or self.__chunks is not None:
+            with self.open('rb') as in_fh:
+                return copy_file_data(in_fh, out_fh, offset, length)
+        with open(self.__col_path, 'rb') as in_fh:
+            return send_file_data(in_fh, out_fh, offset, length)
+
+
+    def read_range(self, offset, length):
+        '''
+        Read part of the file
+
+        :param offset: Position in the file to start at
+        :param length: Max number of bytes to read
+        :return: str (shorter than length at the end of the file)
+        '''
+        with self.open('rb') as fh:
+            fh.seek(offset)
+            return fh.read(length)
+
+
+    def mmap(self):
+        '''
+        Map the file into memory read-only
+
+        Pages are read from the page cache as they're touched.  Slice it, or
+        use buffer(m, offset, size) for a view that doesn't copy (Python 2
+        mmaps can't be wrapped in a memoryview).  Close it when done.
+
+        :return: mmap.mmap (ACCESS_READ)
+        '''
+        if self.__chunks is not None:
+            raise ValueError("Can't map a chunked attachment: " + self.__orig_filename)
+        if self.__compression is not None:
+            raise ValueError("Can't map a compressed attachment: " + self.__col_path)
+        with open(self.__col_path, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                raise ValueError("Can't map an empty attachment: " + self.__col_path)
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
     def open(self, mode='r'):
         '''
         Open the file to read it's contents
 
+        Compressed files are decompressed, and chunked files reassembled, as
+        they're read (and can still be seeked).
+
         :param mode: File mode (should be read)
         :return: File handle
         '''
         if 'w' in mode or 'a' in mode or '+' in mode:
             raise Exception("Don't open collection files for writing")
+        if self.__chunks is not None:
+            if self.__col_store is None:
+                raise Exception("Chunked attachment wasn't loaded from a collection")
+            return self.__col_store.chunk_store.open(self.__chunks, self.__orig_filename)
+        if self.__compression is not None:
+            return CompressedFileReader(self.__col_path)
         return open(self.__col_path, mode)
 
 
-    def prep_for_store(self, store_path, store_prefix):
+    def prep_for_store(self, store_path, store_prefix, col_store=None):
         '''
         Prepare working value for storage
 
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: value ready to be encoded into the file storing the document properties
         '''
         # Take in new attachments
-        if self.__col_path is None:
+        if self.__col_path is None and self.__chunks is None:
             if self.__ext_path is not None:
 
-                # Calc hash
-                with open(self.__ext_path, 'rb') as fh:
-                    hasher = hashlib.md5()
-                    contents = fh.read(1024 * 1024)
-                    while contents:
-                        hasher.update(contents)
-                        contents = fh.read(1024 * 1024)
-                    self.__hash = hasher.hexdigest()
+                if self.__orig_filename is None:
+                    if isinstance(self.__ext_path, basestring):
+                        self.__orig_filename = os.path.basename(self.__ext_path)
+                    else:
+                        self.__orig_filename = self.__ext_path.filename
 
-                # Calc name to save at
-                self.__orig_filename = os.path.basename(self.__ext_path)
-                self.__col_path = self._calc_distinct_filename(
-                    store_path, store_prefix, self.__orig_filename)
+                # Split into chunks shared across the collection
+                if self._use_chunk_store(col_store):
+                    self._copy_in_chunked(col_store.chunk_store)
+                    self.__col_store = col_store
 
-                # Copy file in
-                shutil.copy(self.__ext_path, self.__col_path)
+                # Or store as a file
+                else:
+                    self.__compression = self._use_compression(col_store)
+                    stored_filename = self.__orig_filename
+                    if self.__compression is not None:
+                        stored_filename += self.COMPRESSED_SUFFIX
+                    col_path = self._calc_distinct_filename(
+                        store_path, store_prefix, stored_filename)
+
+                    if self._use_blob_store(col_store):
+                        self._copy_in_deduped(col_store, col_path)
+                    else:
+                        self._copy_in(self.__ext_path, col_path)
+                    self.__col_path = col_path
+                    self.__col_store = col_store
 
         return {
             'path': self.__col_path,
             'hash': self.__hash,
-            'filename': self.__orig_filename
+            'sha256': self.__sha256,
+            'filename': self.__orig_filename,
+            'blob': self.__blob,
+            'compression': self.__compression,
+            'size': self.__size,
+            'stored_size': self.__stored_size,
+            'chunks': self.__chunks,
         }
 
 
-    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types):
+    def _use_compression(self, col_store):
+        '''Method to compress this attachment with (or None)'''
+        if self.__compress is not None:
+            return self.__compress or None
+        if col_store is None:
+            return None
+        return col_store.compress_attachments
+
+
+    def _use_chunk_store(self, col_store):
+        '''Should this attachment be stored as chunks in the collection chunk store?'''
+        if col_store is None:
+            return False
+        if self.__chunked is not None:
+            return self.__chunked
+        return col_store.chunk_attachments
+
+
+    def _use_blob_store(self, col_store):
+        '''Should this attachment be stored in the collection blob store?'''
+        if col_store is None or not col_store.blob_store.supported:
+            return False
+        if self.__dedup is not None:
+            return self.__dedup
+        return col_store.dedup_attachments
+
+
+    def _copy_in_deduped(self, col_store, col_path):
+        '''
+        Copy a file into the blob store and link it into the document folder
+
+        Falls back to a private copy at col_path if the file can't be shared.
+
+        :param col_store: ColStoreV1 with the blob store
+        :param col_path: Path to store the file at
+        '''
+        blob_store = col_store.blob_store
+
+        incoming_path = blob_store.calc_incoming_path(self.__orig_filename)
+        self._copy_in(self.__ext_path, incoming_path)
+        blob_key = blob_store.calc_blob_key(self.__hash, self.__compression)
+
+        try:
+            blob_path = blob_store.add(incoming_path, blob_key)
+        except OSError:
+            blob_path = None
+        if blob_path is None:
+            replace_file(incoming_path, col_path)
+            return
+
+        try:
+            blob_store.link(blob_key, col_path)
+        except OSError:
+            # Too many links, or file system can't link: keep a private copy
+            fast_copy_file(blob_path, col_path)
+            blob_store.release(blob_key)
+            return
+
+        self.__blob = True
+
+
+    def _copy_in(self, ext_path, col_path):
+        '''
+        Copy a file into the collection, hashing it in the same pass
+
+        Written to a temp name and renamed into place, so a crash never leaves
+        a partial file at col_path.  Compressed as it's copied if
+        self.__compression is set.
+
+        :param ext_path: Path to the file outside the collection (or object with open())
+        :param col_path: Path to store the file at
+        '''
+        md5_hasher = hashlib.md5()
+        sha256_hasher = None
+        if self.__calc_sha256:
+            sha256_hasher = hashlib.sha256()
+
+        in_fh = self._open_ext(ext_path)
+        try:
+            with atomic_write(col_path, 'wb') as out_fh:
+                writer = out_fh
+                if self.__compression is not None:
+                    writer = CompressedFileWriter(out_fh, self.__compression)
+                size = 0
+                contents = in_fh.read(self.__buffer_size)
+                while contents:
+                    md5_hasher.update(contents)
+                    if sha256_hasher is not None:
+                        sha256_hasher.update(contents)
+                    writer.write(contents)
+                    size += len(contents)
+                    contents = in_fh.read(self.__buffer_size)
+                if self.__compression is not None:
+                    writer.finish()
+                stored_size = out_fh.tell()
+        finally:
+            in_fh.close()
+        if isinstance(ext_path, basestring):
+            shutil.copymode(ext_path, col_path)
+
+        self.__size = size
+        self.__stored_size = stored_size
+
+        self.__hash = md5_hasher.hexdigest()
+        if sha256_hasher is not None:
+            self.__sha256 = sha256_hasher.hexdigest()
+
+
+    def _copy_in_chunked(self, chunk_store):
+        '''
+        Split a file into content-defined chunks and add them to the chunk store
+
+        Only chunks the store doesn't have yet are written, so a new revision
+        of a file already in the collection costs about the size of its edits.
+
+        :param chunk_store: ChunkStoreV1
+        '''
+        md5_hasher = hashlib.md5()
+        sha256_hasher = None
+        if self.__calc_sha256:
+            sha256_hasher = hashlib.sha256()
+
+        chunks = list()
+        size = 0
+        stored_size = 0
+        in_fh = self._open_ext(self.__ext_path)
+        try:
+            for data in iter_chunks(in_fh):
+                md5_hasher.update(data)
+                if sha256_hasher is not None:
+                    sha256_hasher.update(data)
+                hash, added = chunk_store.add(data)
+                chunks.append([hash, len(data)])
+                size += len(data)
+                if added:
+                    stored_size += len(data)
+        finally:
+            in_fh.close()
+
+        self.__chunks = chunks
+        self.__size = size
+        self.__stored_size = stored_size     # Bytes of new chunks this added
+        self.__hash = md5_hasher.hexdigest()
+        if sha256_hasher is not None:
+            self.__sha256 = sha256_hasher.hexdigest()
+
+
+    def _open_ext(self, ext_path):
+        '''Open the file to take in (a path, or an object with open())'''
+        if isinstance(ext_path, basestring):
+            return open(ext_path, 'rb')
+        return ext_path.open('rb')
+
+
+    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types, col_store=None):
         '''
         Decode value prepared by prep_for_store() back to working value
 
         :param value: value from file (simple structure)
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: anything
         '''
         self.__col_path = value['path']
         self.__hash = value['hash']
+        self.__sha256 = value.get('sha256')
         self.__orig_filename = value['filename']
+        self.__blob = value.get('blob', False)
+        self.__compression = value.get('compression')
+        self.__size = value.get('size')
+        self.__stored_size = value.get('stored_size')
+        self.__chunks = value.get('chunks')
+        self.__col_store = col_store
         return self
 
 
@@ -115,3 +439,9 @@ class FileAttachmentV1(ModelDataTypeV1):
         if self.__col_path is not None:
             if os.path.exists(self.__col_path):
                 os.unlink(self.__col_path)
+
+            # Drop reference to shared copy
+            if self.__blob and self.__col_store is not None:
+                blob_store = self.__col_store.blob_store
+                blob_store.release(blob_store.calc_blob_key(self.__hash, self.__compression))
+
@@ -0,0 +1,165 @@
+import os
+
+from ..utils.LookupFile import LookupFile
+
+
+class IndexStampsV1(object):
+    '''
+    File stamps of the documents as the indexes last saw them
+
+    Documents can be added, removed, or edited without the engine (by hand,
+    or by a git pull), so the property and text indexes can go stale.  This
+    records, in index/stamps.lookup:
+
+        domain:(domain_folder)      = mtime of the domain folder
+        doc:(domain_folder)/(doc)   = [mtime, size] of doc.properties
+        complete                    = True once every document is recorded
+
+    find_changes() compares them to the files.  A domain folder whose mtime
+    hasn't changed has the same document folders, so it isn't listed again;
+    every recorded doc.properties is still stat'd, but only the documents
+    whose stamp changed need to be read.
+    '''
+
+    def __init__(self, path, durability=LookupFile.DURABILITY_OS):
+        '''
+        :param path: Path to the LookupFile to keep the stamps in
+        :param durability: LookupFile durability option for the stamps file
+        '''
+        self.__path = path
+        self.__durability = durability
+        self.__lookup = None        # LookupFile (opened on first use)
+
+
+    def _open(self):
+        if self.__lookup is None:
+            index_dir = os.path.dirname(self.__path)
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            self.__lookup = LookupFile(self.__path, durability=self.__durability)
+        return self.__lookup
+
+
+    @property
+    def complete(self):
+        '''Has every document been recorded (so unrecorded documents are new)?'''
+        return self._open().get('complete', False)
+
+
+    def record(self, doc_ref, stamp):
+        '''
+        Record the stamp of a document the indexes are up to date with
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        :param stamp: (mtime, size) of doc.properties, or None if removed
+        '''
+        lookup = self._open()
+        key = 'doc:' + doc_ref
+        if stamp is None:
+            if key in lookup:
+                del lookup[key]
+        elif lookup.get(key) != list(stamp):
+            lookup[key] = list(stamp)
+
+
+    def find_changes(self, documents_path, list_folders, calc_stamp):
+        '''
+        Find documents whose doc.properties changed since they were recorded
+
+        :param documents_path: Path to the collection's documents folder
+        :param list_folders: Called with a path to get the names of the folders in it
+        :param calc_stamp: Called with (domain_folder, doc_folder) to get the
+                           current stamp of doc.properties (None if missing)
+        :return: (list of (doc_ref, stamp or None if gone),
+                  dictionary of [domain_folder] = mtime to pass to finish())
+        '''
+        lookup = self._open()
+        complete = self.complete
+
+        recorded = dict()           # [domain_folder] = set(doc_folder)
+        for key in lookup.keys():
+            if key.startswith('doc:'):
+                domain_folder, doc_folder = key[4:].split('/', 1)
+                try:
+                    recorded[domain_folder].add(doc_folder)
+                except KeyError:
+                    recorded[domain_folder] = set([doc_folder])
+
+        domain_folders = set(recorded.keys())
+        if os.path.exists(documents_path):
+            domain_folders.update(list_folders(documents_path))
+
+        changes = list()
+        domain_mtimes = dict()
+        for domain_folder in sorted(domain_folders):
+            domain_path = os.path.join(documents_path, domain_folder)
+            known = recorded.get(domain_folder, set())
+            try:
+                mtime = os.stat(domain_path).st_mtime
+            except OSError:
+                mtime = None
+
+            # Only list the folder if documents may have been added or removed
+            if mtime is None:
+                current = set()
+            elif complete and lookup.get('domain:' + domain_folder) == mtime:
+                current = known
+            else:
+                current = set(list_folders(domain_path))
+            domain_mtimes[domain_folder] = mtime
+
+            for doc_folder in sorted(current | known):
+                doc_ref = domain_folder + '/' + doc_folder
+                stamp = None
+                if doc_folder in current:
+                    stamp = calc_stamp(domain_folder, doc_folder)
+                recorded_stamp = lookup.get('doc:' + doc_ref)
+                if stamp is None and recorded_stamp is None:
+                    continue
+                if stamp is None or recorded_stamp != list(stamp):
+                    changes.append((doc_ref, stamp))
+
+        return changes, domain_mtimes
+
+
+    def finish(self, changes, domain_mtimes):
+        '''
+        Record the changes found by find_changes() once the indexes have them
+
+        :param changes: list of (doc_ref, stamp) from find_changes()
+        :param domain_mtimes: Domain folder mtimes from find_changes()
+        '''
+        lookup = self._open()
+
+        # First time, everything is written at once
+        if not self.complete:
+            values = dict()
+            for key, value in lookup.items():
+                if key.startswith('doc:'):
+                    values[key] = value
+            for doc_ref, stamp in changes:
+                if stamp is None:
+                    values.pop('doc:' + doc_ref, None)
+                else:
+                    values['doc:' + doc_ref] = list(stamp)
+            for domain_folder, mtime in domain_mtimes.items():
+                if mtime is not None:
+                    values['domain:' + domain_folder] = mtime
+            values['complete'] = True
+            lookup.replace_all(values)
+            return
+
+        for doc_ref, stamp in changes:
+            self.record(doc_ref, stamp)
+        for domain_folder, mtime in domain_mtimes.items():
+            key = 'domain:' + domain_folder
+            if mtime is None:
+                if key in lookup:
+                    del lookup[key]
+            elif lookup.get(key) != mtime:
+                lookup[key] = mtime
+
+
+    def reset(self):
+        '''Forget every stamp (next refresh re-reads every document)'''
+        self._open().replace_all(dict())
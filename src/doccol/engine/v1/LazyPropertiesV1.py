@@ -0,0 +1,83 @@
+from collections import MutableMapping
+
+
+class LazyPropertiesV1(MutableMapping):
+    '''
+    Document properties that are only decoded when accessed
+
+    Returned by DocColEngineV1.get_document_properties().  Stored values are
+    decoded on first access and memoized in the PropertyFile's memo, which is
+    reset when the file changes.  So values are shared between callers until
+    the document is updated (change values with update_properties(), not in
+    place).
+
+    Changes made to this mapping stay local to it (safe to modify).
+    '''
+
+    def __init__(self, stored_values, decode, memo):
+        '''
+        :param stored_values: Dictionary of encoded property values (not modified)
+        :param decode: Called as decode(prop_name, stored_value) to decode a value
+        :param memo: Dictionary to keep decoded values in
+        '''
+        self.__stored = stored_values
+        self.__decode = decode
+        self.__memo = memo
+        self.__local = dict()       # Values set on this mapping
+        self.__deleted = set()      # Stored values deleted from this mapping
+
+
+    @property
+    def stored_values(self):
+        '''Encoded values the properties were read from (ignores changes made to this mapping)'''
+        return self.__stored
+
+
+    def __getitem__(self, name):
+        try:
+            return self.__local[name]
+        except KeyError:
+            pass
+        if name in self.__deleted or name not in self.__stored:
+            raise KeyError(name)
+        try:
+            return self.__memo[name]
+        except KeyError:
+            value = self.__decode(name, self.__stored[name])
+            self.__memo[name] = value
+            return value
+
+
+    def __setitem__(self, name, value):
+        self.__local[name] = value
+        self.__deleted.discard(name)
+
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.__local.pop(name, None)
+        if name in self.__stored:
+            self.__deleted.add(name)
+
+
+    def __contains__(self, name):
+        if name in self.__local:
+            return True
+        return name in self.__stored and name not in self.__deleted
+
+
+    def has_key(self, name):
+        return name in self
+
+
+    def __iter__(self):
+        for name in self.__stored:
+            if name not in self.__deleted and name not in self.__local:
+                yield name
+        for name in self.__local:
+            yield name
+
+
+    def __len__(self):
+        return len(list(iter(self)))
@@ -63,12 +63,13 @@ class ListDataV1(ModelDataTypeV1):
 
     # -- Storing ----------------------------------------------------------------------
 
-    def prep_for_store(self, store_path, store_prefix):
+    def prep_for_store(self, store_path, store_prefix, col_store=None):
         '''
         Prepare working value for storage
 
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: value ready to be encoded into the file storing the document properties
         '''
         store_values = list()
@@ -78,12 +79,13 @@ class ListDataV1(ModelDataTypeV1):
             store_values.append(encode_prop_value_for_disk(
                 prop_value = value,
                 store_path = store_path,
-                store_prefix = store_prefix))
+                store_prefix = store_prefix,
+                col_store = col_store))
 
         return store_values
 
 
-    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types):
+    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types, col_store=None):
         '''
         Decode value prepared by prep_for_store() back to working value
 
@@ -91,6 +93,7 @@ class ListDataV1(ModelDataTypeV1):
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
         :param col_data_types: Dictionary of property data type handlers in collection
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: anything
         '''
         decoded_values = list()
@@ -101,7 +104,8 @@ class ListDataV1(ModelDataTypeV1):
                 stored_value = item,
                 store_path=store_path,
                 store_prefix=store_prefix,
-                col_data_types=col_data_types))
+                col_data_types=col_data_types,
+                col_store=col_store))
 
         return ListDataV1(decoded_values)
 
@@ -11,18 +11,19 @@ class ModelDataTypeV1(object):
 
 
     @abstractmethod
-    def prep_for_store(self, store_path, store_prefix):
+    def prep_for_store(self, store_path, store_prefix, col_store=None):
         '''
         Prepare working value for storage
 
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: value ready to be encoded into the file storing the document properties
         '''
 
 
     @abstractmethod
-    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types):
+    def decode_retrieved_value(self, value, store_path, store_prefix, col_data_types, col_store=None):
         '''
         Decode value prepared by prep_for_store() back to working value
 
@@ -30,6 +31,7 @@ class ModelDataTypeV1(object):
         :param store_path: Path to directory where additional files can be written
         :param store_prefix: Prefix to apply to any file names
         :param col_data_types: Dictionary of property data type handlers in collection
+        :param col_store: ColStoreV1 with collection-wide storage (may be None)
         :return: anything
         '''
 
@@ -0,0 +1,468 @@
+import os
+import re
+import json
+from bisect import bisect_left, bisect_right
+
+from ..utils.LookupFile import LookupFile
+from ..query import Eq, In, Prefix, Range, calc_sort_key
+
+
+# Value keys that normalize_value() could change (written before it existed)
+MAYBE_UNNORMALIZED_PATTERN = re.compile(r'true|false|[.eE]')
+
+
+def normalize_value(value):
+    '''
+    Make python values that are equal (1, 1.0 and True) the same, so they
+    index under the same key
+
+    :param value: Stored property value
+    :return: Equal value with bools and whole floats as ints
+    '''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float):
+        if value == value and value not in (float('inf'), float('-inf')) and value.is_integer():
+            return int(value)
+        return value
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(key, normalize_value(item)) for key, item in value.items()])
+    return value
+
+
+class PropertyIndexV1(object):
+    '''
+    Lookup of a property's stored value to the documents that have it
+
+    Saved as a LookupFile with one key per (document, value):
+
+        (domain_folder)/(doc_folder)\t(value as json) = 1
+
+    so a change to one document appends a small segment no matter how many
+    documents share the value.  The reverse lookup (value to documents) is
+    built in memory when the file is loaded.
+
+    Values are keyed the way python compares them, so 1, 1.0 and True share
+    a key (see normalize_value()) and an index finds what a scan would.
+
+    Only properties stored as plain python values are indexed.
+    '''
+
+    kind = 'equality'
+
+    def __init__(self, prop_name, path, durability=LookupFile.DURABILITY_OS):
+        '''
+        :param prop_name: Name of the property indexed
+        :param path: Path to the LookupFile to keep the index in
+        :param durability: LookupFile durability option for the index file
+        '''
+        self.prop_name = prop_name
+        self.__lookup = LookupFile(path, durability=durability)
+        self.__refs = dict()    # [value_key] = set(doc_ref)
+        self.__doc_keys = dict()    # [doc_ref] = value_key
+        for key in list(self.__lookup.keys()):
+            doc_ref, value_key = key.split('\t', 1)
+            if MAYBE_UNNORMALIZED_PATTERN.search(value_key):
+                normalized_key = json.dumps(normalize_value(json.loads(value_key)), sort_keys=True)
+                if normalized_key != value_key:
+                    del self.__lookup[key]
+                    self.__lookup[doc_ref + '\t' + normalized_key] = 1
+                    value_key = normalized_key
+            self._add_ref(doc_ref, value_key)
+
+
+    @staticmethod
+    def calc_value_key(stored_value):
+        '''
+        Key to index a stored property value under
+
+        :param stored_value: Value created by encode_prop_value_for_disk() (or None)
+        :return: str, or None if the value can't be indexed
+        '''
+        if stored_value is None or stored_value['value_type'] != 'python':
+            return None
+        return json.dumps(normalize_value(stored_value['value']), sort_keys=True)
+
+
+    def _add_ref(self, doc_ref, value_key):
+        '''
+        :return: True if this is the first document with the value
+        '''
+        self.__doc_keys[doc_ref] = value_key
+        try:
+            self.__refs[value_key].add(doc_ref)
+            return False
+        except KeyError:
+            self.__refs[value_key] = set([doc_ref])
+            return True
+
+
+    def _remove_ref(self, doc_ref, value_key):
+        '''
+        :return: True if no documents have the value anymore
+        '''
+        if self.__doc_keys.get(doc_ref) == value_key:
+            del self.__doc_keys[doc_ref]
+        refs = self.__refs.get(value_key)
+        if refs is not None:
+            refs.discard(doc_ref)
+            if len(refs) == 0:
+                del self.__refs[value_key]
+                return True
+        return False
+
+
+    def _get_refs(self, value_key):
+        return self.__refs.get(value_key, set())
+
+
+    def update(self, doc_ref, new_stored_value):
+        '''
+        Record a document's value
+
+        The value the index had for the document is replaced, so this also
+        corrects documents that were edited by hand.
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        :param new_stored_value: Stored value now (None if not set)
+        '''
+        old_key = self.__doc_keys.get(doc_ref)
+        new_key = self.calc_value_key(new_stored_value)
+        if old_key == new_key:
+            return
+        if old_key is not None:
+            self._remove_ref(doc_ref, old_key)
+            try:
+                del self.__lookup[doc_ref + '\t' + old_key]
+            except KeyError:
+                pass
+        if new_key is not None:
+            self._add_ref(doc_ref, new_key)
+            self.__lookup[doc_ref + '\t' + new_key] = 1
+
+
+    def rebuild(self, docs):
+        '''
+        Rebuild the index from scratch
+
+        :param docs: Iterable of (doc_ref, stored_values) for every document
+        '''
+        self.start_rebuild()
+        for doc_ref, stored_values in docs:
+            self.rebuild_add(doc_ref, stored_values)
+        self.finish_rebuild()
+
+
+    def start_rebuild(self):
+        self.__refs = dict()
+        self.__doc_keys = dict()
+        self.__rebuild_values = dict()
+
+
+    def rebuild_add(self, doc_ref, stored_values):
+        value_key = self.calc_value_key(stored_values.get(self.prop_name))
+        if value_key is not None:
+            self._add_ref(doc_ref, value_key)
+            self.__rebuild_values[doc_ref + '\t' + value_key] = 1
+
+
+    def finish_rebuild(self):
+        self.__lookup.replace_all(self.__rebuild_values)
+        self.__rebuild_values = None
+
+
+    def find_refs(self, test):
+        '''
+        Find the documents that could pass a predicate
+
+        :param test: Predicate for this property
+        :return: set of doc_ref, or None if the index can't answer the predicate
+        '''
+        if isinstance(test, Eq):
+            return set(self.__refs.get(self.calc_value_key(
+                {'value_type': 'python', 'value': test.value}), set()))
+        if isinstance(test, In):
+            refs = set()
+            for value in test.values:
+                refs.update(self.__refs.get(self.calc_value_key(
+                    {'value_type': 'python', 'value': value}), set()))
+            return refs
+        return None
+
+
+    def close(self):
+        self.__lookup.close()
+
+
+class SortedPropertyIndexV1(PropertyIndexV1):
+    '''
+    Property index that also keeps values in order
+
+    On top of equality lookups, answers Range and Prefix predicates and lists
+    documents in value order (for sorting and top-k) by bisecting a sorted
+    list of the distinct values.  Only numbers and strings (ISO dates) are
+    ordered; other values are still found by equality.
+    '''
+
+    kind = 'sorted'
+
+    def __init__(self, prop_name, path, durability=LookupFile.DURABILITY_OS):
+        self.__sorted = list()      # sorted [(sort_key, value_key)]
+        super(SortedPropertyIndexV1, self).__init__(prop_name, path, durability)
+
+
+    def start_rebuild(self):
+        self.__sorted = list()
+        super(SortedPropertyIndexV1, self).start_rebuild()
+
+
+    def _add_ref(self, doc_ref, value_key):
+        is_new = super(SortedPropertyIndexV1, self)._add_ref(doc_ref, value_key)
+        if is_new:
+            sort_key = calc_sort_key(json.loads(value_key))
+            if sort_key is not None:
+                entry = (sort_key, value_key)
+                self.__sorted.insert(bisect_left(self.__sorted, entry), entry)
+        return is_new
+
+
+    def _remove_ref(self, doc_ref, value_key):
+        is_gone = super(SortedPropertyIndexV1, self)._remove_ref(doc_ref, value_key)
+        if is_gone:
+            sort_key = calc_sort_key(json.loads(value_key))
+            if sort_key is not None:
+                entry = (sort_key, value_key)
+                i = bisect_left(self.__sorted, entry)
+                if i < len(self.__sorted) and self.__sorted[i] == entry:
+                    del self.__sorted[i]
+        return is_gone
+
+
+    def _calc_bounds(self, test):
+        '''
+        Slice of the sorted values a predicate could match
+
+        :return: (start, end) or None if the index can't narrow the predicate
+        '''
+        if isinstance(test, Range):
+            start, end = 0, len(self.__sorted)
+            if test.low is not None:
+                low_key = calc_sort_key(test.low)
+                if low_key is None:
+                    return 0, 0
+                start = bisect_left(self.__sorted, (low_key, ))
+            if test.high is not None:
+                high_key = calc_sort_key(test.high)
+                if high_key is None:
+                    return 0, 0
+                end = bisect_right(self.__sorted, (high_key, u'\uffff'))
+            return start, end
+        if isinstance(test, Prefix):
+            start = bisect_left(self.__sorted, ((1, test.prefix), ))
+            end = bisect_left(self.__sorted, ((1, test.prefix + u'\uffff'), ))
+            return start, end
+        return None
+
+
+    def find_refs(self, test):
+        '''
+        Find the documents that could pass a predicate
+
+        :param test: Predicate for this property
+        :return: set of doc_ref, or None if the index can't answer the predicate
+        '''
+        bounds = self._calc_bounds(test)
+        if bounds is None:
+            return super(SortedPropertyIndexV1, self).find_refs(test)
+
+        refs = set()
+        for sort_key, value_key in self.__sorted[bounds[0]:bounds[1]]:
+            if test.matches(sort_key[1]):
+                refs.update(self._get_refs(value_key))
+        return refs
+
+
+    def iter_sorted(self, reverse=False):
+        '''
+        List documents in value order
+
+        Documents with the same value come back ordered by doc_ref.  Documents
+        with a bool value are listed with 0 and 1 (callers skip them).
+
+        :param reverse: Largest values first
+        :return: Generator of doc_ref
+        '''
+        entries = self.__sorted
+        if reverse:
+            entries = reversed(entries)
+        for sort_key, value_key in entries:
+            for doc_ref in sorted(self._get_refs(value_key), reverse=reverse):
+                yield doc_ref
+
+
+class PropertyIndexesV1(object):
+    '''
+    The secondary property indexes declared for a collection
+
+    Which properties are indexed is saved in the collection settings
+    ('indexes'), and the indexes are kept under index/props/.  The engine
+    calls update_doc() and remove_doc() as documents change.
+
+    index/ isn't kept in git, so an index file that's missing (fresh clone)
+    is rebuilt when it's opened.
+    '''
+
+    INDEX_TYPES = {
+        PropertyIndexV1.kind:           PropertyIndexV1,
+        SortedPropertyIndexV1.kind:     SortedPropertyIndexV1,
+    }
+
+    def __init__(self, index_path, settings, calc_file_prefix, iter_docs):
+        '''
+        :param index_path: Path to the collection's index folder
+        :param settings: Collection settings PropertyFile
+        :param calc_file_prefix: Called with a property name to get a safe file name
+        :param iter_docs: Called to get (doc_ref, stored_values) for every document
+        '''
+        self.__path = os.path.join(index_path, 'props')
+        self.__settings = settings
+        self.__calc_file_prefix = calc_file_prefix
+        self.__iter_docs = iter_docs
+        self.__indexes = None   # [prop_name] = PropertyIndexV1 (loaded on first use)
+
+
+    @property
+    def declared(self):
+        '''Dictionary of [prop_name] = index kind'''
+        return dict(self.__settings['indexes'] or dict())
+
+
+    def _load(self):
+        if self.__indexes is None:
+            self.__indexes = dict()
+            for prop_name, kind in self.declared.items():
+                self.__indexes[prop_name] = self._open_index(prop_name, kind)
+        return self.__indexes
+
+
+    def _calc_index_path(self, prop_name, kind):
+        return os.path.join(self.__path, '%s.%s.lookup' % (self.__calc_file_prefix(prop_name), kind))
+
+
+    def _open_index(self, prop_name, kind):
+        if not os.path.exists(self.__path):
+            os.makedirs(self.__path)
+        path = self._calc_index_path(prop_name, kind)
+        is_new = not os.path.exists(path)
+        index = self.INDEX_TYPES[kind](prop_name, path, self.__settings['index_durability'])
+        if is_new:
+            index.rebuild(self.__iter_docs())
+        return index
+
+
+    def get(self, prop_name):
+        '''
+        :param prop_name: Name of the property
+        :return: Index for the property, or None if not indexed
+        '''
+        return self._load().get(prop_name)
+
+
+    def declare(self, prop_name, kind):
+        '''
+        Start indexing a property (builds the index)
+
+        :param prop_name: Name of the property
+        :param kind: Type of index (key of INDEX_TYPES)
+        '''
+        if kind not in self.INDEX_TYPES:
+            raise KeyError("Unknown index type: " + str(kind))
+        self.drop(prop_name)
+        self._load()[prop_name] = self._open_index(prop_name, kind)
+
+        declared = self.declared
+        declared[prop_name] = kind
+        self.__settings['indexes'] = declared
+
+
+    def drop(self, prop_name):
+        '''
+        Stop indexing a property
+
+        :param prop_name: Name of the property
+        '''
+        indexes = self._load()
+        if prop_name in indexes:
+            indexes.pop(prop_name).close()
+        declared = self.declared
+        if prop_name in declared:
+            kind = declared.pop(prop_name)
+            self.__settings['indexes'] = declared
+            path = self._calc_index_path(prop_name, kind)
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+    def rebuild(self, prop_names=None):
+        '''
+        Rebuild indexes from scratch
+
+        :param prop_names: Properties to rebuild (None for all)
+        '''
+        indexes = [index for prop_name, index in self._load().items()
+                   if prop_names is None or prop_name in prop_names]
+        if len(indexes) == 0:
+            return
+
+        # One pass over the documents for all indexes
+        for index in indexes:
+            index.start_rebuild()
+        for doc_ref, stored_values in self.__iter_docs():
+            for index in indexes:
+                index.rebuild_add(doc_ref, stored_values)
+        for index in indexes:
+            index.finish_rebuild()
+
+
+    def update_doc(self, doc_ref, new_stored_values):
+        '''
+        Record a document's properties
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        :param new_stored_values: Stored properties now
+        '''
+        for prop_name, index in self._load().items():
+            index.update(doc_ref, new_stored_values.get(prop_name))
+
+
+    def remove_doc(self, doc_ref):
+        '''
+        Record a document being deleted
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        '''
+        self.update_doc(doc_ref, dict())
+
+
+    def find_refs(self, where):
+        '''
+        Use indexes to narrow down which documents could match
+
+        :param where: list of (property_name, Predicate) from compile_where()
+        :return: set of doc_ref, or None if no index could be used
+        '''
+        refs = None
+        for prop_name, test in where:
+            index = self.get(prop_name)
+            if index is None:
+                continue
+            found = index.find_refs(test)
+            if found is None:
+                continue
+            if refs is None:
+                refs = found
+            else:
+                refs &= found
+        return refs
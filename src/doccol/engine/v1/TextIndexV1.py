@@ -0,0 +1,911 @@
+import os
+import re
+import json
+import math
+import zlib
+import heapq
+import base64
+import shutil
+import struct
+import tempfile
+import itertools
+import threading
+
+from ..utils.LookupFile import LookupFile
+from ..utils.fast_copy import copy_file_data
+from ..utils.Cache import Cache
+from ..utils.atomic_write import calc_temp_path, replace_file
+from ..utils.varint import encode_varints, decode_varints
+from ..utils.text_extract import tokenize, calc_extractor_key, DEFAULT_TEXT_EXTRACTORS
+from ..exceptions import DocCollectionOperationError
+
+from prop_pickle import iter_stored_values
+from FileAttachmentV1 import FileAttachmentV1
+
+
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def encode_postings(postings):
+    '''
+    Compress a posting list
+
+    Each entry is written as (docnum delta, count, position deltas...) in
+    varints, so dense lists of small gaps take about a byte per number.
+
+    :param postings: list of (docnum, sorted positions) ordered by docnum
+    :return: str of bytes
+    '''
+    numbers = list()
+    last_docnum = 0
+    for docnum, positions in postings:
+        numbers.append(docnum - last_docnum)
+        numbers.append(len(positions))
+        last_docnum = docnum
+        last_pos = 0
+        for pos in positions:
+            numbers.append(pos - last_pos)
+            last_pos = pos
+    return encode_varints(numbers)
+
+
+def decode_postings(data, offset=0, length=None):
+    '''
+    Decode a posting list written by encode_postings()
+
+    :return: list of (docnum, positions)
+    '''
+    numbers = decode_varints(data, offset, length)
+    postings = list()
+    docnum = 0
+    i = 0
+    while i < len(numbers):
+        docnum += numbers[i]
+        count = numbers[i+1]
+        i += 2
+        positions = list()
+        pos = 0
+        for delta in numbers[i:i+count]:
+            pos += delta
+            positions.append(pos)
+        i += count
+        postings.append((docnum, positions))
+    return postings
+
+
+def _write_run(inverted, temp_dir):
+    '''
+    Save part of an index being built (see TextPostingsV1.rebuild())
+
+    :param inverted: Dictionary of [term] = list of (docnum, positions)
+    :param temp_dir: Folder to make the temporary file in
+    :return: Temporary file (positioned at the start) of the posting lists in term order
+    '''
+    fh = tempfile.TemporaryFile(dir=temp_dir)
+    try:
+        for term in sorted(inverted.keys()):
+            term_data = term.encode('utf-8')
+            packed = encode_postings(inverted[term])
+            fh.write(struct.pack('>II', len(term_data), len(packed)))
+            fh.write(term_data)
+            fh.write(packed)
+        fh.seek(0)
+    except:
+        fh.close()
+        raise
+    return fh
+
+
+def _iter_run(fh, run_num):
+    '''
+    :return: Generator of (term, run_num, packed postings) from a file _write_run() saved
+    '''
+    while True:
+        lengths = fh.read(8)
+        if not lengths:
+            return
+        term_len, packed_len = struct.unpack('>II', lengths)
+        yield fh.read(term_len).decode('utf-8'), run_num, fh.read(packed_len)
+
+
+def _merge_runs(runs):
+    '''
+    Combine the posting lists of runs saved by _write_run()
+
+    Each run holds later documents than the one before, so a term's lists
+    are joined in run order.
+
+    :param runs: list of run files
+    :return: Generator of (term, list of (docnum, positions)) in term order
+    '''
+    merged = heapq.merge(*[_iter_run(fh, run_num) for run_num, fh in enumerate(runs)])
+    for term, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+        postings = list()
+        for term, run_num, packed in entries:
+            postings.extend(decode_postings(packed))
+        yield term, postings
+
+
+def encode_forward(forward):
+    '''
+    Encode one document's words for the journal
+
+    :param forward: (length, dict of [term] = positions) or None
+    :return: json-able value
+    '''
+    if forward is None:
+        return None
+    length, terms = forward
+    term_list = sorted(terms.keys())
+    packed = encode_postings([(i, terms[term]) for i, term in enumerate(term_list)])
+    return {
+        'len': length,
+        'terms': term_list,
+        'pos': base64.b64encode(zlib.compress(packed)),
+    }
+
+
+def decode_forward(entry):
+    '''Decode a value written by encode_forward()'''
+    if entry is None:
+        return None
+    term_list = entry['terms']
+    packed = zlib.decompress(base64.b64decode(entry['pos']))
+    terms = dict()
+    for i, positions in decode_postings(packed):
+        terms[term_list[i]] = positions
+    return entry['len'], terms
+
+
+class TextPostingsV1(object):
+    '''
+    Inverted index storage: which documents have each word, and where
+
+    Kept as two files in the index folder:
+
+      postings.seg      Every term's posting list (varint delta encoded, and
+                        zlib compressed if long) for the documents as of the
+                        last merge, followed by a header locating each list.
+                        Only the header is loaded: lists are read by offset
+                        when searched.  Written atomically, so it's always
+                        whole.
+      journal.lookup    LookupFile of the documents changed since the merge
+                        ([doc_ref] = words, or None if removed).  A change is
+                        one small append.
+
+    The journal overrides the segment.  Once it holds a good fraction of the
+    documents, both are merged into a new segment.
+
+    While rebuild() runs (possibly on another thread), changes still go to
+    the journal and are also logged so they can be carried over to the
+    journal of the new segment.  Documents are inverted in memory a batch at
+    a time, and each batch saved to a temporary file to be merged into the
+    segment, so the rebuild doesn't hold the whole index in memory.
+    '''
+
+    SEGMENT_MAGIC = 'doccol-text-2'
+    OLD_SEGMENT_MAGICS = ('doccol-text-1', )   # Readable only by rebuilding
+    HEADER_LINE_WIDTH = 40              # Line holding the header location (filled in last)
+    POSTINGS_COMPRESS_MIN = 256         # Compress posting lists at least this long
+    REBUILD_BATCH_POSITIONS = 1000000   # Positions inverted in memory before saving a run
+    MERGE_MIN_DOCS = 256        # Don't merge for fewer changed documents than this
+    MERGE_RATIO = 0.25          # Merge when journal has this fraction of documents
+
+    def __init__(self, path, durability=LookupFile.DURABILITY_OS):
+        '''
+        :param path: Folder to keep the index files in
+        :param durability: LookupFile durability option for the journal
+        '''
+        self.__path = path
+        self.__lock = threading.RLock()
+        self.__rebuild_lock = threading.Lock()
+        self.__rebuild_log = None           # [doc_ref] = forward while rebuilding
+        self.__segment_fh = None
+
+        self._load_segment()
+
+        self.__overlay = dict()             # [doc_ref] = (length, terms) or None if removed
+        self.__overlay_terms = dict()       # [term] = set(doc_ref) in overlay
+        self.__journal = LookupFile(os.path.join(self.__path, 'journal.lookup'), durability=durability)
+        for doc_ref, entry in self.__journal.items():
+            self._set_overlay(doc_ref, decode_forward(entry))
+
+
+    @property
+    def segment_path(self):
+        return os.path.join(self.__path, 'postings.seg')
+
+
+    # -- Segment -------------------------------------------------------------
+
+    @property
+    def needs_rebuild(self):
+        '''Is there no segment (or only one in an old format)?'''
+        return self.__segment_fh is None
+
+
+    def _load_segment(self):
+        self.__base_refs = list()           # [docnum] = doc_ref
+        self.__base_lens = list()           # [docnum] = number of words
+        self.__base_nums = dict()           # [doc_ref] = docnum
+        self.__base_terms = dict()          # [term] = (offset, length, compressed) in the segment
+        self.__doc_count = 0
+        self.__total_len = 0
+        if self.__segment_fh is not None:
+            self.__segment_fh.close()
+            self.__segment_fh = None
+
+        if not os.path.exists(self.segment_path):
+            return
+
+        fh = open(self.segment_path, 'rb')
+        try:
+            magic = fh.readline().strip()
+            if magic in self.OLD_SEGMENT_MAGICS:
+                fh.close()
+                return
+            if magic != self.SEGMENT_MAGIC:
+                raise DocCollectionOperationError("Not a text index segment: " + self.segment_path)
+            header_offset, header_len = [int(n) for n in fh.readline().split()]
+            fh.seek(header_offset)
+            header = json.loads(zlib.decompress(fh.read(header_len)))
+        except:
+            fh.close()
+            raise
+        self.__segment_fh = fh
+
+        for docnum, (doc_ref, length) in enumerate(header['docs']):
+            self.__base_refs.append(doc_ref)
+            self.__base_lens.append(length)
+            self.__base_nums[doc_ref] = docnum
+            self.__total_len += length
+        self.__doc_count = len(self.__base_refs)
+        for term, offset, length, compressed in header['terms']:
+            self.__base_terms[term] = (offset, length, compressed)
+
+
+    def _write_segment(self, doc_lens, term_postings):
+        '''
+        Save a new segment next to the current one (see _install_segment())
+
+        :param doc_lens: list of (doc_ref, number of words) in docnum order
+        :param term_postings: Iterable of (term, list of (docnum, positions)) in term order
+        :return: Path to the new segment file
+        '''
+        tmp_path = calc_temp_path(self.segment_path)
+        terms = list()
+        try:
+            with open(tmp_path, 'wb') as fh:
+                fh.write(self.SEGMENT_MAGIC + '\n')
+                header_line_offset = fh.tell()
+                fh.write(' ' * self.HEADER_LINE_WIDTH + '\n')
+
+                offset = fh.tell()
+                for term, postings in term_postings:
+                    packed = encode_postings(postings)
+                    compressed = len(packed) >= self.POSTINGS_COMPRESS_MIN
+                    if compressed:
+                        packed = zlib.compress(packed)
+                    fh.write(packed)
+                    terms.append((term, offset, len(packed), compressed))
+                    offset += len(packed)
+
+                header = zlib.compress(json.dumps({
+                    'docs': doc_lens,
+                    'terms': terms,
+                }))
+                fh.write(header)
+                fh.seek(header_line_offset)
+                fh.write('%d %d' % (offset, len(header)))
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return tmp_path
+
+
+    def _install_segment(self, new_path):
+        '''
+        Replace the segment with one from _write_segment() and load it (hold __lock)
+
+        The old segment is closed first, since Windows can't replace an open file.
+
+        :param new_path: Path to the new segment file
+        '''
+        if self.__segment_fh is not None:
+            self.__segment_fh.close()
+            self.__segment_fh = None
+        try:
+            replace_file(new_path, self.segment_path)
+        except:
+            if os.path.exists(new_path):
+                os.unlink(new_path)
+            raise
+        finally:
+            self._load_segment()
+
+
+    def _read_base_postings(self, term):
+        '''
+        :return: list of (docnum, positions) for a term in the segment
+        '''
+        loc = self.__base_terms.get(term)
+        if loc is None:
+            return list()
+        offset, length, compressed = loc
+        self.__segment_fh.seek(offset)
+        packed = self.__segment_fh.read(length)
+        if compressed:
+            packed = zlib.decompress(packed)
+        return decode_postings(packed)
+
+
+    def _iter_base_postings(self, term):
+        for docnum, positions in self._read_base_postings(term):
+            yield self.__base_refs[docnum], positions
+
+
+    # -- Changes -------------------------------------------------------------
+
+    def _get_doc_length(self, doc_ref):
+        '''Number of words in a document (None if not in the index)'''
+        if doc_ref in self.__overlay:
+            forward = self.__overlay[doc_ref]
+            if forward is None:
+                return None
+            return forward[0]
+        docnum = self.__base_nums.get(doc_ref)
+        if docnum is None:
+            return None
+        return self.__base_lens[docnum]
+
+
+    def _set_overlay(self, doc_ref, forward):
+        # Take out old version
+        old_len = self._get_doc_length(doc_ref)
+        if old_len is not None:
+            self.__doc_count -= 1
+            self.__total_len -= old_len
+        old_forward = self.__overlay.get(doc_ref)
+        if old_forward is not None:
+            for term in old_forward[1]:
+                refs = self.__overlay_terms[term]
+                refs.discard(doc_ref)
+                if len(refs) == 0:
+                    del self.__overlay_terms[term]
+
+        # Put in new
+        if forward is None and doc_ref not in self.__base_nums:
+            self.__overlay.pop(doc_ref, None)
+            return
+        self.__overlay[doc_ref] = forward
+        if forward is not None:
+            self.__doc_count += 1
+            self.__total_len += forward[0]
+            for term in forward[1]:
+                try:
+                    self.__overlay_terms[term].add(doc_ref)
+                except KeyError:
+                    self.__overlay_terms[term] = set([doc_ref])
+
+
+    def set_doc(self, doc_ref, forward):
+        '''
+        Record a document's words
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        :param forward: (number of words, dict of [term] = positions), or None to remove
+        '''
+        with self.__lock:
+            self._set_overlay(doc_ref, forward)
+            if doc_ref in self.__overlay:
+                self.__journal[doc_ref] = encode_forward(forward)
+            else:
+                self.__journal.pop(doc_ref, None)
+            if self.__rebuild_log is not None:
+                self.__rebuild_log[doc_ref] = forward
+            else:
+                self._merge_if_needed()
+
+
+    def _merge_if_needed(self):
+        changed = len(self.__overlay)
+        if changed >= self.MERGE_MIN_DOCS and changed >= self.MERGE_RATIO * len(self.__base_refs):
+            self.merge()
+
+
+    def merge(self):
+        '''Fold the journal into a new segment'''
+        with self.__lock:
+            if self.__rebuild_log is not None:
+                return      # The rebuild replaces the segment anyway
+
+            # Documents left in the segment keep their order, changed ones go after
+            renumber = dict()           # [old docnum] = new docnum
+            doc_lens = list()
+            for docnum, doc_ref in enumerate(self.__base_refs):
+                if doc_ref not in self.__overlay:
+                    renumber[docnum] = len(doc_lens)
+                    doc_lens.append((doc_ref, self.__base_lens[docnum]))
+            overlay_nums = dict()       # [doc_ref] = new docnum
+            for doc_ref in sorted(self.__overlay.keys()):
+                forward = self.__overlay[doc_ref]
+                if forward is not None:
+                    overlay_nums[doc_ref] = len(doc_lens)
+                    doc_lens.append((doc_ref, forward[0]))
+
+            def _iter_term_postings():
+                for term in sorted(set(self.__base_terms.keys()) | set(self.__overlay_terms.keys())):
+                    postings = [(renumber[docnum], positions)
+                                for docnum, positions in self._read_base_postings(term)
+                                if docnum in renumber]
+                    postings.extend(sorted([(overlay_nums[doc_ref], self.__overlay[doc_ref][1][term])
+                                            for doc_ref in self.__overlay_terms.get(term, ())]))
+                    if len(postings) > 0:
+                        yield term, postings
+
+            self._install_segment(self._write_segment(doc_lens, _iter_term_postings()))
+            self.__overlay = dict()
+            self.__overlay_terms = dict()
+            self.__journal.replace_all(dict())
+
+
+    def _invert_to_runs(self, docs):
+        '''
+        Invert documents into posting lists, saved in runs of REBUILD_BATCH_POSITIONS
+
+        :param docs: Iterable of (doc_ref, forward)
+        :return: (list of (doc_ref, number of words) in docnum order, list of run files)
+        '''
+        doc_lens = list()
+        runs = list()
+        try:
+            inverted = dict()       # [term] = list of (docnum, positions)
+            batch_positions = 0
+            for doc_ref, forward in docs:
+                docnum = len(doc_lens)
+                doc_lens.append((doc_ref, forward[0]))
+                for term, positions in forward[1].items():
+                    try:
+                        inverted[term].append((docnum, positions))
+                    except KeyError:
+                        inverted[term] = [(docnum, positions)]
+                    batch_positions += len(positions)
+                if batch_positions >= self.REBUILD_BATCH_POSITIONS:
+                    runs.append(_write_run(inverted, self.__path))
+                    inverted = dict()
+                    batch_positions = 0
+            if len(inverted) > 0:
+                runs.append(_write_run(inverted, self.__path))
+        except:
+            for fh in runs:
+                fh.close()
+            raise
+        return doc_lens, runs
+
+
+    def rebuild(self, docs):
+        '''
+        Replace the index with the given documents
+
+        Safe to run on a background thread: searches use the old index until
+        the new one is saved, and changes made meanwhile are carried over.
+
+        :param docs: Iterable of (doc_ref, forward) for every document with words
+        '''
+        with self.__rebuild_lock:
+            with self.__lock:
+                self.__rebuild_log = dict()
+            try:
+                doc_lens, runs = self._invert_to_runs(docs)
+                try:
+                    new_path = self._write_segment(doc_lens, _merge_runs(runs))
+                finally:
+                    for fh in runs:
+                        fh.close()
+            except:
+                with self.__lock:
+                    self.__rebuild_log = None
+                raise
+
+            # Changes made during the scan override what it read
+            with self.__lock:
+                changed = self.__rebuild_log
+                self.__rebuild_log = None
+                self._install_segment(new_path)
+                self.__overlay = dict()
+                self.__overlay_terms = dict()
+                for doc_ref, forward in changed.items():
+                    self._set_overlay(doc_ref, forward)
+                self.__journal.replace_all(dict([
+                    (doc_ref, encode_forward(forward)) for doc_ref, forward in self.__overlay.items()]))
+                self._merge_if_needed()
+
+
+    # -- Reading -------------------------------------------------------------
+
+    def get_postings(self, term):
+        '''
+        :param term: Token to look up
+        :return: Dictionary of [doc_ref] = positions of the term
+        '''
+        with self.__lock:
+            postings = dict()
+            for doc_ref, positions in self._iter_base_postings(term):
+                if doc_ref not in self.__overlay:
+                    postings[doc_ref] = positions
+            for doc_ref in self.__overlay_terms.get(term, ()):
+                postings[doc_ref] = self.__overlay[doc_ref][1][term]
+            return postings
+
+
+    def get_doc_length(self, doc_ref):
+        with self.__lock:
+            return self._get_doc_length(doc_ref)
+
+
+    @property
+    def stats(self):
+        '''(number of documents, average words per document)'''
+        with self.__lock:
+            if self.__doc_count == 0:
+                return 0, 0.0
+            return self.__doc_count, float(self.__total_len) / self.__doc_count
+
+
+    def close(self):
+        with self.__lock:
+            self.__journal.close()
+            if self.__segment_fh is not None:
+                self.__segment_fh.close()
+                self.__segment_fh = None
+
+
+class TextIndexV1(object):
+    '''
+    Full-text search over string properties and attachment contents
+
+    Which properties are indexed is saved in the collection settings
+    ('text_index').  String values (also inside lists and dicts) are split
+    into words; attachments contribute their filename and, if an extractor
+    is registered for the file extension, their text.  The engine calls
+    update_doc() and remove_doc() as documents change.
+
+    Searches need every word and quoted phrase to be present, and rank the
+    documents with BM25.
+    '''
+
+    EXTRACT_CACHE_SIZE = 256
+
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self, index_path, settings, iter_docs, col_store=None):
+        '''
+        :param index_path: Path to the collection's index folder
+        :param settings: Collection settings PropertyFile
+        :param iter_docs: Called to get (doc_ref, stored_values) for every document
+                          (with cache=False when called from the rebuild thread,
+                          so it mustn't touch the engine's caches)
+        :param col_store: ColStoreV1 (to read chunked attachments)
+        '''
+        self.__path = os.path.join(index_path, 'text')
+        self.__settings = settings
+        self.__iter_docs = iter_docs
+        self.__col_store = col_store
+        self.__postings = None      # TextPostingsV1 (loaded on first use)
+        self.__load_lock = threading.Lock()
+        self.__extract_cache = Cache(self.EXTRACT_CACHE_SIZE)  # [(hash, ext)] = tokens
+
+        # [extension] = callable(path) returning the text of an attachment
+        self.extractors = dict(DEFAULT_TEXT_EXTRACTORS)
+
+
+    @property
+    def config(self):
+        '''Text index settings, or None if there is no text index'''
+        return self.__settings['text_index']
+
+
+    def _load(self):
+        if self.config is None:
+            return None
+        with self.__load_lock:
+            if self.__postings is None:
+                if not os.path.exists(self.__path):
+                    os.makedirs(self.__path)
+                postings = TextPostingsV1(self.__path, self.__settings['index_durability'])
+                if postings.needs_rebuild:
+                    postings.rebuild(self._iter_forward_docs())
+                self.__postings = postings
+        return self.__postings
+
+
+    def _close(self):
+        with self.__load_lock:
+            if self.__postings is not None:
+                self.__postings.close()
+                self.__postings = None
+
+
+    def declare(self, prop_names=None, attachments=True):
+        '''
+        Start (or reconfigure) the text index and build it
+
+        :param prop_names: Properties to index (None for every property)
+        :param attachments: Index the text of attachment files
+        '''
+        self.drop()
+        self.__settings['text_index'] = {
+            'props': sorted(prop_names) if prop_names is not None else None,
+            'attachments': attachments,
+        }
+        self._load()
+
+
+    def drop(self):
+        '''Stop indexing text'''
+        self._close()
+        if self.config is not None:
+            self.__settings['text_index'] = None
+        if os.path.exists(self.__path):
+            shutil.rmtree(self.__path)
+
+
+    def rebuild(self, background=False):
+        '''
+        Rebuild the text index from the documents
+
+        :param background: Rebuild on a new thread (searches keep using the old index)
+        :return: The threading.Thread if background, else None
+        '''
+        postings = self._load()
+        if postings is None:
+            return None
+        if background:
+            thread = threading.Thread(
+                target = postings.rebuild,
+                args = (self._iter_forward_docs(cache=False), ),
+                name = 'doccol text index rebuild')
+            thread.start()
+            return thread
+        postings.rebuild(self._iter_forward_docs())
+        return None
+
+
+    # -- Words -------------------------------------------------------------
+
+    def _is_indexed(self, prop_name):
+        prop_names = self.config['props']
+        return prop_names is None or prop_name in prop_names
+
+
+    def _calc_forward(self, stored_values):
+        '''
+        Find the words in a document
+
+        Positions skip one between values so phrases don't match across them.
+
+        :param stored_values: Dictionary of values created by encode_prop_value_for_disk()
+        :return: (number of words, dict of [term] = positions), or None if no words
+        '''
+        terms = dict()
+        pos = 0
+        length = 0
+        for prop_name in sorted(stored_values.keys()):
+            if not self._is_indexed(prop_name):
+                continue
+            for tokens in self._iter_value_tokens(stored_values[prop_name]):
+                for token in tokens:
+                    try:
+                        terms[token].append(pos)
+                    except KeyError:
+                        terms[token] = [pos]
+                    pos += 1
+                pos += 1
+                length += len(tokens)
+        if length == 0:
+            return None
+        return length, terms
+
+
+    def _iter_value_tokens(self, stored_value):
+        '''List the words of each string or attachment in a stored value'''
+        for value in iter_stored_values(stored_value, 'python'):
+            for text in _iter_strings(value):
+                yield tokenize(text)
+        if self.config['attachments']:
+            for value in iter_stored_values(stored_value, 'attachment'):
+                if value.get('filename'):
+                    yield tokenize(value['filename'])
+                yield self._extract_attachment_tokens(value)
+
+
+    def _extract_attachment_tokens(self, value):
+        '''
+        Words in an attachment file (cached by hash, as the same file is seen
+        again every time its document changes)
+        '''
+        ext = calc_extractor_key(value.get('filename') or value['path'] or '')
+        extractor = self.extractors.get(ext)
+        if extractor is None:
+            return list()
+
+        cache_key = (value.get('hash'), ext)
+        if value.get('hash') is not None and self.__extract_cache.has(cache_key):
+            return self.__extract_cache.get(cache_key)
+
+        try:
+            if value.get('compression') is None and value.get('chunks') is None:
+                text = extractor(value['path'])
+            else:
+                text = self._extract_from_copy(extractor, value, ext)
+        except Exception, e:
+            print "WARNING: Failed to extract text from %s: %s" % (
+                value.get('path') or value.get('filename'), str(e))
+            return list()
+        tokens = tokenize(text or '')
+
+        if value.get('hash') is not None:
+            self.__extract_cache.add(cache_key, tokens)
+        return tokens
+
+
+    def _extract_from_copy(self, extractor, value, ext):
+        '''Run an extractor on a compressed or chunked attachment (copied out to a temp file)'''
+        attachment = FileAttachmentV1().decode_retrieved_value(value, None, None, None, self.__col_store)
+        fd, tmp_path = tempfile.mkstemp(suffix=ext)
+        try:
+            with os.fdopen(fd, 'wb') as out_fh:
+                with attachment.open('rb') as in_fh:
+                    copy_file_data(in_fh, out_fh)
+            return extractor(tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+
+    def _iter_forward_docs(self, cache=True):
+        for doc_ref, stored_values in self.__iter_docs(cache=cache):
+            forward = self._calc_forward(stored_values)
+            if forward is not None:
+                yield doc_ref, forward
+
+
+    def _select_indexed(self, stored_values):
+        return dict([(prop_name, value) for prop_name, value in stored_values.items()
+                     if self._is_indexed(prop_name)])
+
+
+    def update_doc(self, doc_ref, old_stored_values, new_stored_values):
+        '''
+        Record a document's properties changing
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        :param old_stored_values: Stored properties before
+        :param new_stored_values: Stored properties after
+        '''
+        postings = self._load()
+        if postings is None:
+            return
+        if self._select_indexed(old_stored_values) == self._select_indexed(new_stored_values):
+            return
+        postings.set_doc(doc_ref, self._calc_forward(new_stored_values))
+
+
+    def replace_doc(self, doc_ref, stored_values):
+        '''
+        Re-index a document (without knowing what the index had for it)
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        :param stored_values: Stored properties now
+        '''
+        postings = self._load()
+        if postings is not None:
+            postings.set_doc(doc_ref, self._calc_forward(stored_values))
+
+
+    def remove_doc(self, doc_ref):
+        '''
+        Record a document being deleted
+
+        :param doc_ref: (domain_folder)/(doc_folder)
+        '''
+        postings = self._load()
+        if postings is not None:
+            postings.set_doc(doc_ref, None)
+
+
+    # -- Searching -----------------------------------------------------------
+
+    def _parse_query(self, text):
+        '''
+        :return: list of token lists (one token for words, more for phrases)
+        '''
+        clauses = list()
+        for phrase, word in QUERY_PATTERN.findall(text):
+            tokens = tokenize(phrase or word)
+            if len(tokens) > 0:
+                clauses.append(tokens)
+        return clauses
+
+
+    def search(self, text, ref_prefix=None, limit=None):
+        '''
+        Find documents containing every word and "quoted phrase" in text
+
+        :param text: Search query
+        :param ref_prefix: Only consider doc_refs starting with this (a domain folder + '/')
+        :param limit: Max number of results
+        :return: list of (doc_ref, score), best first
+        '''
+        postings = self._load()
+        if postings is None:
+            raise DocCollectionOperationError("Collection has no text index (see declare_text_index())")
+
+        clauses = self._parse_query(text)
+        if len(clauses) == 0:
+            return list()
+
+        # Documents with every term
+        term_postings = dict()
+        candidates = None
+        for term in set([token for clause in clauses for token in clause]):
+            term_postings[term] = postings.get_postings(term)
+            refs = set(term_postings[term].keys())
+            if ref_prefix is not None:
+                refs = set([doc_ref for doc_ref in refs if doc_ref.startswith(ref_prefix)])
+            if candidates is None:
+                candidates = refs
+            else:
+                candidates &= refs
+            if len(candidates) == 0:
+                return list()
+
+        # Phrases need the words one after the other
+        for clause in clauses:
+            if len(clause) > 1:
+                candidates = set([doc_ref for doc_ref in candidates
+                                  if _has_phrase(term_postings, clause, doc_ref)])
+
+        # Rank
+        doc_count, avg_len = postings.stats
+        scored = list()
+        for doc_ref in candidates:
+            doc_len = postings.get_doc_length(doc_ref) or 0
+            score = 0.0
+            for term, term_refs in term_postings.items():
+                tf = len(term_refs[doc_ref])
+                idf = math.log(1 + (doc_count - len(term_refs) + 0.5) / (len(term_refs) + 0.5))
+                norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * doc_len / max(avg_len, 1.0))
+                score += idf * tf * (self.BM25_K1 + 1) / (tf + norm)
+            scored.append((-score, doc_ref))
+
+        if limit is not None:
+            scored = heapq.nsmallest(limit, scored)
+        else:
+            scored.sort()
+        return [(doc_ref, -neg_score) for neg_score, doc_ref in scored]
+
+
+def _iter_strings(value):
+    '''Strings in a plain python value (recursing into lists and dicts)'''
+    if isinstance(value, basestring):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for text in _iter_strings(item):
+                yield text
+    elif isinstance(value, dict):
+        for item in value.values():
+            for text in _iter_strings(item):
+                yield text
+
+
+def _has_phrase(term_postings, phrase, doc_ref):
+    '''Do the phrase's words appear one after the other in the document?'''
+    starts = set(term_postings[phrase[0]][doc_ref])
+    for i, term in enumerate(phrase[1:], 1):
+        starts &= set([pos - i for pos in term_postings[term][doc_ref]])
+        if len(starts) == 0:
+            return False
+    return True
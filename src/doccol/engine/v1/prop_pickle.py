@@ -1,7 +1,7 @@
 from ..exceptions import PropertyValueDecodeError
 
 
-def encode_prop_value_for_disk(prop_value, store_path, store_prefix):
+def encode_prop_value_for_disk(prop_value, store_path, store_prefix, col_store=None):
     '''
     Helper method to convert assigned document property to save
 
@@ -17,13 +17,16 @@ def encode_prop_value_for_disk(prop_value, store_path, store_prefix):
     :param store_prefix:
         Prefix to apply to any file names
 
+    :param col_store:
+        ColStoreV1 with collection-wide storage (may be None)
+
     :return: Dictionary to pickle to disk
     '''
 
     # See if this value is a Model Data Type with store and retrieve handlers
     if hasattr(prop_value, 'type_code') and hasattr(prop_value, 'prep_for_store'):
         value_type = prop_value.type_code
-        store_value = prop_value.prep_for_store(store_path, store_prefix)
+        store_value = prop_value.prep_for_store(store_path, store_prefix, col_store)
 
     # Else, store basic Python value
     else:
@@ -38,7 +41,7 @@ def encode_prop_value_for_disk(prop_value, store_path, store_prefix):
 
 
 
-def decode_prop_value_from_disk(stored_value, store_path, store_prefix, col_data_types):
+def decode_prop_value_from_disk(stored_value, store_path, store_prefix, col_data_types, col_store=None):
     '''
     Reverse _prep_properties_for_store()
 
@@ -51,6 +54,9 @@ def decode_prop_value_from_disk(stored_value, store_path, store_prefix, col_data
     :param col_data_types:
         Dictionary of data types supported by the document collection engine
 
+    :param col_store:
+        ColStoreV1 with collection-wide storage (may be None)
+
     :return: Value to return as property value (may be ModelDataTypeV1)
     '''
 
@@ -85,4 +91,52 @@ def decode_prop_value_from_disk(stored_value, store_path, store_prefix, col_data
         value = stored_value['value'],
         store_path = store_path,
         store_prefix = store_prefix,
-        col_data_types = col_data_types)
\ No newline at end of file
+        col_data_types = col_data_types,
+        col_store = col_store)
+
+
+
+def iter_stored_values(stored_value, type_code):
+    '''
+    Find values of a type in an encoded property value (without decoding it)
+
+    Recurses into stored list and dict values.
+
+    :param stored_value: Value created by encode_prop_value_for_disk()
+    :param type_code: Type code to look for (ex: 'attachment')
+    :return: Generator of the stored values (the 'value' of each match)
+    '''
+    prop_value_type_code = stored_value['value_type']
+    if prop_value_type_code == type_code:
+        yield stored_value['value']
+    elif prop_value_type_code == 'list':
+        for item in stored_value['value']:
+            for value in iter_stored_values(item, type_code):
+                yield value
+    elif prop_value_type_code == 'dict':
+        for item in stored_value['value'].values():
+            for value in iter_stored_values(item, type_code):
+                yield value
+
+
+
+def stored_values_match(stored_values, where):
+    '''
+    Test encoded document properties against predicates (without decoding)
+
+    Only properties stored as plain python values can match.
+
+    :param stored_values: Dictionary of values created by encode_prop_value_for_disk()
+    :param where: list of (property_name, Predicate) from compile_where()
+    :return: True if every predicate passes
+    '''
+    for prop_name, test in where:
+        try:
+            stored_value = stored_values[prop_name]
+        except KeyError:
+            return False
+        if stored_value['value_type'] != 'python':
+            return False
+        if not test.matches(stored_value['value']):
+            return False
+    return True
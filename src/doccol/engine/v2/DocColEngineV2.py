@@ -0,0 +1,77 @@
+import os
+import copy
+import shutil
+
+from ..exceptions import DocCollectionOperationError
+from ..utils.PropertyFile import PropertyFile
+from ..utils.BinaryPropertyFile import BinaryPropertyFile
+from ..utils.atomic_write import atomic_write
+
+from ..v1.DocColEngineV1 import DocColEngineV1
+from ..v1.FileAttachmentV1 import FileAttachmentV1
+from ..v1.prop_pickle import iter_stored_values
+
+
+class DocColEngineV2(DocColEngineV1):
+    '''
+    Version 1 layout with document properties saved in a compact binary format
+
+    Everything works as in version 1 (same folders, data types, indexes),
+    but each document's properties are kept in doc.bin (see
+    BinaryPropertyFile) instead of doc.properties JSON.  That's faster to load
+    and save, but not editable by hand or mergeable in git.  Use export_v1()
+    to get a version 1 copy of the collection.
+    '''
+
+    DOC_PROP_FILE_NAME = 'doc.bin'
+    DOC_PROP_FILE_CLASS = BinaryPropertyFile
+
+
+    def export_v1(self, dest_path):
+        '''
+        Write a copy of the collection in the version 1 (JSON) format
+
+        Indexes aren't copied (they're rebuilt when the copy is opened), and
+        attachments shared through the blob store are copied into each
+        document that uses them.
+
+        :param dest_path: Folder to create the copy in (must not exist)
+        '''
+        src_path = os.path.dirname(self.documents_path)
+        if os.path.exists(dest_path):
+            raise DocCollectionOperationError("Export destination already exists: " + dest_path)
+
+        def _ignore(folder, names):
+            ignored = [name for name in names
+                       if name == self.DOC_PROP_FILE_NAME or name.endswith('.tmp')]
+            if os.path.abspath(folder) == os.path.abspath(src_path):
+                ignored += [name for name in names if name in ('index', 'blobs', 'VERSION')]
+            return ignored
+
+        # Copies domain folders, attachments, and collection settings
+        shutil.copytree(src_path, dest_path, ignore=_ignore)
+
+        for doc_id, doc_props, stamp in self._iter_docs(None, workers=8):
+            doc_dir = os.path.join(dest_path, 'documents', doc_id.domain_folder, doc_id.doc_folder)
+
+            # Attachments are now in the copy, and not linked from blobs/
+            # (chunked attachments stay in the copied chunks/ folder)
+            properties = copy.deepcopy(doc_props['properties'])
+            for stored_value in properties.values():
+                for value in iter_stored_values(stored_value, FileAttachmentV1.type_code):
+                    if value.get('path') is None:
+                        continue
+                    value['path'] = os.path.join(doc_dir, os.path.basename(value['path']))
+                    value['blob'] = False
+
+            out = PropertyFile(os.path.join(doc_dir, DocColEngineV1.DOC_PROP_FILE_NAME))
+            out.def_property('name')
+            out.def_property('properties')
+            out.update({
+                'name': doc_props['name'],
+                'properties': properties,
+            })
+
+        # Written last, so a partial copy isn't taken for a collection
+        with atomic_write(os.path.join(dest_path, 'VERSION')) as fh:
+            print >>fh, "1"
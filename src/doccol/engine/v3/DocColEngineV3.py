@@ -0,0 +1,1043 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from ..DocColEngine import DocColEngine
+from ..DoccumentId import DocumentId
+from ..utils.PropertyFile import PropertyFile
+from ..utils.LookupFile import LookupFile
+from ..exceptions import PropertyValueDecodeError
+from ..query import Eq, In, Prefix, Range, compile_where, calc_sort_key
+
+from ..v1.DocColEngineV1 import DocColEngineV1, sanitize_folder_name
+from ..v1.ModelDataTypeV1 import safe_del_prop_value
+from ..v1.FileAttachmentV1 import FileAttachmentV1
+from ..v1.ColStoreV1 import ColStoreV1
+from ..v1.LazyPropertiesV1 import LazyPropertiesV1
+from ..v1.TextIndexV1 import TextIndexV1
+from ..v1.prop_pickle import encode_prop_value_for_disk, decode_prop_value_from_disk
+from ..v1.prop_pickle import iter_stored_values, stored_values_match
+
+
+DOCS_PER_ATTACHMENT_FOLDER = 1000
+SQLITE_INT_RANGE = (-2**63, 2**63 - 1)
+LIST_CHUNK_SIZE = 500
+BULK_CHUNK_SIZE = 256
+
+INDEX_KINDS = ('equality', 'sorted')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS domains (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS docs (
+    id          INTEGER PRIMARY KEY,
+    domain_id   INTEGER NOT NULL REFERENCES domains(id),
+    name        TEXT NOT NULL,
+    stamp       INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (domain_id, name)
+);
+CREATE TABLE IF NOT EXISTS props (
+    doc_id      INTEGER NOT NULL REFERENCES docs(id),
+    name        TEXT NOT NULL,
+    value_type  TEXT NOT NULL,
+    value       TEXT,
+    sort_value,
+    PRIMARY KEY (doc_id, name)
+);
+'''
+
+
+class V3DocumentId(DocumentId):
+    def __init__(self, domain, domain_key, name, doc_key):
+        self.__domain = domain
+        self.__domain_key = domain_key
+        self.__doc_name = name
+        self.__doc_key = doc_key
+    @property
+    def domain(self):
+        return self.__domain
+    @property
+    def domain_key(self):
+        return self.__domain_key
+    @property
+    def name(self):
+        return self.__doc_name
+    @property
+    def doc_name(self):
+        return self.__doc_name
+    @property
+    def doc_key(self):
+        return self.__doc_key
+    def __str__(self):
+        return "%d/%d (%s)" % (self.domain_key, self.doc_key, self.doc_name)
+
+
+def calc_sort_value(stored_value):
+    '''
+    Value to put in the sort_value column so SQL can test and order by it
+
+    :param stored_value: Value created by encode_prop_value_for_disk()
+    :return: number or string, or None if the value can't be ordered
+    '''
+    if stored_value['value_type'] != 'python':
+        return None
+    sort_key = calc_sort_key(stored_value['value'])
+    if sort_key is None:
+        return None
+    return _to_sql_value(sort_key[1])
+
+
+def _to_sql_value(value):
+    '''SQLite integers are 64 bit: store bigger ones as (approximate) floats'''
+    if isinstance(value, (int, long)) and not SQLITE_INT_RANGE[0] <= value <= SQLITE_INT_RANGE[1]:
+        return float(value)
+    return value
+
+
+def _quote_sql_string(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _match_bools_too(alias, sql, params, values):
+    '''
+    Extend an equality test on sort_value to bools equal to the values
+
+    Bools have no sort_value (they aren't ordered), but True == 1 and
+    False == 0, and the version 1 engine finds them that way.
+
+    :param alias: SQL alias of the props row
+    :param sql: Test on the sort_value column
+    :param params: Parameters of sql
+    :param values: Values being tested for
+    :return: (sql, params)
+    '''
+    bool_values = sorted(set([json.dumps(value == 1) for value in values
+                              if calc_sort_key(value)[0] == 0 and value in (0, 1)]))
+    if len(bool_values) == 0:
+        return sql, params
+    return "(%s OR (%s.sort_value IS NULL AND %s.value_type = 'python' AND %s.value IN (%s)))" % (
+        sql, alias, alias, alias, ','.join(['?'] * len(bool_values))), params + bool_values
+
+
+class DocColEngineV3(DocColEngine):
+    '''
+    Engine storing documents in a single SQLite database
+
+    For large collections: no folder per document, and a lookup is an
+    indexed query rather than several file system calls.
+
+      collection.db           domains, docs, and one props row per property
+                              (stored value as JSON, plus a sort_value column
+                              for plain numbers and strings that find_docs()
+                              tests and orders by in SQL).  WAL journal mode.
+      collection.properties   Collection settings (as in version 1)
+      attachments/            Attachment files, in a folder per
+                              DOCS_PER_ATTACHMENT_FOLDER documents
+      blobs/, index/text/     Blob store and full-text index (as in version 1)
+
+    Property values use the version 1 data types.  declare_index() creates a
+    partial SQLite index on the property's sort_value.  The database is only
+    changed through the engine, so refresh_indexes() has nothing to do.
+    '''
+
+    DATA_TYPES = DocColEngineV1.DATA_TYPES
+
+    def __init__(self, path):
+        self.__path = path
+        self.__local = threading.local()        # Per thread: db connection and open batch
+
+        self.__settings = PropertyFile(os.path.join(self.__path, 'collection.properties'))
+        self.__settings.def_property('dedup_attachments', default=False)
+        self.__settings.def_property('compress_attachments', default=None)
+        self.__settings.def_property('chunk_attachments', default=False)
+        self.__settings.def_property('indexes', default=None)
+        self.__settings.def_property('text_index', default=None)
+        self.__settings.def_property('index_durability', default=LookupFile.DURABILITY_OS)
+        self.__col_store = ColStoreV1(self.__path, self.__settings)
+
+        self.__text_index = TextIndexV1(
+            index_path = os.path.join(self.__path, 'index'),
+            settings = self.__settings,
+            iter_docs = self._iter_stored_docs,
+            col_store = self.__col_store)
+
+        db = self._get_db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+
+
+    @property
+    def settings(self):
+        '''
+        Collection-wide settings (saved in collection.properties)
+
+          dedup_attachments:  Store attachments once in blobs/ and hard link
+                              them into documents (default False)
+          compress_attachments: Store attachments compressed with 'zlib' or
+                              'bz2' (default None: stored as is)
+          chunk_attachments:  Split attachments into content-defined chunks
+                              stored once in chunks/ (default False)
+          indexes:            Properties with SQLite indexes (see declare_index())
+          text_index:         Full-text index settings (see declare_text_index())
+          index_durability:   How index files are written: 'os' (default),
+                              'group' or 'fsync' (see LookupFile).  Read when
+                              the collection is opened.
+        '''
+        return self.__settings
+
+
+    @property
+    def blob_store(self):
+        '''BlobStoreV1 for deduplicated attachments'''
+        return self.__col_store.blob_store
+
+
+    @property
+    def chunk_store(self):
+        '''ChunkStoreV1 for chunked attachments'''
+        return self.__col_store.chunk_store
+
+
+    # -- Database ------------------------------------------------------------
+
+    @property
+    def db_path(self):
+        return os.path.join(self.__path, 'collection.db')
+
+
+    def _get_db(self):
+        '''
+        Connection for the calling thread (sqlite3 connections can't be shared)
+
+        Opened in autocommit mode: transactions are started explicitly by
+        _transaction() and batch().
+        '''
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.__local.db = db
+            self.__local.batch_depth = 0
+        return db
+
+
+    @contextmanager
+    def _transaction(self):
+        '''
+        Run statements in a transaction (or as part of the open batch)
+
+        :return: Connection (via with)
+        '''
+        db = self._get_db()
+        if self.__local.batch_depth > 0:
+            yield db
+            return
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+    @contextmanager
+    def batch(self):
+        '''
+        Make the changes in the with block in one transaction
+
+        Changes are committed when the block exits, or rolled back if it
+        raises.  Attachment files replaced or deleted in the block are only
+        removed once committed, and ones added are removed on a rollback.
+        Nested calls join the outer batch.  Per thread.
+        '''
+        db = self._get_db()
+        if self.__local.batch_depth > 0:
+            self.__local.batch_depth += 1
+            try:
+                yield
+            finally:
+                self.__local.batch_depth -= 1
+            return
+
+        db.execute('BEGIN IMMEDIATE')
+        self.__local.batch_depth = 1
+        self.__local.batch_on_commit = list()      # Callables to run once committed
+        self.__local.batch_on_rollback = list()    # Callables to run if rolled back
+        self.__local.batch_doc_ids = dict()        # [doc_key] = doc_id changed in the batch
+        try:
+            yield
+        except:
+            self.__local.batch_depth = 0
+            db.execute('ROLLBACK')
+            for callback in self.__local.batch_on_rollback:
+                callback()
+            self._reindex_text(self.__local.batch_doc_ids.values())
+            raise
+        self.__local.batch_depth = 0
+        db.execute('COMMIT')
+        for callback in self.__local.batch_on_commit:
+            callback()
+
+
+    def _on_commit(self, callback):
+        '''Run callback once the changes are committed (now, unless a batch is open)'''
+        if self.__local.batch_depth > 0:
+            self.__local.batch_on_commit.append(callback)
+        else:
+            callback()
+
+
+    def _on_rollback(self, callback):
+        '''Run callback if the open batch is rolled back'''
+        if self.__local.batch_depth > 0:
+            self.__local.batch_on_rollback.append(callback)
+
+
+    def _reindex_text(self, doc_ids):
+        '''Bring the text index back in line with the database (after a rollback)'''
+        for doc_id in doc_ids:
+            stored_values = self._load_stored_values([doc_id.doc_key]).get(doc_id.doc_key, dict())
+            self.__text_index.replace_doc(self._calc_doc_ref(doc_id), stored_values)
+
+
+    # -- Domains -------------------------------------------------------------
+
+    def _get_domain_key(self, domain, must_exist=False):
+        '''
+        :param domain: Name of domain
+        :param must_exist: If False, the domain is created if needed
+        :return: Row id of the domain, or None
+        '''
+        db = self._get_db()
+        row = db.execute('SELECT id FROM domains WHERE name = ?', (domain, )).fetchone()
+        if row is not None:
+            return row[0]
+        if must_exist:
+            return None
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO domains (name) VALUES (?)', (domain, ))
+            return db.execute('SELECT id FROM domains WHERE name = ?', (domain, )).fetchone()[0]
+
+
+    def list_all_domains(self):
+        '''
+        List all domains in the collection
+
+        :return: Generator listing domain names
+        '''
+        for row in self._get_db().execute('SELECT name FROM domains ORDER BY name').fetchall():
+            yield row[0]
+
+
+    # -- Documents -----------------------------------------------------------
+
+    def _calc_attachment_path(self, doc_id):
+        '''Folder to store a document's attachment files in (created if needed)'''
+        path = os.path.join(self.__path, 'attachments',
+                            str(doc_id.doc_key // DOCS_PER_ATTACHMENT_FOLDER))
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        return path
+
+
+    def _calc_prop_file_prefix(self, doc_id, prop_name):
+        return '%d-%s-%s' % (doc_id.doc_key, sanitize_folder_name(prop_name), abs(hash(prop_name)))
+
+
+    def _calc_doc_ref(self, doc_id):
+        '''Key for a document in the text index'''
+        return '%d/%d' % (doc_id.domain_key, doc_id.doc_key)
+
+
+    def create_new_doc(self, domain, name):
+        '''
+        Initialize a new document in the collection
+
+        :param domain: Domain (like a folder) of documents
+        :param name: Unique ID of document in the domain
+        :return: Internal Document ID
+        '''
+        domain_key = self._get_domain_key(domain)
+        try:
+            with self._transaction() as db:
+                cursor = db.execute('INSERT INTO docs (domain_id, name) VALUES (?, ?)',
+                                    (domain_key, name))
+                doc_key = cursor.lastrowid
+        except sqlite3.IntegrityError:
+            raise KeyError("Document already exists in domain (%s): %s" % (domain, name))
+
+        return V3DocumentId(domain=domain, domain_key=domain_key, name=name, doc_key=doc_key)
+
+
+    def create_new_docs(self, domain, items, workers=4):
+        '''
+        Initialize many new documents (with properties) in one domain
+
+        Documents are processed in chunks: rows are inserted, property values
+        (and attachment copies) are prepared on a pool of threads, then the
+        chunk is committed in one transaction.
+
+        :param domain: Domain (like a folder) of documents
+        :param items: Iterable of (name, properties dict)
+        :param workers: Number of threads to prepare property values on
+        :return: Generator of (name, Internal Document ID or None, Exception or None)
+        '''
+        domain_key = self._get_domain_key(domain)
+
+        pool = ThreadPool(workers)
+        try:
+            chunk = list()
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= BULK_CHUNK_SIZE:
+                    for result in self._create_new_docs_chunk(domain, domain_key, chunk, pool):
+                        yield result
+                    chunk = list()
+            if len(chunk) > 0:
+                for result in self._create_new_docs_chunk(domain, domain_key, chunk, pool):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def _create_new_docs_chunk(self, domain, domain_key, chunk, pool):
+        '''Create one chunk of documents for create_new_docs()'''
+        results = list()
+        created = list()
+
+        with self.batch():
+            db = self._get_db()
+
+            for name, properties in chunk:
+                try:
+                    try:
+                        cursor = db.execute('INSERT INTO docs (domain_id, name) VALUES (?, ?)',
+                                            (domain_key, name))
+                    except sqlite3.IntegrityError:
+                        raise KeyError("Document already exists in domain (%s): %s" % (domain, name))
+                    doc_id = V3DocumentId(
+                        domain = domain,
+                        domain_key = domain_key,
+                        name = name,
+                        doc_key = cursor.lastrowid)
+                    results.append([name, doc_id, None])
+                    created.append((len(results)-1, doc_id, properties))
+                except Exception, e:
+                    results.append([name, None, e])
+
+            # Prepare property values (copies attachments in) in parallel
+            def _encode(args):
+                i, doc_id, properties = args
+                try:
+                    return i, self._encode_properties(doc_id, properties), None
+                except Exception, e:
+                    return i, None, e
+
+            for i, encoded, error in pool.imap(_encode, created):
+                doc_id = results[i][1]
+                if error is None:
+                    self._save_stored_values(db, doc_id, encoded, encoded.keys())
+                    self.__text_index.update_doc(self._calc_doc_ref(doc_id), dict(), encoded)
+                else:
+                    self.del_document(doc_id)
+                    results[i][1] = None
+                    results[i][2] = error
+
+        return [tuple(result) for result in results]
+
+
+    def _encode_properties(self, doc_id, properties):
+        '''
+        Convert property values for storage (without saving them)
+
+        :param doc_id: Internal Document ID
+        :param properties: Dictionary of properties to encode (None values skipped)
+        :return: Dictionary of encoded properties
+        '''
+        encoded = dict()
+        for prop_name, prop_value in properties.items():
+            if prop_value is not None:
+                encoded[prop_name] = encode_prop_value_for_disk(
+                    prop_value = prop_value,
+                    store_path = self._calc_attachment_path(doc_id),
+                    store_prefix = self._calc_prop_file_prefix(doc_id, prop_name),
+                    col_store = self.__col_store)
+        return encoded
+
+
+    def get_document_id(self, domain, name):
+        '''
+        Retrieve document from collection
+
+        :param domain: Domain (like a folder) of documents
+        :param name: Unique ID of document in the domain
+        :return: Internal Document ID
+        '''
+        row = self._get_db().execute('''
+            SELECT domains.id, docs.id FROM docs
+            JOIN domains ON domains.id = docs.domain_id
+            WHERE domains.name = ? AND docs.name = ?''', (domain, name)).fetchone()
+        if row is None:
+            return None
+        return V3DocumentId(domain=domain, domain_key=row[0], name=name, doc_key=row[1])
+
+
+    def list_all_docs(self, domain=None):
+        '''
+        List all documents in a domain in the collection
+
+        :param domain: Name of the domain (None for all domains)
+        :return: Generator listing document ids (ordered by domain and name)
+        '''
+        for doc_id, stored_values, stamp in self._iter_docs(domain, with_properties=False):
+            yield doc_id
+
+
+    def list_all_docs_with_properties(self, domain=None, workers=8, after=None):
+        '''
+        List all documents with their properties loaded
+
+        Properties are read with the documents, a chunk at a time.
+
+        :param domain: Name of the domain (None for all domains)
+        :param workers: Not used (reads are one query per chunk)
+        :param after: Start after this document (an id from listing the same domain)
+        :return: Generator of (document id, properties, stamp) (ordered by domain and name)
+        '''
+        where_sql, where_params = '', ()
+        if after is not None:
+            where_sql, where_params = '(domains.name > ? OR (domains.name = ? AND docs.name > ?))', \
+                                      (after.domain, after.domain, after.doc_name)
+        for doc_id, stored_values, stamp in self._iter_docs(domain, where_sql=where_sql,
+                                                            where_params=where_params):
+            yield doc_id, self._make_lazy_properties(doc_id, stored_values), stamp
+
+
+    def _iter_docs(self, domain, with_properties=True, where_sql='', where_params=()):
+        '''
+        List documents (and their stored properties)
+
+        :param domain: Name of the domain (None for all domains)
+        :param with_properties: Load stored properties too
+        :return: Generator of (document id, stored values or None, stamp)
+        '''
+        sql = '''SELECT domains.name, domains.id, docs.name, docs.id, docs.stamp
+                 FROM docs JOIN domains ON domains.id = docs.domain_id'''
+        params = list()
+        conditions = list()
+        if domain is not None:
+            conditions.append('domains.name = ?')
+            params.append(domain)
+        if where_sql:
+            conditions.append(where_sql)
+            params.extend(where_params)
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY domains.name, docs.name'
+
+        # Fetch the list up front so no cursor stays open while callers write
+        rows = self._get_db().execute(sql, params).fetchall()
+        for i in range(0, len(rows), LIST_CHUNK_SIZE):
+            chunk = rows[i:i+LIST_CHUNK_SIZE]
+            stored = dict()
+            if with_properties:
+                stored = self._load_stored_values([row[3] for row in chunk])
+            for domain_name, domain_key, doc_name, doc_key, stamp in chunk:
+                doc_id = V3DocumentId(
+                    domain = domain_name,
+                    domain_key = domain_key,
+                    name = doc_name,
+                    doc_key = doc_key)
+                yield doc_id, stored.get(doc_key, dict()) if with_properties else None, stamp
+
+
+    def _load_stored_values(self, doc_keys):
+        '''
+        Read stored properties of documents
+
+        :param doc_keys: Row ids of the documents
+        :return: Dictionary of [doc_key] = dictionary of stored values
+        '''
+        stored = dict()
+        db = self._get_db()
+        doc_keys = list(doc_keys)
+        for i in range(0, len(doc_keys), LIST_CHUNK_SIZE):
+            chunk = doc_keys[i:i+LIST_CHUNK_SIZE]
+            rows = db.execute(
+                'SELECT doc_id, name, value_type, value FROM props WHERE doc_id IN (%s)' % (
+                    ','.join(['?'] * len(chunk))), chunk).fetchall()
+            for doc_key, prop_name, value_type, value in rows:
+                if doc_key not in stored:
+                    stored[doc_key] = dict()
+                stored[doc_key][prop_name] = {
+                    'value_type': value_type,
+                    'value': json.loads(value),
+                }
+        return stored
+
+
+    def _iter_stored_docs(self, cache=True):
+        '''
+        List every document's stored property values (for the text index)
+
+        :param cache: Unused (nothing is cached; each thread has its own connection)
+        :return: Generator of (doc_ref, stored_values)
+        '''
+        for doc_id, stored_values, stamp in self._iter_docs(None):
+            yield self._calc_doc_ref(doc_id), stored_values
+
+
+    # -- Properties ----------------------------------------------------------
+
+    def get_document_properties(self, doc_id):
+        '''
+        Get all of the properties for a document
+
+        Values are decoded as they're accessed (see LazyPropertiesV1)
+
+        :param doc_id: Internal Document ID
+        :return: dict-like of properties (safe to modify)
+        '''
+        stored_values = self._load_stored_values([doc_id.doc_key]).get(doc_id.doc_key, dict())
+        return self._make_lazy_properties(doc_id, stored_values)
+
+
+    def _make_lazy_properties(self, doc_id, stored_values):
+        def _decode(prop_name, prop_value):
+            try:
+                return decode_prop_value_from_disk(
+                    stored_value = prop_value,
+                    store_path = self._calc_attachment_path(doc_id),
+                    store_prefix = self._calc_prop_file_prefix(doc_id, prop_name),
+                    col_data_types = self.DATA_TYPES,
+                    col_store = self.__col_store)
+            except PropertyValueDecodeError, e:
+                raise PropertyValueDecodeError(
+                    "Unable to decode property '%s' for document %s: %s" % (
+                        prop_name, str(doc_id), str(e)))
+
+        return LazyPropertiesV1(stored_values, _decode, dict())
+
+
+    def get_document_stamp(self, doc_id):
+        '''
+        Get a cheap token that changes when the document's properties change
+
+        :param doc_id: Internal Document ID
+        :return: Change counter of the document, or None if missing
+        '''
+        row = self._get_db().execute(
+            'SELECT stamp FROM docs WHERE id = ?', (doc_id.doc_key, )).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+
+    def update_properties(self, doc_id, properties):
+        '''
+        For each key in the properties, set the value in the document
+
+        :param doc_id: Internal Document ID
+        :param properties: Dictionary of properties to set
+        '''
+        old_stored = self._load_stored_values([doc_id.doc_key]).get(doc_id.doc_key, dict())
+        existing_properties = self._make_lazy_properties(doc_id, old_stored)
+        props_to_delete = list()
+
+        # Convert property values for storage
+        new_stored = dict(old_stored)
+        for prop_name, prop_value in properties.items():
+
+            try:
+                props_to_delete.append(existing_properties[prop_name])
+            except KeyError:
+                pass
+
+            if prop_value is None:
+                new_stored.pop(prop_name, None)
+            else:
+                new_stored[prop_name] = encode_prop_value_for_disk(
+                    prop_value = prop_value,
+                    store_path = self._calc_attachment_path(doc_id),
+                    store_prefix = self._calc_prop_file_prefix(doc_id, prop_name),
+                    col_store = self.__col_store)
+
+        # Save properties
+        with self._transaction() as db:
+            self._save_stored_values(db, doc_id, new_stored, properties.keys())
+        self.__text_index.update_doc(self._calc_doc_ref(doc_id), old_stored, new_stored)
+
+        # Delete old values
+        def _delete_old_values():
+            for value in props_to_delete:
+                safe_del_prop_value(value)
+        self._on_commit(_delete_old_values)
+
+
+    def _save_stored_values(self, db, doc_id, stored_values, prop_names):
+        '''
+        Write property rows (and bump the document's stamp)
+
+        :param db: Connection in a transaction
+        :param doc_id: Internal Document ID
+        :param stored_values: Dictionary of encoded values (missing ones are deleted)
+        :param prop_names: Names of the properties to write (their values are new)
+        '''
+        if self.__local.batch_depth > 0:
+            self.__local.batch_doc_ids[doc_id.doc_key] = doc_id
+            new_values = dict([(prop_name, stored_values[prop_name])
+                               for prop_name in prop_names if prop_name in stored_values])
+            self._on_rollback(lambda: self._remove_stored_files(new_values))
+
+        for prop_name in prop_names:
+            if prop_name in stored_values:
+                stored_value = stored_values[prop_name]
+                db.execute('''INSERT OR REPLACE INTO props
+                              (doc_id, name, value_type, value, sort_value)
+                              VALUES (?, ?, ?, ?, ?)''', (
+                    doc_id.doc_key, prop_name,
+                    stored_value['value_type'],
+                    json.dumps(stored_value['value']),
+                    calc_sort_value(stored_value)))
+            else:
+                db.execute('DELETE FROM props WHERE doc_id = ? AND name = ?',
+                           (doc_id.doc_key, prop_name))
+        db.execute('UPDATE docs SET stamp = stamp + 1 WHERE id = ?', (doc_id.doc_key, ))
+
+
+    def replace_properties(self, doc_id, properties):
+        '''
+        Replace all properties in document with these ones
+
+        :param doc_id: Internal Document ID
+        :param properties: Dictionary of properties to set
+        '''
+        values = dict(properties)
+        for prop_name in self.get_document_properties(doc_id).keys():
+            if prop_name not in values:
+                values[prop_name] = None
+        self.update_properties(doc_id, values)
+
+
+    def del_property(self, doc_id, name):
+        '''
+        Delete a property from the document
+
+        :param doc_id: Internal Document ID
+        :param name: Name of property to delete
+        '''
+        self.update_properties(doc_id, {name: None})
+
+
+    def del_document(self, doc_id):
+        '''
+        Delete a document from the collection
+
+        :param doc_id: Internal Document ID
+        '''
+        stored_values = self._load_stored_values([doc_id.doc_key]).get(doc_id.doc_key, dict())
+
+        with self._transaction() as db:
+            db.execute('DELETE FROM props WHERE doc_id = ?', (doc_id.doc_key, ))
+            db.execute('DELETE FROM docs WHERE id = ?', (doc_id.doc_key, ))
+            if self.__local.batch_depth > 0:
+                self.__local.batch_doc_ids[doc_id.doc_key] = doc_id
+        self.__text_index.remove_doc(self._calc_doc_ref(doc_id))
+
+        self._on_commit(lambda: self._remove_stored_files(stored_values))
+
+
+    def _remove_stored_files(self, stored_values):
+        '''
+        Remove the attachment files of stored values
+
+        :param stored_values: Dictionary of encoded values
+        '''
+        for stored_value in stored_values.values():
+            for value in iter_stored_values(stored_value, FileAttachmentV1.type_code):
+                if value.get('path') and os.path.exists(value['path']):
+                    os.unlink(value['path'])
+                if value.get('blob'):
+                    blob_store = self.__col_store.blob_store
+                    blob_store.release(blob_store.calc_blob_key(value['hash'], value.get('compression')))
+
+
+    # -- Queries -------------------------------------------------------------
+
+    def _translate_test(self, alias, test):
+        '''
+        Express a predicate on a property's sort_value column in SQL
+
+        :param alias: SQL alias of the props row
+        :param test: Predicate
+        :return: (sql, params), or None if it has to be tested in Python
+        '''
+        column = alias + '.sort_value'
+        if isinstance(test, Eq):
+            if calc_sort_key(test.value) is None:
+                return None
+            return _match_bools_too(alias, '%s = ?' % (column), [_to_sql_value(test.value)],
+                                    [test.value])
+
+        if isinstance(test, In):
+            if len([value for value in test.values if calc_sort_key(value) is None]) > 0:
+                return None
+            if len(test.values) == 0:
+                return '0', []
+            return _match_bools_too(alias,
+                '%s IN (%s)' % (column, ','.join(['?'] * len(test.values))),
+                [_to_sql_value(value) for value in test.values], test.values)
+
+        if isinstance(test, Prefix):
+            if not isinstance(test.prefix, basestring):
+                return None
+            return "typeof(%s) = 'text' AND %s >= ? AND substr(%s, 1, ?) = ?" % (
+                column, column, column), [test.prefix, len(test.prefix), test.prefix]
+
+        if isinstance(test, Range):
+            bounds = [(value, op) for value, op in (
+                (test.low, '>=' if test.low_inclusive else '>'),
+                (test.high, '<=' if test.high_inclusive else '<')) if value is not None]
+            if len(bounds) == 0:
+                return None
+            ranks = set()
+            for value, op in bounds:
+                sort_key = calc_sort_key(value)
+                if sort_key is None:
+                    return None
+                ranks.add(sort_key[0])
+            if len(ranks) > 1:
+                return '0', []
+            if ranks.pop() == 0:
+                sql = ["typeof(%s) IN ('integer', 'real')" % (column)]
+            else:
+                sql = ["typeof(%s) = 'text'" % (column)]
+            params = list()
+            for value, op in bounds:
+                sql.append('%s %s ?' % (column, op))
+                params.append(_to_sql_value(value))
+            return ' AND '.join(sql), params
+
+        return None
+
+
+    def find_docs(self, domain, where, limit=None, workers=None, order_by=None):
+        '''
+        Find documents whose property values pass every predicate
+
+        Predicates on plain numbers and strings are run in SQL (using the
+        SQLite index of properties passed to declare_index()); others are
+        tested in Python on the stored values.
+
+        :param domain: Name of the domain (None for all domains)
+        :param where: Dictionary of [property_name] = Predicate (or value to equal)
+        :param limit: Stop after this many documents are found
+        :param workers: Not used
+        :param order_by: Property name to sort by ('-name' for descending).
+                         Documents without a number or string value for it are left out.
+        :return: Generator listing document ids
+        '''
+        where = compile_where(where)
+        if limit is not None and limit <= 0:
+            return
+
+        joins = list()
+        params = list()
+        python_where = list()
+        for i, (prop_name, test) in enumerate(where):
+            alias = 'p%d' % (i)
+            translated = self._translate_test(alias, test)
+            if translated is None:
+                python_where.append((prop_name, test))
+                continue
+            sql, test_params = translated
+            # Property name inline (not a parameter) so SQLite can use the partial index
+            joins.append('JOIN props %s ON %s.doc_id = docs.id AND %s.name = %s AND %s' % (
+                alias, alias, alias, _quote_sql_string(prop_name), sql))
+            params.extend(test_params)
+
+        order_sql = 'domains.name, docs.name'
+        if order_by is not None:
+            direction = 'DESC' if order_by.startswith('-') else 'ASC'
+            joins.append('JOIN props po ON po.doc_id = docs.id AND po.name = %s '
+                         'AND po.sort_value IS NOT NULL' % (_quote_sql_string(order_by.lstrip('-'))))
+            order_sql = 'po.sort_value %s, docs.id %s' % (direction, direction)
+
+        sql = '''SELECT domains.name, domains.id, docs.name, docs.id
+                 FROM docs JOIN domains ON domains.id = docs.domain_id ''' + ' '.join(joins)
+        if domain is not None:
+            sql += ' WHERE domains.name = ?'
+            params.append(domain)
+        sql += ' ORDER BY ' + order_sql
+        if limit is not None and len(python_where) == 0:
+            sql += ' LIMIT %d' % (limit)
+
+        rows = self._get_db().execute(sql, params).fetchall()
+
+        found = 0
+        for i in range(0, len(rows), LIST_CHUNK_SIZE):
+            chunk = rows[i:i+LIST_CHUNK_SIZE]
+            stored = dict()
+            if len(python_where) > 0:
+                stored = self._load_stored_values([row[3] for row in chunk])
+            for domain_name, domain_key, doc_name, doc_key in chunk:
+                if len(python_where) > 0:
+                    if not stored_values_match(stored.get(doc_key, dict()), python_where):
+                        continue
+                yield V3DocumentId(
+                    domain = domain_name,
+                    domain_key = domain_key,
+                    name = doc_name,
+                    doc_key = doc_key)
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+
+    # -- Property indexes ----------------------------------------------------
+
+    def _calc_index_name(self, prop_name):
+        return 'prop_idx_' + hashlib.md5(prop_name.encode('utf-8')).hexdigest()[:16]
+
+
+    @property
+    def declared_indexes(self):
+        '''Dictionary of [prop_name] = index kind'''
+        return dict(self.__settings['indexes'] or dict())
+
+
+    def declare_index(self, prop_name, kind='equality'):
+        '''
+        Keep an SQLite index on a property so find_docs() doesn't need to scan
+
+        Both kinds are the same B-tree index (it answers equality, ranges,
+        prefixes and order_by).
+
+        :param prop_name: Name of the property to index
+        :param kind: 'equality' or 'sorted'
+        '''
+        if kind not in INDEX_KINDS:
+            raise KeyError("Unknown index type: " + str(kind))
+        with self._transaction() as db:
+            db.execute('CREATE INDEX IF NOT EXISTS %s ON props (sort_value, doc_id) WHERE name = %s' % (
+                self._calc_index_name(prop_name), _quote_sql_string(prop_name)))
+        declared = self.declared_indexes
+        declared[prop_name] = kind
+        self.__settings['indexes'] = declared
+
+
+    def drop_index(self, prop_name):
+        '''
+        Stop indexing a property
+
+        :param prop_name: Name of the property
+        '''
+        with self._transaction() as db:
+            db.execute('DROP INDEX IF EXISTS %s' % (self._calc_index_name(prop_name)))
+        declared = self.declared_indexes
+        if prop_name in declared:
+            del declared[prop_name]
+            self.__settings['indexes'] = declared
+
+
+    def rebuild_indexes(self, prop_names=None):
+        '''
+        Rebuild SQLite indexes from scratch
+
+        :param prop_names: Properties to rebuild (None for all)
+        '''
+        db = self._get_db()
+        for prop_name in self.declared_indexes.keys():
+            if prop_names is None or prop_name in prop_names:
+                db.execute('REINDEX %s' % (self._calc_index_name(prop_name)))
+
+
+    def refresh_indexes(self):
+        '''
+        Nothing to do: the database is only changed through the engine
+
+        :return: 0
+        '''
+        return 0
+
+
+    # -- Full-text index -----------------------------------------------------
+
+    def declare_text_index(self, prop_names=None, attachments=True):
+        '''
+        Keep a full-text index so search_docs() can find documents by words
+
+        :param prop_names: Properties to index (None for every property)
+        :param attachments: Also index attachment files
+        '''
+        self.__text_index.declare(prop_names, attachments)
+
+
+    def drop_text_index(self):
+        '''Stop keeping the full-text index'''
+        self.__text_index.drop()
+
+
+    def rebuild_text_index(self, background=False):
+        '''
+        Rebuild the full-text index from scratch
+
+        :param background: Rebuild on another thread (searches use the old index meanwhile)
+        :return: threading.Thread doing the rebuild if background, else None
+        '''
+        return self.__text_index.rebuild(background)
+
+
+    def register_text_extractor(self, ext, extractor):
+        '''
+        Set how to get the text out of attachments of a file type
+
+        :param ext: File extension (ex: '.pdf')
+        :param extractor: Called with the path to the file, returns text (or None)
+        '''
+        self.__text_index.extractors[ext.lower()] = extractor
+
+
+    def search_docs(self, text, domain=None, limit=None):
+        '''
+        Find documents containing every word and "quoted phrase" in text
+
+        :param text: Search query
+        :param domain: Name of the domain (None for all domains)
+        :param limit: Max number of results
+        :return: Generator of (document id, score), best first
+        '''
+        ref_prefix = None
+        if domain is not None:
+            domain_key = self._get_domain_key(domain, must_exist=True)
+            if domain_key is None:
+                return
+            ref_prefix = '%d/' % (domain_key)
+
+        results = self.__text_index.search(text, ref_prefix, limit)
+        db = self._get_db()
+        for doc_ref, score in results:
+            doc_key = int(doc_ref.split('/', 1)[1])
+            row = db.execute('''
+                SELECT domains.name, domains.id, docs.name FROM docs
+                JOIN domains ON domains.id = docs.domain_id
+                WHERE docs.id = ?''', (doc_key, )).fetchone()
+            if row is None:
+                continue
+            yield V3DocumentId(
+                domain = row[0],
+                domain_key = row[1],
+                name = row[2],
+                doc_key = doc_key), score
@@ -0,0 +1,179 @@
+'''Check stored attachments still match the hashes recorded for them'''
+import os
+import time
+import errno
+import hashlib
+import multiprocessing
+from collections import deque
+
+from .v1.FileAttachmentV1 import FileAttachmentV1
+from .v1.ChunkStoreV1 import ChunkStoreV1
+from .v1.prop_pickle import iter_stored_values
+from .utils.CompressedFile import CompressedFileReader, CompressedFileError
+
+
+VERIFY_BUFFER_SIZE = 1024 * 1024
+PENDING_PER_PROCESS = 8
+
+
+class AttachmentCheck(object):
+    '''Outcome of checking one attachment with verify_attachments()'''
+
+    OK = 'ok'
+    MISMATCH = 'mismatch'           # Contents don't match the recorded hash
+    MISSING = 'missing'             # File isn't there
+    UNREADABLE = 'unreadable'       # File couldn't be read
+
+    def __init__(self, domain, doc_name, prop_name, path, status, detail=None):
+        self.domain = domain
+        self.doc_name = doc_name
+        self.prop_name = prop_name
+        self.path = path
+        self.status = status
+        self.detail = detail
+
+    @property
+    def ok(self):
+        return self.status == self.OK
+
+    def __str__(self):
+        msg = "%s :: %s [%s] %s: %s" % (
+            self.domain, self.doc_name, self.prop_name, self.status.upper(), self.path)
+        if self.detail:
+            msg += " (%s)" % (self.detail)
+        return msg
+
+
+def verify_attachments(engine, domain=None, processes=None, max_bytes_per_sec=None, include_ok=False):
+    '''
+    Re-hash every attachment and compare it to the hash recorded when it was stored
+
+    Attachments are found in every document's stored properties (including
+    ones nested in list and dict values) and hashed on a pool of processes,
+    so checking isn't limited to one core.  Only a few files per process are
+    queued at a time, and results are yielded as they come in (in document
+    order), so a collection of any size can be checked as a stream.
+    Compressed attachments are hashed as they're decompressed, and chunked
+    ones as they're reassembled.
+
+    :param engine: DocColEngine of the collection
+    :param domain: Name of the domain to check (None for all domains)
+    :param processes: Number of processes to hash with (default number of CPUs)
+    :param max_bytes_per_sec: Limit on total read speed (None for no limit)
+    :param include_ok: Also yield attachments that passed
+    :return: Generator of AttachmentCheck
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    bytes_per_process = None
+    if max_bytes_per_sec is not None:
+        bytes_per_process = max(1, max_bytes_per_sec // processes)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for doc_id, properties, stamp in engine.list_all_docs_with_properties(domain):
+            for prop_name, stored_value in properties.stored_values.items():
+                for value in iter_stored_values(stored_value, FileAttachmentV1.type_code):
+                    if value.get('chunks') is not None:
+                        source = ('chunks', engine.chunk_store.path, value['chunks'])
+                    elif value.get('path') is not None:
+                        source = ('file', value['path'], value.get('compression') is not None)
+                    else:
+                        continue
+                    task = (source, value.get('sha256') is not None, bytes_per_process)
+                    pending.append((doc_id, prop_name, value, pool.apply_async(_hash_file, (task, ))))
+
+                    while len(pending) >= processes * PENDING_PER_PROCESS:
+                        check = _finish_check(*pending.popleft())
+                        if include_ok or not check.ok:
+                            yield check
+
+        while len(pending) > 0:
+            check = _finish_check(*pending.popleft())
+            if include_ok or not check.ok:
+                yield check
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _finish_check(doc_id, prop_name, value, pending_hash):
+    '''Wait for a file's hashes and compare them to the recorded ones'''
+    error_status, detail, md5, sha256 = pending_hash.get()
+
+    status = error_status or AttachmentCheck.OK
+    if status == AttachmentCheck.OK:
+        if value.get('hash') is not None and value['hash'] != md5:
+            status = AttachmentCheck.MISMATCH
+            detail = "md5 %s, expected %s" % (md5, value['hash'])
+        elif value.get('sha256') is not None and value['sha256'] != sha256:
+            status = AttachmentCheck.MISMATCH
+            detail = "sha256 %s, expected %s" % (sha256, value['sha256'])
+
+    return AttachmentCheck(
+        domain = doc_id.domain,
+        doc_name = doc_id.doc_name,
+        prop_name = prop_name,
+        path = value.get('path') or "(chunked) %s" % (value.get('filename')),
+        status = status,
+        detail = detail)
+
+
+def _hash_file(task):
+    '''
+    Hash a file (runs in the worker processes)
+
+    :param task: (source, also calculate sha256?, max bytes per second or None)
+                 where source is ('file', path, compressed?) or
+                 ('chunks', chunk store path, manifest)
+    :return: (error status or None, error detail, md5 hex, sha256 hex or None)
+    '''
+    source, calc_sha256, bytes_per_sec = task
+
+    md5_hasher = hashlib.md5()
+    sha256_hasher = None
+    if calc_sha256:
+        sha256_hasher = hashlib.sha256()
+
+    try:
+        started = time.time()
+        bytes_read = 0
+        with _open_source(source) as fh:
+            data = fh.read(VERIFY_BUFFER_SIZE)
+            while data:
+                md5_hasher.update(data)
+                if sha256_hasher is not None:
+                    sha256_hasher.update(data)
+
+                # Sleep off any time we're ahead of the allowed rate
+                bytes_read += len(data)
+                if bytes_per_sec is not None:
+                    ahead = bytes_read / float(bytes_per_sec) - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+                data = fh.read(VERIFY_BUFFER_SIZE)
+    except (IOError, OSError), e:
+        if e.errno == errno.ENOENT:
+            return AttachmentCheck.MISSING, None, None, None
+        return AttachmentCheck.UNREADABLE, str(e), None, None
+    except CompressedFileError, e:
+        return AttachmentCheck.UNREADABLE, str(e), None, None
+
+    sha256 = None
+    if sha256_hasher is not None:
+        sha256 = sha256_hasher.hexdigest()
+    return None, None, md5_hasher.hexdigest(), sha256
+
+
+def _open_source(source):
+    '''Open an attachment's contents to hash (see _hash_file())'''
+    if source[0] == 'chunks':
+        kind, chunk_store_path, manifest = source
+        return ChunkStoreV1(chunk_store_path).open(manifest)
+    kind, path, compressed = source
+    if compressed:
+        return CompressedFileReader(path)
+    return open(path, 'rb')
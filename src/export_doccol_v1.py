@@ -0,0 +1,31 @@
+'''Export a binary (version 2) Document Collection as a version 1 (JSON) collection'''
+import os
+import sys
+
+from doccol.engine import pick_engine, DocCollectionOperationError
+
+def abort(msg = None):
+    print ""
+    if msg is not None:
+        print "ERROR: " + msg
+    print "ABORTING"
+    sys.exit(2)
+
+if __name__ == '__main__':
+
+    # Get arguments
+    if len(sys.argv) != 3:
+        abort ("Usage: %s colection_path export_path" % (os.path.basename(sys.argv[0])))
+    path = sys.argv[1].strip()
+    dest_path = sys.argv[2].strip()
+
+    # Do export
+    try:
+        engine = pick_engine(path)
+        if not hasattr(engine, 'export_v1'):
+            abort("Collection isn't in a format that can be exported: " + path)
+        engine.export_v1(dest_path)
+    except DocCollectionOperationError, e:
+        abort("Failed:\n" + str(e))
+
+    print "Finished"
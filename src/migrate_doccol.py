@@ -0,0 +1,40 @@
+'''Copy a Document Collection into a new collection of another format version'''
+import os
+import sys
+
+from doccol.engine import DocCollectionOperationError
+from doccol.engine.migrate import migrate_collection
+
+def abort(msg = None):
+    print ""
+    if msg is not None:
+        print "ERROR: " + msg
+    print "ABORTING"
+    sys.exit(2)
+
+def show_progress(domain, done):
+    print "%s: %d documents" % (domain, done)
+
+if __name__ == '__main__':
+
+    # Get arguments
+    if len(sys.argv) not in (4, 5):
+        abort ("Usage: %s colection_path dest_path version [workers]" % (os.path.basename(sys.argv[0])))
+    path = sys.argv[1].strip()
+    dest_path = sys.argv[2].strip()
+    try:
+        version = int(sys.argv[3])
+        workers = 4
+        if len(sys.argv) == 5:
+            workers = int(sys.argv[4])
+    except ValueError:
+        abort("Version and workers must be numbers")
+
+    # Do migration (run again to resume after a failure)
+    try:
+        copied = migrate_collection(path, dest_path, version, workers, show_progress)
+    except DocCollectionOperationError, e:
+        abort("Failed:\n" + str(e))
+
+    print "Copied %d documents" % (copied)
+    print "Finished"
@@ -0,0 +1,32 @@
+'''Rebuild the property (and full-text) indexes of a Document Collection'''
+import os
+import sys
+
+from doccol import DocumentCollection
+from doccol.engine import DocCollectionOperationError
+
+def abort(msg = None):
+    print ""
+    if msg is not None:
+        print "ERROR: " + msg
+    print "ABORTING"
+    sys.exit(2)
+
+if __name__ == '__main__':
+
+    # Get arguments
+    if len(sys.argv) < 2:
+        abort ("Usage: %s colection_path [property_name ...]" % (os.path.basename(sys.argv[0])))
+    path = sys.argv[1].strip()
+    prop_names = sys.argv[2:] or None
+
+    # Do rebuild
+    try:
+        col = DocumentCollection(path)
+        col.rebuild_indexes(prop_names)
+        if prop_names is None:
+            col.rebuild_text_index()
+    except DocCollectionOperationError, e:
+        abort("Failed:\n" + str(e))
+
+    print "Finished"
@@ -0,0 +1,96 @@
+'''
+Tests for sharing attachment files through the blob store (dedup_attachments)
+
+Run from src/:  python -m unittest discover -s tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from doccol import DocumentCollection
+from doccol.engine import create_doccol
+from doccol.engine.v1.BlobStoreV1 import BlobStoreV1
+
+
+class TestBlobStoreCompression(unittest.TestCase):
+
+    CONTENT = ''.join(['line %d of the attachment\n' % (i) for i in range(2000)])
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.attach_path = os.path.join(self.temp_dir, 'report.txt')
+        with open(self.attach_path, 'wb') as fh:
+            fh.write(self.CONTENT)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+    def _open_collection(self, version):
+        path = os.path.join(self.temp_dir, 'col%d' % (version))
+        os.mkdir(path)
+        create_doccol(path, version)
+        col = DocumentCollection(path)
+        col.settings['dedup_attachments'] = True
+        return col
+
+
+    def _add(self, col, name, compress):
+        doc = col.new('Docs', name)
+        doc.p.set(f=col.data_types.attachment(attach=self.attach_path, compress=compress))
+        return col.get('Docs', name).p.f
+
+
+    def _list_blobs(self, col):
+        blobs_path = col._DocumentCollection__engine.blob_store.path
+        names = list()
+        for shard in os.listdir(blobs_path):
+            if shard != 'incoming':
+                names.extend(os.listdir(os.path.join(blobs_path, shard)))
+        return sorted(names)
+
+
+    def _check_compression_keys(self, version):
+        col = self._open_collection(version)
+        attachments = dict()
+        for name, compress in (('raw 1', False), ('raw 2', False), ('zlib 1', 'zlib'),
+                               ('zlib 2', 'zlib'), ('bz2', 'bz2')):
+            attachments[name] = self._add(col, name, compress)
+
+        # Every copy reads back the content, with the right decoder
+        for name, attachment in attachments.items():
+            with attachment.open('rb') as fh:
+                self.assertEqual(fh.read(), self.CONTENT, name)
+
+        # Same content and method share a blob; each method has its own
+        hash = attachments['raw 1'].hash
+        self.assertEqual(self._list_blobs(col), sorted([hash, hash + '.bz2', hash + '.zlib']))
+        blob_store = col._DocumentCollection__engine.blob_store
+        for key in (hash, hash + '.zlib'):
+            self.assertEqual(os.stat(blob_store.calc_blob_path(key)).st_nlink, 3)   # Store + 2 docs
+
+        # Blobs are released with the documents using them
+        col.del_doc('Docs', 'zlib 1')
+        self.assertIn(hash + '.zlib', self._list_blobs(col))
+        col.del_doc('Docs', 'zlib 2')
+        col.del_doc('Docs', 'bz2')
+        self.assertEqual(self._list_blobs(col), [hash])
+
+
+    def test_compression_keys_v1(self):
+        self._check_compression_keys(1)
+
+
+    def test_compression_keys_v3(self):
+        self._check_compression_keys(3)
+
+
+    def test_calc_blob_key(self):
+        self.assertEqual(BlobStoreV1.calc_blob_key('abc'), 'abc')
+        self.assertEqual(BlobStoreV1.calc_blob_key('abc', 'zlib'), 'abc.zlib')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+'''
+Tests for Document and its property accessor (doc.p)
+
+Run from src/:  python -m unittest discover -s tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from doccol import DocumentCollection
+from doccol.engine import create_doccol
+
+
+class TestDocumentSnapshot(unittest.TestCase):
+
+    NAMES = ('load', 'refresh', 'loaded', 'is_stale')
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.temp_dir, 'col')
+        os.mkdir(path)
+        create_doccol(path, 1)
+        self.col = DocumentCollection(path)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+    def test_snapshot_names_usable_as_properties(self):
+        doc = self.col.new('Docs', 'doc')
+        doc.p.set(**dict([(name, name + ' value') for name in self.NAMES]))
+
+        for snapshot in (False, True):
+            doc = self.col.get('Docs', 'doc')
+            if snapshot:
+                doc.snapshot()
+            self.assertEqual(doc.loaded, snapshot)
+            for name in self.NAMES:
+                self.assertEqual(getattr(doc.p, name)['value'], name + ' value')
+
+
+    def test_stale_snapshot(self):
+        self.col.new('Docs', 'doc').p.set(n=1)
+        doc = self.col.get('Docs', 'doc')
+        self.assertFalse(doc.is_stale())
+
+        doc.snapshot()
+        self.col.get('Docs', 'doc').p.set(n=2)
+        self.assertTrue(doc.is_stale())
+        self.assertEqual(doc.p.n['value'], 1)
+
+        doc.refresh()
+        self.assertFalse(doc.is_stale())
+        self.assertEqual(doc.p.n['value'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
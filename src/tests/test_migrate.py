@@ -0,0 +1,97 @@
+'''
+Tests for migrate_collection() resuming an interrupted migration
+
+Run from src/:  python -m unittest discover -s tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from doccol import DocumentCollection
+from doccol.engine import create_doccol, migrate
+from doccol.engine.utils.LookupFile import LookupFile
+from doccol.engine.v1.DocColEngineV1 import DocColEngineV1
+
+
+class MigrationInterrupted(Exception): pass
+
+
+class TestMigrateResume(unittest.TestCase):
+
+    DOC_COUNT = 30
+    CHUNK_SIZE = 4
+    CHUNKS_BEFORE_CRASH = 5
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_chunk_size = migrate.MIGRATE_CHUNK_SIZE
+        migrate.MIGRATE_CHUNK_SIZE = self.CHUNK_SIZE
+
+
+    def tearDown(self):
+        migrate.MIGRATE_CHUNK_SIZE = self.orig_chunk_size
+        shutil.rmtree(self.temp_dir)
+
+
+    def _make_source(self, version):
+        path = os.path.join(self.temp_dir, 'src')
+        os.mkdir(path)
+        create_doccol(path, version)
+        col = DocumentCollection(path)
+        for i in range(self.DOC_COUNT):
+            col.new('Docs', 'doc %02d' % (i)).p.set(n=i)
+        return path
+
+
+    def _interrupt(self, src_path, dest_path, version):
+        '''Run a migration that crashes after CHUNKS_BEFORE_CRASH chunks'''
+        def _progress(domain, done):
+            if done >= self.CHUNK_SIZE * self.CHUNKS_BEFORE_CRASH:
+                raise MigrationInterrupted()
+        self.assertRaises(MigrationInterrupted,
+            migrate.migrate_collection, src_path, dest_path, version, 2, _progress)
+
+
+    def _check_resume(self, src_version, dest_version):
+        src_path = self._make_source(src_version)
+        dest_path = os.path.join(self.temp_dir, 'dest')
+        self._interrupt(src_path, dest_path, dest_version)
+        finished = self.CHUNK_SIZE * self.CHUNKS_BEFORE_CRASH
+
+        # Checkpoint names the last finished document
+        checkpoint = LookupFile(os.path.join(dest_path, migrate.CHECKPOINT_FILE_NAME))
+        self.assertEqual(checkpoint['after:Docs'], 'doc %02d' % (finished - 1))
+        checkpoint.close()
+
+        # Resuming only lists the documents after it
+        listed = list()
+        orig_list = DocColEngineV1.list_all_docs_with_properties
+        def _counting_list(engine, *args, **kwargs):
+            for doc in orig_list(engine, *args, **kwargs):
+                listed.append(doc[0].name)
+                yield doc
+        DocColEngineV1.list_all_docs_with_properties = _counting_list
+        try:
+            copied = migrate.migrate_collection(src_path, dest_path, dest_version, 2)
+        finally:
+            DocColEngineV1.list_all_docs_with_properties = orig_list
+
+        self.assertEqual(copied, self.DOC_COUNT - finished)
+        self.assertEqual(listed, ['doc %02d' % (i) for i in range(finished, self.DOC_COUNT)])
+
+        dest = DocumentCollection(dest_path)
+        self.assertEqual(sorted([doc.p.n['value'] for doc in dest.list_docs(None)]),
+                         range(self.DOC_COUNT))
+
+
+    def test_resume_v1_to_v3(self):
+        self._check_resume(1, 3)
+
+
+    def test_resume_v1_to_v2(self):
+        self._check_resume(1, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+Tests for the full-text index segment (TextPostingsV1)
+
+Run from src/:  python -m unittest discover -s tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from doccol.engine.v1 import TextIndexV1 as text_index_module
+from doccol.engine.v1.TextIndexV1 import TextPostingsV1
+
+
+def make_forward(words):
+    terms = dict()
+    for pos, word in enumerate(words):
+        terms.setdefault(word, list()).append(pos)
+    return len(words), terms
+
+
+class TestTextPostings(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.docs = dict()
+        for i in range(50):
+            words = ['common', 'word%d' % (i % 7), 'doc%d' % (i)] * (1 + i % 3)
+            self.docs['D/doc%02d' % (i)] = make_forward(words)
+
+        # Segment replaced while open fails on Windows: check it's closed first
+        self.orig_replace_file = text_index_module.replace_file
+        def _replace_file(src, dst):
+            self.assertTrue(self.postings.needs_rebuild, "Segment still open when replaced")
+            self.orig_replace_file(src, dst)
+        text_index_module.replace_file = _replace_file
+
+
+    def tearDown(self):
+        text_index_module.replace_file = self.orig_replace_file
+        self.postings.close()
+        shutil.rmtree(self.path)
+
+
+    def _check_postings(self, postings, docs):
+        for term in ('common', 'word3', 'doc7', 'missing'):
+            expected = dict([(doc_ref, forward[1][term]) for doc_ref, forward in docs.items()
+                             if term in forward[1]])
+            self.assertEqual(postings.get_postings(term), expected)
+        self.assertEqual(postings.stats[0], len(docs))
+
+
+    def test_rebuild_in_runs(self):
+        self.postings = TextPostingsV1(self.path)
+        self.assertTrue(self.postings.needs_rebuild)
+        orig_batch = TextPostingsV1.REBUILD_BATCH_POSITIONS
+        TextPostingsV1.REBUILD_BATCH_POSITIONS = 20     # Several runs to merge
+        try:
+            self.postings.rebuild(sorted(self.docs.items()))
+        finally:
+            TextPostingsV1.REBUILD_BATCH_POSITIONS = orig_batch
+        self._check_postings(self.postings, self.docs)
+
+        # Reads the saved segment when reopened
+        self.postings.close()
+        self.postings = TextPostingsV1(self.path)
+        self.assertFalse(self.postings.needs_rebuild)
+        self._check_postings(self.postings, self.docs)
+
+
+    def test_merge_journal(self):
+        self.postings = TextPostingsV1(self.path)
+        self.postings.rebuild(sorted(self.docs.items()))
+
+        # Change, remove and add documents, then fold the journal in
+        self.postings.set_doc('D/doc03', make_forward(['common', 'changed']))
+        self.docs['D/doc03'] = make_forward(['common', 'changed'])
+        self.postings.set_doc('D/doc07', None)
+        del self.docs['D/doc07']
+        self.postings.set_doc('D/new', make_forward(['word3', 'doc7']))
+        self.docs['D/new'] = make_forward(['word3', 'doc7'])
+        self._check_postings(self.postings, self.docs)
+
+        self.postings.merge()
+        self._check_postings(self.postings, self.docs)
+        self.assertEqual(self.postings.get_postings('changed'), {'D/doc03': [1]})
+
+        self.postings.close()
+        self.postings = TextPostingsV1(self.path)
+        self._check_postings(self.postings, self.docs)
+
+
+if __name__ == '__main__':
+    unittest.main()
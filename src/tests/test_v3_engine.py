@@ -0,0 +1,89 @@
+'''
+Tests for the version 3 (SQLite) engine matching the version 1 engine
+
+Run from src/:  python -m unittest discover -s tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from doccol import DocumentCollection
+from doccol.engine import create_doccol
+from doccol.engine.query import In
+
+
+class Abort(Exception): pass
+
+
+class TestV3Engine(unittest.TestCase):
+
+    VALUES = {'true': True, 'false': False, 'one': 1, 'zero': 0, 'one float': 1.0,
+              'two': 2, 'text': '1'}
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+    def _open_collection(self, version):
+        path = os.path.join(self.temp_dir, 'col%d' % (version))
+        os.mkdir(path)
+        create_doccol(path, version)
+        return DocumentCollection(path)
+
+
+    def _find_names(self, col, **predicates):
+        return sorted([doc.name for doc in col.find('Docs', **predicates)])
+
+
+    def test_bool_equality_matches_v1(self):
+        cols = [self._open_collection(version) for version in (1, 3)]
+        for col in cols:
+            for name, value in self.VALUES.items():
+                col.new('Docs', name).p.set(v=value)
+
+        for value in (1, 0, 1.0, True, False, 2, '1', In([1, 2]), In([0, 'x'])):
+            found = [self._find_names(col, v=value) for col in cols]
+            self.assertEqual(found[0], found[1], repr(value))
+        self.assertEqual(self._find_names(cols[1], v=1), ['one', 'one float', 'true'])
+
+
+    def test_batch_rolls_back(self):
+        attach_path = os.path.join(self.temp_dir, 'a.txt')
+        with open(attach_path, 'wb') as fh:
+            fh.write('attachment')
+
+        col = self._open_collection(3)
+        col.declare_text_index(['t'], attachments=False)
+        col.new('Docs', 'kept').p.set(t='original words',
+                                      f=col.data_types.attachment(attach=attach_path))
+        kept_path = col.get('Docs', 'kept').p.f.open('rb').name
+        files_before = sorted(os.listdir(os.path.dirname(kept_path)))
+
+        try:
+            with col.batch():
+                col.new('Docs', 'added').p.set(t='added words',
+                                               f=col.data_types.attachment(attach=attach_path))
+                col.get('Docs', 'kept').p.set(t='changed words',
+                                              f=col.data_types.attachment(attach=attach_path))
+                raise Abort()
+        except Abort:
+            pass
+
+        self.assertEqual([doc.name for doc in col.list_docs('Docs')], ['kept'])
+        kept = col.get('Docs', 'kept')
+        self.assertEqual(kept.p.t['value'], 'original words')
+        with kept.p.f.open('rb') as fh:
+            self.assertEqual(fh.read(), 'attachment')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(kept_path))), files_before)
+        self.assertEqual([doc.name for doc in col.search('original')], ['kept'])
+        self.assertEqual(list(col.search('changed')), [])
+        self.assertEqual(list(col.search('added')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
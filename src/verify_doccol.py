@@ -0,0 +1,42 @@
+'''Check the attachments in a Document Collection still match their recorded hashes'''
+import os
+import sys
+
+from doccol import DocumentCollection
+from doccol.engine import DocCollectionOperationError
+
+def abort(msg = None):
+    print ""
+    if msg is not None:
+        print "ERROR: " + msg
+    print "ABORTING"
+    sys.exit(2)
+
+if __name__ == '__main__':
+
+    # Get arguments
+    if len(sys.argv) not in (2, 3):
+        abort ("Usage: %s colection_path [max_mb_per_sec]" % (os.path.basename(sys.argv[0])))
+    path = sys.argv[1].strip()
+    max_mb_per_sec = None
+    if len(sys.argv) == 3:
+        try:
+            max_mb_per_sec = float(sys.argv[2])
+        except ValueError:
+            abort("Max MB per second must be a number: " + sys.argv[2])
+
+    # Do verify (problems are printed as they're found)
+    problems = 0
+    try:
+        col = DocumentCollection(path)
+        for check in col.verify_attachments(max_mb_per_sec=max_mb_per_sec):
+            print str(check)
+            sys.stdout.flush()
+            problems += 1
+    except DocCollectionOperationError, e:
+        abort("Failed:\n" + str(e))
+
+    print "Found %d problem attachments" % (problems)
+    print "Finished"
+    if problems > 0:
+        sys.exit(1)